@@ -0,0 +1,114 @@
+"""
+Measure the per-request overhead of API key authentication.
+
+Builds minimal applications with one route and compares no authentication,
+the original dependencies (linear scan of the key values in a sync dependency
+plus a dependency printing the key), the hashed key index, and the hashed key
+index with a rate limit that is never reached.
+
+    python benchmarks/bench_auth.py --requests 5000 --keys 1000
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import os
+import sys
+import time
+
+import fastapi
+import fastapi.security
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vmail.vmail_router import ratelimit  # noqa: E402
+
+
+def create_app(dependencies) -> fastapi.FastAPI:
+    app = fastapi.FastAPI()
+
+    @app.get("/verified", dependencies=dependencies)
+    async def verified():
+        return {}
+
+    return app
+
+
+def original_dependencies(api_keys):
+    api_key_header = fastapi.security.APIKeyHeader(name="X-API-Key")
+
+    def custom_header_dependency(x_api_key: str = fastapi.Header()) -> str:
+        print(f"XAPIKEY = {x_api_key}")
+        return x_api_key
+
+    def get_api_key(api_key: str = fastapi.Security(api_key_header)) -> str:
+        if api_key in api_keys.values():
+            return api_key
+        raise fastapi.HTTPException(status_code=401)
+
+    return [fastapi.Depends(get_api_key), fastapi.Depends(custom_header_dependency)]
+
+
+def hashed_dependencies(api_keys, limiter=None):
+    api_key_header = fastapi.security.APIKeyHeader(name="X-API-Key")
+    index = {hashlib.sha256(v.encode("utf-8")).digest(): k for k, v in api_keys.items()}
+
+    async def get_api_key(api_key: str = fastapi.Security(api_key_header)) -> str:
+        name = index.get(hashlib.sha256(api_key.encode("utf-8")).digest())
+        if name is not None:
+            return name
+        raise fastapi.HTTPException(status_code=401)
+
+    async def check_rate_limit(
+        request: fastapi.Request, client: str = fastapi.Depends(get_api_key)
+    ):
+        if limiter is None:
+            return
+        if await limiter.check(client, request.scope["route"].path) > 0:
+            raise fastapi.HTTPException(status_code=429)
+
+    return [fastapi.Depends(get_api_key), fastapi.Depends(check_rate_limit)]
+
+
+async def measure(app: fastapi.FastAPI, api_key: str, n_requests: int) -> float:
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app),
+        base_url="http://bench",
+        headers={"X-API-Key": api_key},
+    ) as client:
+        for _ in range(100):
+            await client.get("/verified")
+        t0 = time.perf_counter()
+        for _ in range(n_requests):
+            response = await client.get("/verified")
+            response.raise_for_status()
+        return (time.perf_counter() - t0) / n_requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--keys", type=int, default=1000)
+    args = parser.parse_args()
+    api_keys = {f"client{i}": f"key-{i:08d}" for i in range(args.keys)}
+    api_key = api_keys[f"client{args.keys - 1}"]
+    limiter = ratelimit.RateLimiter(ratelimit.LocalBackend(), {"*": "1000000/1"})
+    variants = (
+        ("none", []),
+        ("original", original_dependencies(api_keys)),
+        ("hashed", hashed_dependencies(api_keys)),
+        ("limited", hashed_dependencies(api_keys, limiter)),
+    )
+    results = {}
+    for label, dependencies in variants:
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[label] = asyncio.run(measure(create_app(dependencies), api_key, args.requests))
+    for label, seconds in results.items():
+        overhead = seconds - results["none"]
+        print(f"{label:>9}: {seconds * 1e6:.0f} us per request, {overhead * 1e6:+.0f} us auth")
+
+
+if __name__ == "__main__":
+    main()
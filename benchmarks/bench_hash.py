@@ -0,0 +1,49 @@
+"""
+Measure address hashes per second.
+
+Compares the original hash_something (new SHA-256 object fed the seed on every
+call) with the preloaded SHA-256 of scheme 0 and the keyed BLAKE2b of scheme 1.
+
+    python benchmarks/bench_hash.py --hashes 200000
+"""
+import argparse
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vmail.vmail_router  # noqa: E402
+from vmail.config import get_settings  # noqa: E402
+
+
+def hash_original(text: str) -> str:
+    h = hashlib.new("sha256")
+    h.update(get_settings().verify_seed.encode("utf-8"))
+    h.update(text.encode("utf-8"))
+    return h.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hashes", type=int, default=200000)
+    args = parser.parse_args()
+    seed = get_settings().verify_seed
+    hashers = (
+        ("original", hash_original),
+        ("scheme 0", vmail.vmail_router.HASH_SCHEMES[0](seed)),
+        ("scheme 1", vmail.vmail_router.HASH_SCHEMES[1](seed)),
+    )
+    assert hashers[0][1]("a@example.com") == hashers[1][1]("a@example.com")
+    addresses = [f"user{i}@example.com" for i in range(args.hashes)]
+    for label, hasher in hashers:
+        t0 = time.perf_counter()
+        for address in addresses:
+            hasher(address)
+        elapsed = time.perf_counter() - t0
+        print(f"{label:>10}: {args.hashes / elapsed:.0f} hashes/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Measure the overhead of metrics collection.
+
+Reports the cost of a single histogram observation and counter increment,
+the per-request overhead of MetricsMiddleware on a minimal application, and
+the per-statement overhead of the SQLAlchemy event hooks on in-memory SQLite.
+
+    python benchmarks/bench_metrics.py --requests 2000 --statements 5000 --rounds 5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import timeit
+
+import fastapi
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vmail.vmail_router import db, metrics  # noqa: E402
+
+
+def create_app(instrumented: bool) -> fastapi.FastAPI:
+    app = fastapi.FastAPI()
+    if instrumented:
+        app.add_middleware(metrics.MetricsMiddleware)
+
+    @app.get("/verified")
+    async def verified():
+        return {}
+
+    return app
+
+
+async def measure_requests(app: fastapi.FastAPI, n_requests: int) -> float:
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://bench"
+    ) as client:
+        for _ in range(100):
+            await client.get("/verified")
+        t0 = time.perf_counter()
+        for _ in range(n_requests):
+            await client.get("/verified")
+        return (time.perf_counter() - t0) / n_requests
+
+
+async def measure_statements(instrumented: bool, n_statements: int) -> float:
+    engine = db.create_engine("sqlite:///:memory:")
+    if instrumented:
+        metrics.instrument_engine(engine)
+    async with engine.connect() as connection:
+        await connection.exec_driver_sql("SELECT 1")
+        t0 = time.perf_counter()
+        for _ in range(n_statements):
+            await connection.exec_driver_sql("SELECT 1")
+        elapsed = (time.perf_counter() - t0) / n_statements
+    await engine.dispose()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--statements", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    histogram = metrics.Histogram("bench_seconds", "", ["route"])
+    counter = metrics.Counter("bench_total", "", ["route", "status"])
+    n = 200000
+    observe = timeit.timeit(lambda: histogram.observe(0.003, "/verified"), number=n) / n
+    inc = timeit.timeit(lambda: counter.inc("/verified", "200"), number=n) / n
+    print(f"histogram observe: {observe * 1e9:.0f} ns")
+    print(f"counter inc:       {inc * 1e9:.0f} ns")
+    # Alternate the variants and keep the best round of each to damp noise
+    requests = {False: [], True: []}
+    statements = {False: [], True: []}
+    for _ in range(args.rounds):
+        for instrumented in (False, True):
+            requests[instrumented].append(
+                asyncio.run(measure_requests(create_app(instrumented), args.requests))
+            )
+            statements[instrumented].append(
+                asyncio.run(measure_statements(instrumented, args.statements))
+            )
+    for label, results in (("request", requests), ("statement", statements)):
+        plain, instrumented = min(results[False]), min(results[True])
+        print(
+            f"{label}: {plain * 1e6:.0f} us plain, {instrumented * 1e6:.0f} us instrumented "
+            f"({(instrumented - plain) * 1e6:+.1f} us)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Count SQL statements and time the repository work of one /register call.
+
+Compares the original sequence (read, save, verification_requested) with
+VmailRepo.register against a temporary SQLite database, for new addresses
+and for addresses registered again. Statements are counted with a
+before_cursor_execute listener; COMMIT is counted separately.
+
+    python benchmarks/bench_register.py --addresses 2000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlalchemy  # noqa: E402
+import sqlalchemy.ext.asyncio  # noqa: E402
+
+from vmail.vmail_router import db, migrations, repo  # noqa: E402
+
+
+class Counter:
+    def __init__(self, engine: sqlalchemy.ext.asyncio.AsyncEngine):
+        self.statements = 0
+        self.commits = 0
+        sqlalchemy.event.listen(engine.sync_engine, "before_cursor_execute", self._execute)
+        sqlalchemy.event.listen(engine.sync_engine, "commit", self._commit)
+
+    def _execute(self, *args):
+        self.statements += 1
+
+    def _commit(self, *args):
+        self.commits += 1
+
+    def reset(self):
+        self.statements = 0
+        self.commits = 0
+
+
+async def register_original(repository: repo.VmailRepo, address: str, token: str):
+    record = await repository.read(address)
+    if record is None:
+        await repository.save(address)
+    await repository.verification_requested(address, token)
+
+
+async def register_upsert(repository: repo.VmailRepo, address: str, token: str):
+    await repository.register(address, token)
+
+
+async def measure(engine, counter, label, register, n_addresses, offset):
+    factory = sqlalchemy.ext.asyncio.async_sessionmaker(bind=engine, expire_on_commit=False)
+    for attempt in ("new", "again"):
+        counter.reset()
+        t0 = time.perf_counter()
+        for i in range(n_addresses):
+            async with factory() as session:
+                await register(
+                    repo.VmailRepo(session),
+                    f"user{i}@example.com",
+                    f"{attempt[0]}{offset + i}",
+                )
+        elapsed = time.perf_counter() - t0
+        print(
+            f"{label:>9} {attempt:>5}: {counter.statements / n_addresses:.1f} statements, "
+            f"{counter.commits / n_addresses:.1f} commits, "
+            f"{elapsed / n_addresses * 1e6:.0f} us per register"
+        )
+
+
+async def run(db_path: str, n_addresses: int):
+    for label, register in (("original", register_original), ("register", register_upsert)):
+        path = f"{db_path}.{label}"
+        engine = db.create_engine(f"sqlite:///{path}")
+        await migrations.initialize(engine)
+        counter = Counter(engine)
+        await measure(engine, counter, label, register, n_addresses, 0)
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--addresses", type=int, default=2000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(run(os.path.join(tmp, "bench.db"), args.addresses))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Measure verification messages rendered per second.
+
+Compares building each message from scratch (new Jinja environment and
+template lookup, MIME tree built and serialized per message, as fastapi_mail
+does) with the precompiled VerificationTemplate.
+
+    python benchmarks/bench_render.py --messages 5000
+"""
+import argparse
+import email.mime.multipart
+import email.mime.text
+import email.utils
+import os
+import sys
+import time
+
+import jinja2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vmail.vmail_router  # noqa: E402
+from vmail.config import get_settings  # noqa: E402
+
+
+def render_uncompiled(recipient: str) -> bytes:
+    settings = get_settings()
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(settings.template_path), autoescape=True
+    )
+    body = env.get_template("verify_email.html").render(
+        name=recipient,
+        email=recipient,
+        url="http://localhost/verify/123456",
+        otp="123456",
+        application_name="",
+    )
+    message = email.mime.multipart.MIMEMultipart("mixed")
+    message.set_charset("utf-8")
+    message.attach(email.mime.text.MIMEText(body, "html", "utf-8"))
+    message["Date"] = email.utils.formatdate(localtime=True)
+    message["Message-ID"] = email.utils.make_msgid()
+    message["To"] = recipient
+    message["From"] = email.utils.formataddr((settings.smtp_name, settings.smtp_from))
+    message["Subject"] = "Fastapi-Mail module"
+    return message.as_bytes()
+
+
+def render_compiled(recipient: str) -> bytes:
+    return vmail.vmail_router.build_verification_message(
+        recipient, "123456", "http://localhost/verify/123456"
+    ).data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=5000)
+    args = parser.parse_args()
+    for label, render in (("uncompiled", render_uncompiled), ("compiled", render_compiled)):
+        render("warmup@example.com")
+        t0 = time.perf_counter()
+        for i in range(args.messages):
+            render(f"user{i}@example.com")
+        elapsed = time.perf_counter() - t0
+        print(f"{label:>10}: {args.messages / elapsed:.0f} messages/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Measure verification email throughput against a local SMTP sink, with a new
+connection per message (fastapi_mail) and with the pooled SMTP sessions.
+
+Requires aiosmtpd.
+
+    python benchmarks/bench_smtp.py --messages 500 --concurrency 8
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Sink:
+    def __init__(self):
+        self.received = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received += 1
+        return "250 OK"
+
+
+def configure(port: int):
+    os.environ["VMAIL_SMTP_HOST"] = "127.0.0.1"
+    os.environ["VMAIL_SMTP_PORT"] = str(port)
+    os.environ["VMAIL_SMTP_SSL"] = "false"
+    os.environ["VMAIL_SMTP_STARTTLS"] = "false"
+    os.environ["VMAIL_SMTP_CREDENTIALS"] = "false"
+
+
+async def bench(send, n_messages: int, concurrency: int) -> float:
+    queue = asyncio.Queue()
+    for i in range(n_messages):
+        queue.put_nowait(f"user{i}@example.com")
+
+    async def worker():
+        while not queue.empty():
+            await send(queue.get_nowait())
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return time.perf_counter() - t0
+
+
+async def run(n_messages: int, concurrency: int):
+    import fastapi_mail
+    import vmail.vmail_router as vr
+
+    async def send_unpooled(recipient):
+        message = fastapi_mail.MessageSchema(
+            subject="Fastapi-Mail module",
+            recipients=[recipient],
+            template_body={
+                "name": recipient,
+                "email": recipient,
+                "url": "http://localhost/verify/123456",
+                "otp": "123456",
+                "application_name": "",
+            },
+            subtype=fastapi_mail.MessageType.html,
+        )
+        await fastapi_mail.FastMail(vr.mail_conf).send_message(
+            message, template_name="verify_email.html"
+        )
+
+    async def send_pooled(recipient):
+        assert await vr.send_verification_email(
+            recipient, "123456", "http://localhost/verify/123456"
+        )
+
+    for label, send in (("unpooled", send_unpooled), ("pooled", send_pooled)):
+        elapsed = await bench(send, n_messages, concurrency)
+        print(f"{label:>10}: {n_messages / elapsed:.1f} messages/s")
+    print(f"pool: {vr.get_smtp_pool().stats()}")
+    await vr.close_smtp_pool()
+
+
+def main():
+    import aiosmtpd.controller
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--port", type=int, default=8025)
+    args = parser.parse_args()
+    sink = Sink()
+    controller = aiosmtpd.controller.Controller(sink, hostname="127.0.0.1", port=args.port)
+    controller.start()
+    try:
+        configure(args.port)
+        asyncio.run(run(args.messages, args.concurrency))
+    finally:
+        controller.stop()
+    print(f"sink received {sink.received} messages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Measure application cold start and check it against a budget.
+
+Imports vmail.app in fresh interpreters with python -X importtime and reports
+the median import time of the application and of its largest dependencies,
+plus the wall time of the interpreter run. Exits with status 1 if the import
+time exceeds the budget in startup_budget.json, or if a module listed there
+as deferred was imported at startup.
+
+Import times depend on the machine; record a budget for the machine that
+runs the check with --update.
+
+    python benchmarks/bench_startup.py --runs 7
+    python benchmarks/bench_startup.py --update
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_budget.json")
+# Headroom over the measured import time when recording a budget
+HEADROOM = 1.25
+
+
+def import_times(module: str) -> dict:
+    """
+    Run one fresh interpreter importing module and return the cumulative
+    import time in seconds and nesting depth of each module imported, plus
+    the wall time.
+    """
+    t0 = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    wall = time.perf_counter() - t0
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times[name.strip()] = (int(cumulative) / 1e6, depth)
+    times["<wall>"] = (wall, 0)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--module", default="vmail.app")
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--top", type=int, default=10, help="Largest dependencies to list")
+    parser.add_argument("--update", action="store_true", help="Record the measured time as the budget")
+    args = parser.parse_args()
+    runs = [import_times(args.module) for _ in range(args.runs)]
+    total = statistics.median(run[args.module][0] for run in runs)
+    wall = statistics.median(run["<wall>"][0] for run in runs)
+    print(f"{args.module}: {total * 1000:.0f} ms import, {wall * 1000:.0f} ms interpreter wall time")
+    # Top level imports (of module, or made at interpreter start), largest first
+    dependencies = sorted(
+        (
+            (statistics.median(run.get(name, (0, 0))[0] for run in runs), name)
+            for name, (_, depth) in runs[0].items()
+            if depth == 1
+        ),
+        reverse=True,
+    )
+    for seconds, name in dependencies[: args.top]:
+        print(f"  {seconds * 1000:7.1f} ms  {name}")
+
+    budget = {}
+    if os.path.exists(BUDGET):
+        with open(BUDGET) as f:
+            budget = json.load(f)
+    if args.update:
+        budget["import_ms"] = round(total * 1000 * HEADROOM)
+        budget.setdefault("deferred", [])
+        with open(BUDGET, "w") as f:
+            json.dump(budget, f, indent=2)
+            f.write("\n")
+        print(f"Budget set to {budget['import_ms']} ms")
+        return
+    failures = []
+    if "import_ms" in budget and total * 1000 > budget["import_ms"]:
+        failures.append(f"import time {total * 1000:.0f} ms exceeds budget {budget['import_ms']} ms")
+    for name in budget.get("deferred", []):
+        if any(name in run for run in runs):
+            failures.append(f"{name} is imported at startup")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    if budget:
+        print(f"Within budget of {budget.get('import_ms')} ms")
+
+
+if __name__ == "__main__":
+    main()
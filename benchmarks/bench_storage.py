@@ -0,0 +1,163 @@
+"""
+Compare the storage size and lookup latency of the email table layouts.
+
+Builds a SQLite database of verified rows in the original layout (text keys,
+float times) and in the compact layout of VMAIL_DB_COMPACT_SCHEMA (binary
+keys, integer times). Reports the size of the table and of each index from the dbstat
+table, the time taken to load the rows, and the latency of primary key
+lookups, both as a bare SQL query and through VmailRepo.read without the
+status cache. Rows are inserted in hash order, so B-tree pages have the fill
+of a table built up by registrations.
+
+    python benchmarks/bench_storage.py --rows 1000000
+    python benchmarks/bench_storage.py --rows 10000000 --output storage.json
+
+The two databases need about 2.5 GB of disk per 10 million rows.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import sqlalchemy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import report  # noqa: E402
+
+LAYOUTS = ("original", "compact")
+
+
+async def populate(engine, n_rows: int, batch_size: int = 100000) -> float:
+    import vmail.vmail_router
+    from vmail.vmail_router import db, migrations
+
+    await migrations.initialize(engine)
+    t0 = time.perf_counter()
+    now = time.time()
+    for start in range(0, n_rows, batch_size):
+        rows = [
+            {
+                "address": vmail.vmail_router.hash_something(f"user{i}@example.com"),
+                "tcreated": now,
+                "trequested": now,
+                "tverified": now,
+            }
+            for i in range(start, min(n_rows, start + batch_size))
+        ]
+        async with engine.begin() as connection:
+            await connection.execute(sqlalchemy.insert(db.Email), rows)
+    return time.perf_counter() - t0
+
+
+def sizes(db_path: str) -> dict:
+    connection = sqlite3.connect(db_path)
+    try:
+        objects = dict(
+            connection.execute(
+                "SELECT name, SUM(pgsize) FROM dbstat "
+                "WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name = 'email') "
+                "GROUP BY name"
+            ).fetchall()
+        )
+    finally:
+        connection.close()
+    return objects
+
+
+def sql_lookups(db_path: str, keys: list) -> list:
+    connection = sqlite3.connect(db_path)
+    latencies = []
+    try:
+        for key in keys:
+            t0 = time.perf_counter()
+            connection.execute(
+                "SELECT tverified, trequested, token FROM email WHERE address = ?", (key,)
+            ).fetchone()
+            latencies.append(time.perf_counter() - t0)
+    finally:
+        connection.close()
+    return latencies
+
+
+async def repo_lookups(engine, addresses: list) -> list:
+    import sqlalchemy.ext.asyncio
+    from vmail.vmail_router import repo
+
+    session_factory = sqlalchemy.ext.asyncio.async_sessionmaker(engine, expire_on_commit=False)
+    latencies = []
+    async with session_factory() as session:
+        repository = repo.VmailRepo(session)
+        for address in addresses:
+            t0 = time.perf_counter()
+            record = await repository.read(address)
+            latencies.append(time.perf_counter() - t0)
+            assert record is not None
+    return latencies
+
+
+async def measure(db_path: str, compact: bool, n_rows: int, n_lookups: int) -> dict:
+    import vmail.vmail_router
+    from vmail.vmail_router import db
+
+    engine = db.create_engine(f"sqlite:///{db_path}", compact_schema=compact)
+    load_seconds = await populate(engine, n_rows)
+    objects = sizes(db_path)
+    sample = random.Random(0).sample(range(n_rows), min(n_rows, n_lookups))
+    addresses = [f"user{i}@example.com" for i in sample]
+    keys = [vmail.vmail_router.hash_something(address) for address in addresses]
+    if compact:
+        keys = [db.pack_key(key) for key in keys]
+    # Warm the page cache with one pass, then measure a second
+    sql_lookups(db_path, keys)
+    sql = sorted(sql_lookups(db_path, keys))
+    await repo_lookups(engine, addresses)
+    read = sorted(await repo_lookups(engine, addresses))
+    await engine.dispose()
+    mb = 1024 * 1024
+    results = {
+        "file_mb": os.path.getsize(db_path) / mb,
+        "table_mb": objects.pop("email", 0) / mb,
+        "load_seconds": load_seconds,
+        "sql_p50_us": report.percentile(sql, 0.5) * 1e6,
+        "sql_p99_us": report.percentile(sql, 0.99) * 1e6,
+        "read_p50_us": report.percentile(read, 0.5) * 1e6,
+        "read_p99_us": report.percentile(read, 0.99) * 1e6,
+    }
+    for name, size in sorted(objects.items()):
+        results[f"{name}_mb"] = size / mb
+    results["bytes_per_row"] = os.path.getsize(db_path) / n_rows
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--dir", default=None, help="Directory for the databases, default a temporary one")
+    parser.add_argument("--output", default=None, help="Write results as JSON to this file")
+    args = parser.parse_args()
+    results = {}
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for layout in LAYOUTS:
+            db_path = os.path.join(tmp, f"{layout}.db")
+            results[layout] = asyncio.run(
+                measure(db_path, layout == "compact", args.rows, args.lookups)
+            )
+            os.remove(db_path)
+    metrics = list(results[LAYOUTS[0]])
+    print(f"{'':>32} {'original':>12} {'compact':>12} {'ratio':>7}")
+    for metric in metrics:
+        old = results["original"].get(metric, 0.0)
+        new = results["compact"].get(metric, 0.0)
+        print(f"{metric:>32} {old:12.2f} {new:12.2f} {new / old if old else 0:7.2f}")
+    parameters = {key: value for key, value in vars(args).items() if key not in ("output", "dir")}
+    report.save(args.output, "storage", parameters, results)
+
+
+if __name__ == "__main__":
+    main()
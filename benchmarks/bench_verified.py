@@ -0,0 +1,91 @@
+"""
+Measure concurrent /verified throughput.
+
+Runs the application in-process against a temporary SQLite database populated
+with a number of verified addresses, then issues GET /verified requests with
+the requested concurrency.
+
+    python benchmarks/bench_verified.py --requests 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+API_KEY = "bench"
+
+
+def configure(db_path: str):
+    os.environ["VMAIL_DB_CONNECTION_STRING"] = f"sqlite:///{db_path}"
+    os.environ["VMAIL_API_KEYS"] = f'{{"bench":"{API_KEY}"}}'
+
+
+async def populate(n_rows: int):
+    import sqlalchemy
+    import vmail.vmail_router
+    import vmail.vmail_router.db
+
+    engine = sqlalchemy.create_engine(os.environ["VMAIL_DB_CONNECTION_STRING"])
+    vmail.vmail_router.db.SQL_BASE.metadata.create_all(engine)
+    now = time.time()
+    rows = [
+        {
+            "address": vmail.vmail_router.hash_something(f"user{i}@example.com"),
+            "tcreated": now,
+            "trequested": now,
+            "tverified": now,
+        }
+        for i in range(n_rows)
+    ]
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.insert(vmail.vmail_router.db.Email), rows)
+    engine.dispose()
+
+
+async def run(n_requests: int, concurrency: int, n_rows: int) -> float:
+    import httpx
+    import vmail.app
+
+    transport = httpx.ASGITransport(app=vmail.app.app)
+    queue = asyncio.Queue()
+    for i in range(n_requests):
+        queue.put_nowait(f"user{i % n_rows}@example.com")
+
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", headers={"X-API-Key": API_KEY}
+    ) as client:
+
+        async def worker():
+            while not queue.empty():
+                email = queue.get_nowait()
+                response = await client.get("/verified", params={"email": email})
+                response.raise_for_status()
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - t0
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--rows", type=int, default=10000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        configure(os.path.join(tmp, "bench.db"))
+        asyncio.run(populate(args.rows))
+        elapsed = asyncio.run(run(args.requests, args.concurrency, args.rows))
+    print(
+        f"{args.requests} requests, concurrency {args.concurrency}: "
+        f"{elapsed:.2f}s, {args.requests / elapsed:.1f} req/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Compare two benchmark result files written with --output.
+
+Prints each metric of the baseline and the candidate with their ratio, and
+marks changes for the worse beyond the threshold. Exits with status 1 if
+there are any, so it can gate a CI job.
+
+    python benchmarks/compare.py baseline.json candidate.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+
+# Metrics where a larger value is an improvement; for all others smaller is better
+HIGHER_IS_BETTER = {"throughput"}
+# Counts that describe the run rather than measure it
+IGNORED = {"requests"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1, help="Relative change reported as a regression"
+    )
+    args = parser.parse_args()
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline["benchmark"] != candidate["benchmark"]:
+        sys.exit(f"Cannot compare {baseline['benchmark']} with {candidate['benchmark']}")
+    if baseline["parameters"] != candidate["parameters"]:
+        print("Warning: the runs used different parameters")
+    print(
+        f"baseline {baseline['environment']['revision']}, "
+        f"candidate {candidate['environment']['revision']}"
+    )
+    regressions = 0
+    for name, metrics in baseline["results"].items():
+        if name not in candidate["results"]:
+            print(f"{name}: missing from candidate")
+            continue
+        for metric, old in metrics.items():
+            new = candidate["results"][name].get(metric)
+            if metric in IGNORED or new is None:
+                continue
+            ratio = new / old if old else float("inf") if new else 1.0
+            change = ratio - 1 if metric in HIGHER_IS_BETTER else 1 - ratio
+            regressed = change < -args.threshold
+            regressions += regressed
+            print(
+                f"{name + ' ' + metric:>32}: {old:12.2f} -> {new:12.2f}  x{ratio:.2f}"
+                + ("  REGRESSION" if regressed else "")
+            )
+    if regressions:
+        print(f"{regressions} regressions beyond {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
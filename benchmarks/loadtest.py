@@ -0,0 +1,310 @@
+"""
+Load test the vmail endpoints.
+
+Starts vmail.app:app against a temporary SQLite database (or the database
+given with --db, which must be empty unless --reset is given, as it is then
+cleared), a local SMTP sink and a stub DNS resolver, then drives
+/valid, /verified, /register and /verify/{token} in turn at the requested
+concurrency. Reports throughput, p50/p95/p99 latency and database statements
+per request for each endpoint, optionally saved as JSON with --output.
+
+The application runs in-process over ASGI by default, or in a uvicorn
+subprocess with --server. Requires aiosmtpd.
+
+    python benchmarks/loadtest.py --requests 2000 --concurrency 20 --output results.json
+"""
+import argparse
+import asyncio
+import email
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import report  # noqa: E402
+
+API_KEY = "bench"
+ENDPOINTS = ("valid", "verified", "register", "verify")
+
+
+class StubResolver:
+    """
+    DNS resolver answering every domain with one MX record after latency seconds.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    async def resolve(self, qname: str, rdtype: str):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [types.SimpleNamespace(exchange=f"mx.{qname}.")]
+
+
+class Sink:
+    """
+    SMTP handler keeping the OTP sent to each recipient.
+    """
+
+    def __init__(self):
+        self.otps = {}
+
+    async def handle_DATA(self, server, session, envelope):
+        message = email.message_from_bytes(envelope.content)
+        part = message.get_payload()[0] if message.is_multipart() else message
+        match = re.search(rb"<code>(\d+)", part.get_payload(decode=True))
+        if match:
+            for recipient in envelope.rcpt_tos:
+                self.otps[recipient] = match.group(1).decode()
+        return "250 OK"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def configure(db_url: str, smtp_port: int):
+    os.environ.update(
+        VMAIL_DB_CONNECTION_STRING=db_url,
+        VMAIL_API_KEYS=f'{{"bench":"{API_KEY}"}}',
+        VMAIL_SMTP_HOST="127.0.0.1",
+        VMAIL_SMTP_PORT=str(smtp_port),
+        VMAIL_SMTP_SSL="false",
+        VMAIL_SMTP_STARTTLS="false",
+        VMAIL_SMTP_CREDENTIALS="false",
+        VMAIL_METRICS_ENABLED="true",
+    )
+
+
+def install_stub_resolver(latency: float):
+    from vmail.vmail_router import deliverability
+
+    deliverability.RESOLVER = deliverability.DomainResolver(resolver=StubResolver(latency))
+
+
+async def initialize(n_verified: int, reset: bool = False):
+    import sqlalchemy
+    import vmail.config
+    import vmail.vmail_router
+    from vmail.vmail_router import db, migrations
+
+    settings = vmail.config.get_settings()
+    engine = db.create_engine(
+        settings.db_connection_string, compact_schema=settings.db_compact_schema
+    )
+    await migrations.initialize(engine)
+    used = []
+    async with engine.connect() as connection:
+        for table in (db.Email.__table__, db.Outbox.__table__):
+            if await connection.scalar(sqlalchemy.select(1).select_from(table).limit(1)):
+                used.append(table.name)
+    if used and not reset:
+        await engine.dispose()
+        raise SystemExit(
+            f"The database already holds rows in {', '.join(used)}; "
+            "use --reset to delete them, or omit --db to use a temporary database."
+        )
+    now = time.time()
+    rows = [
+        {
+            "address": vmail.vmail_router.hash_something(f"verified{i}@example.com"),
+            "tcreated": now,
+            "trequested": now,
+            "tverified": now,
+        }
+        for i in range(n_verified)
+    ]
+    async with engine.begin() as connection:
+        await connection.execute(sqlalchemy.delete(db.Email))
+        await connection.execute(sqlalchemy.delete(db.Outbox))
+        if rows:
+            await connection.execute(sqlalchemy.insert(db.Email), rows)
+    await engine.dispose()
+
+
+async def statements(client) -> float:
+    response = await client.get("/metrics")
+    match = re.search(r"^vmail_db_query_seconds_count (\S+)$", response.text, re.MULTILINE)
+    return float(match.group(1)) if match else 0.0
+
+
+async def drive(client, requests, concurrency: int) -> dict:
+    """
+    Issue requests, a list of (method, url, kwargs), with concurrency workers.
+    """
+    queue = asyncio.Queue()
+    for request in requests:
+        queue.put_nowait(request)
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            method, url, kwargs = queue.get_nowait()
+            t0 = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - t0)
+            if response.status_code >= 400:
+                errors += 1
+
+    n_statements = await statements(client)
+    t0 = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - t0
+    n_statements = await statements(client) - n_statements
+    result = report.summarize(latencies, elapsed)
+    result["errors"] = errors
+    result["statements_per_request"] = n_statements / len(latencies) if latencies else 0.0
+    return result
+
+
+def build_requests(endpoint: str, n_requests: int, n_verified: int, sink: Sink):
+    import vmail.vmail_router
+
+    if endpoint == "valid":
+        return [
+            ("GET", "/valid", {"params": {"email": f"user{i}@domain{i % 100}.example"}})
+            for i in range(n_requests)
+        ]
+    if endpoint == "verified":
+        return [
+            ("GET", "/verified", {"params": {"email": f"verified{i % n_verified}@example.com"}})
+            for i in range(n_requests)
+        ]
+    if endpoint == "register":
+        return [
+            ("POST", "/register", {"data": {"email": f"register{i}@example.com"}})
+            for i in range(n_requests)
+        ]
+    if endpoint == "verify":
+        return [
+            (
+                "GET",
+                f"/verify/{otp}",
+                {"params": {"key": vmail.vmail_router.hash_something(recipient)}},
+            )
+            for recipient, otp in list(sink.otps.items())[:n_requests]
+        ]
+    raise ValueError(endpoint)
+
+
+async def run_load(base_url: str, transport, args, sink: Sink) -> dict:
+    import httpx
+
+    results = {}
+    async with httpx.AsyncClient(
+        transport=transport, base_url=base_url, headers={"X-API-Key": API_KEY}, timeout=60
+    ) as client:
+        for endpoint in args.endpoints:
+            if endpoint == "verify" and not sink.otps:
+                print("verify: skipped, run register first")
+                continue
+            requests = build_requests(endpoint, args.requests, args.verified, sink)
+            result = await drive(client, requests, args.concurrency)
+            results[endpoint] = result
+            print(
+                f"{endpoint:>9}: {result['throughput']:8.1f} req/s  "
+                f"p50 {result['p50_ms']:7.2f} ms  p95 {result['p95_ms']:7.2f} ms  "
+                f"p99 {result['p99_ms']:7.2f} ms  "
+                f"{result['statements_per_request']:.2f} statements/req  "
+                f"{result['errors']} errors"
+            )
+    return results
+
+
+async def run_asgi(args, sink: Sink) -> dict:
+    import httpx
+
+    install_stub_resolver(args.dns_latency)
+    import vmail.app
+
+    app = vmail.app.app
+    async with app.router.lifespan_context(app):
+        return await run_load("http://bench", httpx.ASGITransport(app=app), args, sink)
+
+
+async def run_server(args, sink: Sink) -> dict:
+    port = free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--serve",
+            str(port),
+            "--dns-latency",
+            str(args.dns_latency),
+        ],
+        env=os.environ.copy(),
+    )
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+        return await run_load(f"http://127.0.0.1:{port}", None, args, sink)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def serve(port: int, dns_latency: float):
+    import uvicorn
+
+    install_stub_resolver(dns_latency)
+    import vmail.app
+
+    uvicorn.run(vmail.app.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=1000, help="Requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--verified", type=int, default=10000, help="Verified addresses in the database")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument("--db", default=None, help="Database URL, default a temporary SQLite file")
+    parser.add_argument(
+        "--reset", action="store_true", help="Delete the email and outbox rows of a non-empty --db"
+    )
+    parser.add_argument("--dns-latency", type=float, default=0.02, help="Seconds per stub DNS lookup")
+    parser.add_argument("--server", action="store_true", help="Run the application under uvicorn")
+    parser.add_argument("--serve", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--output", default=None, help="Write results as JSON to this file")
+    args = parser.parse_args()
+    if args.serve is not None:
+        return serve(args.serve, args.dns_latency)
+
+    import aiosmtpd.controller
+
+    sink = Sink()
+    smtp_port = free_port()
+    controller = aiosmtpd.controller.Controller(sink, hostname="127.0.0.1", port=smtp_port)
+    controller.start()
+    with tempfile.TemporaryDirectory() as tmp:
+        configure(args.db or f"sqlite:///{os.path.join(tmp, 'loadtest.db')}", smtp_port)
+        try:
+            asyncio.run(initialize(args.verified, args.reset))
+            run = run_server if args.server else run_asgi
+            results = asyncio.run(run(args, sink))
+        finally:
+            controller.stop()
+    parameters = {
+        key: value for key, value in vars(args).items() if key not in ("serve", "output", "reset")
+    }
+    parameters["db"] = "sqlite" if args.db is None else args.db.split(":", 1)[0]
+    report.save(args.output, "loadtest", parameters, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Micro-benchmarks of the hashing, OTP and repository hot paths.
+
+Times hash_something, create_otp and the VmailRepo methods used by the
+endpoints (read with and without the status cache, read_many, register and
+verify) against a temporary SQLite database with a number of verified rows.
+Each result is the best of several rounds, in microseconds per operation.
+
+    python benchmarks/micro.py --rows 10000 --operations 2000 --output micro.json
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import timeit
+
+import sqlalchemy
+import sqlalchemy.ext.asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import report  # noqa: E402
+import vmail.vmail_router  # noqa: E402
+from vmail.vmail_router import cache, db, migrations, repo  # noqa: E402
+
+
+async def populate(engine, n_rows: int):
+    await migrations.initialize(engine)
+    now = time.time()
+    rows = [
+        {
+            "address": vmail.vmail_router.hash_something(f"user{i}@example.com"),
+            "tcreated": now,
+            "trequested": now,
+            "tverified": now,
+        }
+        for i in range(n_rows)
+    ]
+    async with engine.begin() as connection:
+        await connection.execute(sqlalchemy.insert(db.Email), rows)
+
+
+async def measure_repo(db_path: str, n_rows: int, n_operations: int, rounds: int) -> dict:
+    engine = db.create_engine(f"sqlite:///{db_path}")
+    await populate(engine, n_rows)
+    session_factory = sqlalchemy.ext.asyncio.async_sessionmaker(engine, expire_on_commit=False)
+    status_cache = cache.StatusCache(cache.LocalBackend(max_entries=n_rows))
+    addresses = [f"user{i}@example.com" for i in range(min(n_rows, n_operations))]
+    results = {}
+
+    async def best(name, operation, count):
+        timings = []
+        for i in range(rounds):
+            async with session_factory() as session:
+                t0 = time.perf_counter()
+                await operation(session, i)
+                timings.append((time.perf_counter() - t0) / count)
+        results[name] = min(timings) * 1e6
+
+    async def read(session, _):
+        repository = repo.VmailRepo(session)
+        for address in addresses:
+            await repository.read(address)
+
+    async def read_cached(session, _):
+        repository = repo.VmailRepo(session, status_cache)
+        for address in addresses:
+            await repository.read(address)
+
+    async def read_many(session, _):
+        await repo.VmailRepo(session).read_many(addresses)
+
+    tokens = {}
+
+    async def register(session, i):
+        repository = repo.VmailRepo(session)
+        for j in range(n_operations):
+            address = f"new{i}-{j}@example.com"
+            tokens[address] = vmail.vmail_router.create_otp()
+            await repository.register(address, tokens[address])
+
+    async def verify(session, i):
+        repository = repo.VmailRepo(session)
+        for j in range(n_operations):
+            address = f"new{i}-{j}@example.com"
+            await repository.verify(
+                tokens[address], key=vmail.vmail_router.hash_something(address)
+            )
+
+    await best("repo.read", read, len(addresses))
+    await best("repo.read (cached)", read_cached, len(addresses))
+    await best("repo.read_many", read_many, len(addresses))
+    await best("repo.register", register, n_operations)
+    await best("repo.verify", verify, n_operations)
+    await engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10000, help="Verified rows in the database")
+    parser.add_argument("--operations", type=int, default=2000, help="Operations per round")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--output", default=None, help="Write results as JSON to this file")
+    args = parser.parse_args()
+    n = 100000
+    results = {
+        "hash_something": min(
+            timeit.repeat(
+                lambda: vmail.vmail_router.hash_something("user@example.com"),
+                number=n,
+                repeat=args.rounds,
+            )
+        )
+        / n
+        * 1e6,
+        "create_otp": min(
+            timeit.repeat(vmail.vmail_router.create_otp, number=n, repeat=args.rounds)
+        )
+        / n
+        * 1e6,
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        results.update(
+            asyncio.run(
+                measure_repo(
+                    os.path.join(tmp, "micro.db"), args.rows, args.operations, args.rounds
+                )
+            )
+        )
+    for name, microseconds in results.items():
+        print(f"{name:>20}: {microseconds:9.2f} us")
+    parameters = {key: value for key, value in vars(args).items() if key != "output"}
+    report.save(args.output, "micro", parameters, {k: {"us": v} for k, v in results.items()})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Helpers shared by the benchmark scripts for summarizing and saving results.
+
+Results are saved as JSON with the environment they were measured in, so runs
+of different versions can be compared with compare.py.
+"""
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import typing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(sorted_values: typing.Sequence[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: typing.Sequence[float], elapsed: float) -> dict:
+    """
+    Throughput and latency percentiles (in milliseconds) of a run.
+    """
+    values = sorted(latencies)
+    return {
+        "requests": len(values),
+        "throughput": len(values) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(values, 0.50) * 1000,
+        "p95_ms": percentile(values, 0.95) * 1000,
+        "p99_ms": percentile(values, 0.99) * 1000,
+        "max_ms": (values[-1] if values else 0.0) * 1000,
+    }
+
+
+def environment() -> dict:
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "revision": revision,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def save(path: typing.Optional[str], benchmark: str, parameters: dict, results: dict):
+    """
+    Write results to path as JSON, if a path is given.
+    """
+    if not path:
+        return
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "benchmark": benchmark,
+                "environment": environment(),
+                "parameters": parameters,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+        f.write("\n")
+    print(f"Results written to {path}")
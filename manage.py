@@ -1,51 +1,447 @@
 import argparse
+import asyncio
+import csv
+import itertools
+import json
 import logging
+import time
 
-import sqlalchemy
-import sqlalchemy.orm
+import email_validator
+import sqlalchemy.ext.asyncio
 import vmail.config
+import vmail.vmail_router
 import vmail.vmail_router.db
+import vmail.vmail_router.migrations
+import vmail.vmail_router.outbox
+import vmail.vmail_router.reaper
 import vmail.vmail_router.repo
+import vmail.vmail_router.shards
 
-def initialize_database(settings):
+
+def connection_strings(settings):
+    """
+    Connection strings of the databases holding the data: every shard when
+    db_shard_connection_strings is set, otherwise db_connection_string.
+    """
+    return settings.db_shard_connection_strings or [settings.db_connection_string]
+
+
+def create_engine(settings, connection_string, **kwargs):
+    """
+    Engine for connection_string, in the email table layout of settings.
+    """
+    return vmail.vmail_router.db.create_engine(
+        connection_string, compact_schema=settings.db_compact_schema, **kwargs
+    )
+
+
+def create_engines(settings, **kwargs):
+    return [
+        create_engine(settings, connection_string, **kwargs)
+        for connection_string in connection_strings(settings)
+    ]
+
+
+def create_repository(settings, engines):
+    """
+    Repository over engines, as created by create_engines, with the address
+    keys of settings.
+    """
+    key_hasher = vmail.vmail_router.KeyHasher.from_settings(settings)
+    if settings.db_shard_connection_strings:
+        return vmail.vmail_router.repo.ShardedVmailRepo(
+            vmail.vmail_router.shards.ShardSet(engines), key_hasher=key_hasher
+        )
+    session = sqlalchemy.ext.asyncio.AsyncSession(bind=engines[0], expire_on_commit=False)
+    return vmail.vmail_router.repo.VmailRepo(session, key_hasher=key_hasher)
+
+
+def create_session_factories(engines):
+    return [
+        sqlalchemy.ext.asyncio.async_sessionmaker(bind=engine, expire_on_commit=False)
+        for engine in engines
+    ]
+
+
+async def dispose(engines):
+    for engine in engines:
+        await engine.dispose()
+
+
+async def initialize_database(settings):
     L = logging.getLogger(__name__)
-    L.info("Initializing database at %s", settings.db_connection_string)
-    engine = sqlalchemy.create_engine(
-        settings.db_connection_string, pool_pre_ping=True
+    for connection_string in connection_strings(settings):
+        L.info("Initializing database at %s", connection_string)
+        engine = create_engine(settings, connection_string, pool_pre_ping=True)
+        try:
+            version = await vmail.vmail_router.migrations.initialize(engine)
+            L.info("Schema version %s", version)
+            if version < vmail.vmail_router.migrations.HEAD:
+                L.warning("Database schema is out of date, run: manage.py migrate")
+            if await vmail.vmail_router.migrations.is_compact(engine) != settings.db_compact_schema:
+                L.warning("Email table layout differs from the settings, run: manage.py convert")
+        finally:
+            await engine.dispose()
+    L.info("Done")
+
+
+async def clear_database(settings):
+    L = logging.getLogger(__name__)
+    L.info("Clearing database at %s", ", ".join(connection_strings(settings)))
+    engines = create_engines(settings, pool_pre_ping=True)
+    repository = create_repository(settings, engines)
+    try:
+        n_deleted = await repository.clear()
+        L.info("Deleted %s records", n_deleted)
+    finally:
+        await repository.close()
+        await dispose(engines)
+    L.info("Done")
+
+
+async def migrate_database(settings, target=None):
+    L = logging.getLogger(__name__)
+    for connection_string in connection_strings(settings):
+        L.info("Migrating database at %s", connection_string)
+        engine = create_engine(settings, connection_string)
+        try:
+            version = await vmail.vmail_router.migrations.current_version(engine)
+            L.info("Current schema version %s", version)
+            applied = await vmail.vmail_router.migrations.upgrade(engine, target=target)
+            version = await vmail.vmail_router.migrations.current_version(engine)
+            L.info("Applied %s migrations, schema version %s", len(applied), version)
+        finally:
+            await engine.dispose()
+    L.info("Done")
+
+
+async def convert_database(settings, batch_size=10000):
+    L = logging.getLogger(__name__)
+    layout = "compact" if settings.db_compact_schema else "original"
+    for connection_string in connection_strings(settings):
+        L.info("Converting the email table at %s to the %s layout", connection_string, layout)
+        engine = create_engine(settings, connection_string)
+        try:
+            t0 = time.perf_counter()
+            n_converted = await vmail.vmail_router.migrations.convert(
+                engine, settings.db_compact_schema, batch_size=batch_size
+            )
+            if n_converted is None:
+                L.info("Already in the %s layout", layout)
+            else:
+                L.info("Converted %s records in %.3fs", n_converted, time.perf_counter() - t0)
+        finally:
+            await engine.dispose()
+    L.info("Done")
+
+
+async def send_outbox(settings, once=False):
+    L = logging.getLogger(__name__)
+    L.info("Sending queued messages from %s", ", ".join(connection_strings(settings)))
+    engines = create_engines(settings)
+    sender = vmail.vmail_router.outbox.OutboxSender(
+        create_session_factories(engines),
+        concurrency=settings.outbox_concurrency,
+        poll_seconds=settings.outbox_poll_seconds,
+        max_attempts=settings.outbox_max_attempts,
+        backoff_seconds=settings.outbox_backoff_seconds,
+        backoff_max_seconds=settings.outbox_backoff_max_seconds,
+        lease_seconds=settings.outbox_lease_seconds,
+        key_hasher=vmail.vmail_router.KeyHasher.from_settings(settings),
     )
-    vmail.vmail_router.db.SQL_BASE.metadata.create_all(engine)
+    try:
+        if once:
+            n_processed = await sender.run_once()
+            L.info("Processed %s messages", n_processed)
+        else:
+            await sender.run()
+    finally:
+        L.info("Outbox %s", sender.stats())
+        await vmail.vmail_router.close_smtp_pool()
+        await dispose(engines)
     L.info("Done")
 
 
-def clear_database(settings):
+async def rehash_database(settings, input_file):
     L = logging.getLogger(__name__)
-    L.info("Clearing database at %s", settings.db_connection_string)
-    engine = sqlalchemy.create_engine(
-        settings.db_connection_string, pool_pre_ping=True
+    L.info("Rehashing addresses at %s to scheme %s", ", ".join(connection_strings(settings)), settings.hash_scheme)
+    engines = create_engines(settings)
+    repository = create_repository(settings, engines)
+    n_read = n_moved = 0
+    try:
+        batch = []
+        for line in itertools.chain(input_file, [None]):
+            if line is not None and line.strip():
+                batch.append(line.strip())
+            if batch and (line is None or len(batch) >= settings.batch_chunk_size):
+                n_moved += await repository.rehash(batch)
+                n_read += len(batch)
+                batch = []
+                L.info("Read %s addresses, moved %s records", n_read, n_moved)
+        counts = await repository.count_by_scheme()
+        for scheme, count in sorted(counts.items()):
+            if scheme != settings.hash_scheme and count:
+                L.warning("%s records remain under scheme %s", count, scheme)
+    finally:
+        await repository.close()
+        await dispose(engines)
+    L.info("Done")
+
+
+def read_verified(input_file, key_hasher, input_format="text", hashed=False):
+    """
+    Yield (key, tverified) for each record of input_file, with the keys of
+    key_hasher, or None for records that are not valid addresses.
+
+    text input has one address per line, or one key with hashed. ndjson and
+    csv records, as written by export, have a "key" field or an "email"
+    field with the plain text address, and an optional "tverified" time.
+    """
+    now = time.time()
+
+    def key_of(email_address):
+        try:
+            emailinfo = email_validator.validate_email(email_address, check_deliverability=False)
+        except email_validator.EmailNotValidError:
+            return None
+        return key_hasher.hash(emailinfo.normalized)
+
+    if input_format == "text":
+        for line in input_file:
+            value = line.strip()
+            if value:
+                yield (value, now) if hashed else (key_of(value), now)
+        return
+    if input_format == "csv":
+        records = csv.DictReader(input_file)
+    else:
+        records = (json.loads(line) for line in input_file if line.strip())
+    for record in records:
+        key = record.get("key") or key_of(record.get("email") or "")
+        tverified = record.get("tverified")
+        yield (key, float(tverified) if tverified not in (None, "") else now)
+
+
+async def import_database(settings, input_file, input_format="text", hashed=False, batch_size=10000):
+    L = logging.getLogger(__name__)
+    L.info("Importing verified addresses to %s", ", ".join(connection_strings(settings)))
+    engines = create_engines(settings)
+    repository = create_repository(settings, engines)
+    n_read = n_skipped = n_written = 0
+    t0 = time.perf_counter()
+    try:
+        batch = []
+        key_hasher = vmail.vmail_router.KeyHasher.from_settings(settings)
+        rows = read_verified(input_file, key_hasher, input_format, hashed)
+        for row in itertools.chain(rows, [None]):
+            if row is not None:
+                n_read += 1
+                if row[0] is None:
+                    n_skipped += 1
+                else:
+                    batch.append(row)
+            if batch and (row is None or len(batch) >= batch_size):
+                n_written += await repository.import_verified(batch)
+                batch = []
+                elapsed = time.perf_counter() - t0
+                L.info(
+                    "Read %s records, wrote %s, skipped %s, %.0f records/s",
+                    n_read,
+                    n_written,
+                    n_skipped,
+                    n_read / elapsed if elapsed else 0,
+                )
+    finally:
+        await repository.close()
+        await dispose(engines)
+    if n_skipped:
+        L.warning("Skipped %s records that are not valid addresses", n_skipped)
+    L.info("Done")
+
+
+async def export_database(settings, output_file, output_format="ndjson", batch_size=10000):
+    L = logging.getLogger(__name__)
+    L.info("Exporting verified addresses from %s", ", ".join(connection_strings(settings)))
+    engines = create_engines(settings)
+    repository = create_repository(settings, engines)
+    n_written = 0
+    t0 = time.perf_counter()
+    try:
+        if output_format == "csv":
+            writer = csv.writer(output_file)
+            writer.writerow(["key", "tverified"])
+        after = None
+        while True:
+            rows = await repository.export_verified(batch_size, after=after)
+            # End the read transaction so long exports do not hold a snapshot
+            await repository.rollback()
+            if not rows:
+                break
+            if output_format == "csv":
+                writer.writerows(rows)
+            else:
+                output_file.writelines(
+                    json.dumps({"key": key, "tverified": tverified}) + "\n" for key, tverified in rows
+                )
+            n_written += len(rows)
+            after = rows[-1][0]
+            elapsed = time.perf_counter() - t0
+            L.info("Exported %s records, %.0f records/s", n_written, n_written / elapsed if elapsed else 0)
+        output_file.flush()
+    finally:
+        await repository.close()
+        await dispose(engines)
+    L.info("Done")
+
+
+async def reap_database(settings, vacuum=False):
+    L = logging.getLogger(__name__)
+    L.info("Reaping stale records at %s", ", ".join(connection_strings(settings)))
+    engines = create_engines(settings)
+    reaper = vmail.vmail_router.reaper.Reaper(
+        create_session_factories(engines),
+        token_timeout_seconds=settings.verify_timeout_seconds,
+        retention_seconds=settings.reap_retention_seconds,
+        batch_size=settings.reap_batch_size,
     )
-    session = sqlalchemy.orm.sessionmaker(bind=engine)()
-    repository = vmail.vmail_router.repo.VmailRepo(session)
     try:
-        n_deleted = repository.clear()
-        L.info("Deleted %s records", n_deleted)
+        result = await reaper.run_once()
+        L.info(
+            "Removed %s expired tokens, purged %s records in %s batches, %.3fs",
+            result.expired_tokens,
+            result.purged,
+            result.batches,
+            result.elapsed,
+        )
+        if vacuum:
+            t0 = time.perf_counter()
+            for engine in engines:
+                async with engine.connect() as connection:
+                    connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+                    if connection.dialect.name == "sqlite":
+                        await connection.exec_driver_sql("VACUUM")
+                    else:
+                        await connection.exec_driver_sql("VACUUM ANALYZE email")
+            L.info("Vacuumed in %.3fs", time.perf_counter() - t0)
+    finally:
+        await dispose(engines)
+    L.info("Done")
+
+
+async def rebalance_database(settings, drain=(), batch_size=10000):
+    """
+    Move every record to the shard its key maps to with the configured
+    db_shard_connection_strings. All records of the drain databases, shards
+    being removed, are moved. Each batch is inserted on its shard, keeping
+    records already stored there, before it is deleted from its source, so
+    the command can be interrupted and run again.
+    """
+    L = logging.getLogger(__name__)
+    shard_set = vmail.vmail_router.shards.ShardSet(create_engines(settings))
+    targets = vmail.vmail_router.repo.ShardedVmailRepo(shard_set)
+    sources = connection_strings(settings) + list(drain)
+    n_moved = 0
+    t0 = time.perf_counter()
+    try:
+        for i, connection_string in enumerate(sources):
+            L.info("Rebalancing records at %s", connection_string)
+            if i < len(shard_set):
+                engine = shard_set.engines[i]
+            else:
+                engine = create_engine(settings, connection_string)
+            session = sqlalchemy.ext.asyncio.AsyncSession(bind=engine, expire_on_commit=False)
+            repository = vmail.vmail_router.repo.VmailRepo(session)
+            n_read = 0
+            try:
+                after = None
+                while True:
+                    rows = await repository.export_rows(batch_size, after=after)
+                    await repository.rollback()
+                    if not rows:
+                        break
+                    after = rows[-1]["address"]
+                    n_read += len(rows)
+                    moves = {}
+                    for row in rows:
+                        shard = shard_set.shard_of_key(row["address"])
+                        if shard != i:
+                            moves.setdefault(shard, []).append(row)
+                    for shard, group in moves.items():
+                        await targets.shard(shard).import_rows(group)
+                        await repository.delete_keys([row["address"] for row in group])
+                        n_moved += len(group)
+                    elapsed = time.perf_counter() - t0
+                    L.info(
+                        "Read %s records, moved %s in total, %.0f records/s",
+                        n_read,
+                        n_moved,
+                        n_read / elapsed if elapsed else 0,
+                    )
+            finally:
+                await repository.close()
+                if i >= len(shard_set):
+                    await engine.dispose()
     finally:
-        session.close()
+        await targets.close()
+        await shard_set.dispose()
     L.info("Done")
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('command', help="Command to run", nargs="?", choices=["initialize", "clear" ])
+    parser.add_argument('command', help="Command to run", nargs="?", choices=["initialize", "clear", "migrate", "send", "rehash", "reap", "import", "export", "rebalance", "convert"])
     parser.add_argument('-c', '--config', default=None, help="Enviroment file for settings", required=False)
+    parser.add_argument('-t', '--target', default=None, type=int, help="Schema version to migrate to, default latest", required=False)
+    parser.add_argument('--once', action="store_true", help="send: process due messages and exit")
+    parser.add_argument('--vacuum', action="store_true", help="reap: compact the database afterwards")
+    parser.add_argument('-i', '--input', default="-", type=argparse.FileType("r"), help="rehash, import: input file, default stdin")
+    parser.add_argument('-o', '--output', default="-", type=argparse.FileType("w"), help="export: output file, default stdout")
+    parser.add_argument('-f', '--format', default=None, choices=["text", "ndjson", "csv"], help="import: input format, default text; export: output format, default ndjson")
+    parser.add_argument('--hashed', action="store_true", help="import: text input holds address keys rather than addresses")
+    parser.add_argument('--batch-size', default=10000, type=int, help="import, export, rebalance, convert: records per batch")
+    parser.add_argument('--drain', default=[], action="append", help="rebalance: connection string of a shard being removed, may be repeated")
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
     settings = vmail.config.get_settings(env_file=args.config)
 
     if args.command == "initialize":
-        return initialize_database(settings)
+        return asyncio.run(initialize_database(settings))
 
     if args.command == "clear":
-        return clear_database(settings)
+        return asyncio.run(clear_database(settings))
+
+    if args.command == "migrate":
+        return asyncio.run(migrate_database(settings, target=args.target))
+
+    if args.command == "convert":
+        return asyncio.run(convert_database(settings, batch_size=args.batch_size))
+
+    if args.command == "rehash":
+        return asyncio.run(rehash_database(settings, args.input))
+
+    if args.command == "import":
+        return asyncio.run(
+            import_database(settings, args.input, args.format or "text", args.hashed, args.batch_size)
+        )
+
+    if args.command == "export":
+        if args.format == "text":
+            parser.error("export writes ndjson or csv")
+        return asyncio.run(export_database(settings, args.output, args.format or "ndjson", args.batch_size))
+
+    if args.command == "rebalance":
+        if not settings.db_shard_connection_strings:
+            parser.error("rebalance requires VMAIL_DB_SHARD_CONNECTION_STRINGS")
+        return asyncio.run(rebalance_database(settings, drain=args.drain, batch_size=args.batch_size))
+
+    if args.command == "reap":
+        return asyncio.run(reap_database(settings, vacuum=args.vacuum))
+
+    if args.command == "send":
+        try:
+            return asyncio.run(send_outbox(settings, once=args.once))
+        except KeyboardInterrupt:
+            pass
 
 
 if __name__ == "__main__":
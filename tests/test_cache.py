@@ -0,0 +1,111 @@
+"""
+Status cache in front of VmailRepo.read, with the local backend.
+"""
+import asyncio
+import os
+import tempfile
+
+import sqlalchemy.ext.asyncio
+
+from vmail.vmail_router import cache, db, hash_something, migrations, model, repo
+
+ADDRESS = "someone@example.com"
+OTHER = "other@example.com"
+
+
+def run(test):
+    """
+    Run coroutine function test(session_factory, status_cache) on a new
+    database with ADDRESS registered under token "123456".
+    """
+
+    async def main(path):
+        engine = db.create_engine(f"sqlite:///{path}")
+        await migrations.initialize(engine)
+        session_factory = sqlalchemy.ext.asyncio.async_sessionmaker(engine, expire_on_commit=False)
+        async with session_factory() as session:
+            await repo.VmailRepo(session).register(ADDRESS, "123456")
+        try:
+            await test(session_factory, cache.StatusCache(cache.LocalBackend()))
+        finally:
+            await engine.dispose()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(main(os.path.join(tmp, "vmail.db")))
+
+
+async def read(session_factory, status_cache, email_address: str = ADDRESS):
+    async with session_factory() as session:
+        return await repo.VmailRepo(session, status_cache=status_cache).read(email_address)
+
+
+async def verify(session_factory, status_cache):
+    async with session_factory() as session:
+        return await repo.VmailRepo(session, status_cache=status_cache).verify(
+            "123456", email_address=ADDRESS
+        )
+
+
+class VerifyingRepo(repo.VmailRepo):
+    """
+    Repository that verifies ADDRESS through another session after loading
+    rows and before filling the cache.
+    """
+
+    def __init__(self, session, session_factory, status_cache):
+        super().__init__(session, status_cache=status_cache)
+        self._session_factory = session_factory
+
+    async def _read_instances(self, email_addresses):
+        result = await super()._read_instances(email_addresses)
+        state = await verify(self._session_factory, self._status_cache)
+        assert state == model.VerifiedEnum.verified
+        return result
+
+
+def test_read_fills_cache():
+    async def test(session_factory, status_cache):
+        assert (await read(session_factory, status_cache)).verified == model.VerifiedEnum.unverified
+        assert await read(session_factory, status_cache, OTHER) is None
+        assert await status_cache.get(hash_something(ADDRESS)) == model.VerifiedEnum.unverified
+        assert await status_cache.get(hash_something(OTHER)) == cache.StatusCache.NOT_FOUND
+        assert (await read(session_factory, status_cache)).verified == model.VerifiedEnum.unverified
+        assert status_cache.stats()["hits"] == 3
+
+    run(test)
+
+
+def test_write_invalidates_cache():
+    async def test(session_factory, status_cache):
+        await read(session_factory, status_cache)
+        assert await verify(session_factory, status_cache) == model.VerifiedEnum.verified
+        assert await status_cache.backend.get(hash_something(ADDRESS)) is None
+        assert (await read(session_factory, status_cache)).verified == model.VerifiedEnum.verified
+
+    run(test)
+
+
+def test_read_skips_fill_after_invalidation():
+    async def test(session_factory, status_cache):
+        async with session_factory() as session:
+            repository = VerifyingRepo(session, session_factory, status_cache)
+            assert (await repository.read(ADDRESS)).verified == model.VerifiedEnum.unverified
+        assert await status_cache.backend.get(hash_something(ADDRESS)) is None
+        assert status_cache.stats()["stale_fills"] == 1
+        assert (await read(session_factory, status_cache)).verified == model.VerifiedEnum.verified
+
+    run(test)
+
+
+def test_read_many_skips_fill_after_invalidation():
+    async def test(session_factory, status_cache):
+        async with session_factory() as session:
+            repository = VerifyingRepo(session, session_factory, status_cache)
+            result = await repository.read_many([ADDRESS, OTHER])
+        assert result[ADDRESS].verified == model.VerifiedEnum.unverified
+        assert await status_cache.backend.get(hash_something(ADDRESS)) is None
+        # Keys that were not written are still filled
+        assert await status_cache.backend.get(hash_something(OTHER)) == cache.StatusCache.NOT_FOUND
+        assert (await read(session_factory, status_cache)).verified == model.VerifiedEnum.verified
+
+    run(test)
@@ -0,0 +1,30 @@
+"""
+Engines created by db.create_engine.
+"""
+import asyncio
+import logging
+import os
+import tempfile
+
+import sqlalchemy
+
+from vmail.vmail_router import db
+
+
+def test_pool_logs_under_sqlalchemy_pool(caplog):
+    async def main(path):
+        engine = db.create_engine(f"sqlite:///{path}")
+        try:
+            async with engine.connect() as connection:
+                await connection.execute(sqlalchemy.text("SELECT 1"))
+            assert isinstance(engine.sync_engine.pool, db.InstrumentedPool)
+            assert db.pool_stats(engine)["checkouts"] == 1
+        finally:
+            await engine.dispose()
+
+    caplog.set_level(logging.DEBUG, logger="sqlalchemy.pool")
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(main(os.path.join(tmp, "vmail.db")))
+    names = {record.name for record in caplog.records}
+    assert "sqlalchemy.pool.impl.AsyncAdaptedQueuePool" in names
+    assert not any(name.startswith("vmail") for name in names)
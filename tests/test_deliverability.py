@@ -0,0 +1,110 @@
+"""
+DomainResolver caching and coalescing, with a stub resolver.
+"""
+import asyncio
+import types
+
+import dns.resolver
+
+from vmail.vmail_router import deliverability
+
+
+class StubResolver:
+    """
+    Resolver answering from records, a dict of (domain, rdtype) to a list of
+    records or an exception to raise. Queries are counted and take delay
+    seconds.
+    """
+
+    def __init__(self, records: dict, delay: float = 0):
+        self.records = records
+        self.delay = delay
+        self.queries = []
+
+    async def resolve(self, qname: str, rdtype: str):
+        self.queries.append((qname, rdtype))
+        await asyncio.sleep(self.delay)
+        answer = self.records.get((qname, rdtype), dns.resolver.NoAnswer())
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+def mx(exchange: str):
+    return types.SimpleNamespace(exchange=exchange)
+
+
+def a(address: str):
+    return types.SimpleNamespace(address=address)
+
+
+RECORDS = {
+    ("example.com", "MX"): [mx("mail.example.com.")],
+    ("null.example", "MX"): [mx(".")],
+    ("nomx.example", "A"): [a("93.184.216.34")],
+    ("private.example", "A"): [a("10.0.0.1")],
+    ("missing.example", "MX"): dns.resolver.NXDOMAIN(),
+    ("slow.example", "MX"): dns.resolver.LifetimeTimeout(timeout=1, errors={}),
+}
+
+
+def test_check():
+    async def main():
+        resolver = deliverability.DomainResolver(StubResolver(RECORDS))
+        assert await resolver.check("Example.com") == deliverability.DomainStatus(True)
+        assert await resolver.check("nomx.example") == deliverability.DomainStatus(True)
+        status = await resolver.check("null.example")
+        assert status == deliverability.DomainStatus(
+            False, "The domain name null.example does not accept email."
+        )
+        assert not (await resolver.check("private.example")).deliverable
+        status = await resolver.check("missing.example", "missing.example (i18n)")
+        assert status.message == "The domain name missing.example (i18n) does not exist."
+
+    asyncio.run(main())
+
+
+def test_check_caches_until_ttl():
+    async def main():
+        stub = StubResolver(RECORDS)
+        resolver = deliverability.DomainResolver(stub, ttl=0.5, negative_ttl=0.1)
+        await resolver.check("example.com")
+        await resolver.check("missing.example")
+        await resolver.check("example.com")
+        await resolver.check("missing.example")
+        assert len(stub.queries) == 2
+        assert resolver.stats()["hits"] == 2
+        # Undeliverable domains expire after negative_ttl, others after ttl
+        await asyncio.sleep(0.2)
+        await resolver.check("example.com")
+        await resolver.check("missing.example")
+        assert len(stub.queries) == 3
+        await asyncio.sleep(0.4)
+        await resolver.check("example.com")
+        assert len(stub.queries) == 4
+
+    asyncio.run(main())
+
+
+def test_check_does_not_cache_inconclusive_lookups():
+    async def main():
+        stub = StubResolver(RECORDS)
+        resolver = deliverability.DomainResolver(stub)
+        assert await resolver.check("slow.example") == deliverability.DomainStatus(True, "timeout")
+        await resolver.check("slow.example")
+        assert len(stub.queries) == 2
+        assert resolver.stats()["lookup_errors"] == 2
+
+    asyncio.run(main())
+
+
+def test_concurrent_checks_share_a_lookup():
+    async def main():
+        stub = StubResolver(RECORDS, delay=0.05)
+        resolver = deliverability.DomainResolver(stub)
+        statuses = await asyncio.gather(*[resolver.check("example.com") for _ in range(10)])
+        assert statuses == [deliverability.DomainStatus(True)] * 10
+        assert stub.queries == [("example.com", "MX")]
+        assert resolver.stats()["coalesced"] == 9
+
+    asyncio.run(main())
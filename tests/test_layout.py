@@ -0,0 +1,42 @@
+"""
+Email table layouts, chosen per engine by db.create_engine.
+"""
+import asyncio
+import os
+import sqlite3
+import tempfile
+
+import sqlalchemy.ext.asyncio
+
+from vmail.vmail_router import db, migrations, model, repo
+
+ADDRESS = "someone@example.com"
+
+
+async def register_and_read(path: str, compact: bool):
+    engine = db.create_engine(f"sqlite:///{path}", compact_schema=compact)
+    try:
+        await migrations.initialize(engine)
+        assert await migrations.is_compact(engine) == compact
+        session_factory = sqlalchemy.ext.asyncio.async_sessionmaker(engine, expire_on_commit=False)
+        async with session_factory() as session:
+            repository = repo.VmailRepo(session)
+            await repository.register(ADDRESS, "token1")
+            assert await repository.verify("token1", email_address=ADDRESS) == model.VerifiedEnum.verified
+            assert (await repository.read(ADDRESS)).verified == model.VerifiedEnum.verified
+            assert (await repository.count_by_scheme())[1] == 1
+    finally:
+        await engine.dispose()
+
+
+def test_layouts_side_by_side():
+    with tempfile.TemporaryDirectory() as tmp:
+        for compact, types in ((True, ("blob", "integer")), (False, ("text", "real"))):
+            path = os.path.join(tmp, f"{compact}.db")
+            asyncio.run(register_and_read(path, compact))
+            connection = sqlite3.connect(path)
+            try:
+                row = connection.execute("SELECT typeof(address), typeof(tverified) FROM email").fetchone()
+            finally:
+                connection.close()
+            assert row == types
@@ -0,0 +1,135 @@
+"""
+SMTPPool sessions, against an aiosmtpd server.
+"""
+import asyncio
+import socket
+
+import aiosmtpd.controller
+
+from vmail.vmail_router import mailer
+
+SENDER = "vmail@example.com"
+
+
+class Sink:
+    """
+    Handler accepting every message except those to rejected addresses.
+    """
+
+    def __init__(self, rejected: tuple = ()):
+        self.rejected = rejected
+        self.received = []
+        # One SMTP protocol instance per connection
+        self.connections = []
+
+    async def handle_DATA(self, server, session, envelope):
+        if any(recipient in self.rejected for recipient in envelope.rcpt_tos):
+            return "550 Rejected"
+        self.received.extend(envelope.rcpt_tos)
+        if not any(server is seen for seen in self.connections):
+            self.connections.append(server)
+        return "250 OK"
+
+
+def message(recipient: str) -> mailer.RawMessage:
+    return mailer.RawMessage(
+        SENDER, [recipient], f"To: {recipient}\r\nSubject: Test\r\n\r\nHello\r\n".encode()
+    )
+
+
+def run(test, sink: Sink, **kwargs):
+    """
+    Run coroutine function test(pool, controller) with a pool connected to
+    an SMTP server delivering to sink.
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    controller = aiosmtpd.controller.Controller(sink, hostname="127.0.0.1", port=port)
+    controller.start()
+
+    async def main():
+        pool = mailer.SMTPPool("127.0.0.1", port, **kwargs)
+        try:
+            await test(pool, controller)
+        finally:
+            await pool.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        controller.stop()
+
+
+def test_sessions_are_reused():
+    sink = Sink()
+
+    async def test(pool, controller):
+        results = await pool.send_many([message("a@example.com"), message("b@example.com")])
+        assert results == [True, True]
+        assert await pool.send(message("c@example.com"))
+        assert pool.stats()["connects"] == 1
+        assert pool.stats()["idle"] == 1
+
+    run(test, sink)
+    assert sink.received == ["a@example.com", "b@example.com", "c@example.com"]
+    assert len(sink.connections) == 1
+
+
+def test_concurrent_sends_are_bounded_by_size():
+    sink = Sink()
+
+    async def test(pool, controller):
+        results = await asyncio.gather(
+            *[pool.send(message(f"user{i}@example.com")) for i in range(20)]
+        )
+        assert all(results)
+        assert pool.stats()["connects"] <= 2
+        assert pool.stats()["sent"] == 20
+
+    run(test, sink, size=2)
+    assert len(sink.received) == 20
+
+
+def test_idle_sessions_are_replaced():
+    sink = Sink()
+
+    async def test(pool, controller):
+        assert await pool.send(message("a@example.com"))
+        await asyncio.sleep(0.05)
+        assert await pool.send(message("b@example.com"))
+        assert pool.stats()["connects"] == 2
+
+    run(test, sink, idle_timeout=0.01)
+    assert len(sink.connections) == 2
+
+
+def test_session_dropped_by_server_is_replaced():
+    sink = Sink()
+
+    async def test(pool, controller):
+        assert await pool.send(message("a@example.com"))
+        # Close the server side of the pooled session
+        for server in sink.connections:
+            controller.loop.call_soon_threadsafe(server.transport.close)
+        await asyncio.sleep(0.1)
+        assert await pool.send(message("b@example.com"))
+        assert pool.stats()["connects"] == 2
+        assert pool.stats()["failures"] == 0
+
+    run(test, sink)
+    assert sink.received == ["a@example.com", "b@example.com"]
+
+
+def test_rejected_message_fails_alone():
+    sink = Sink(rejected=("b@example.com",))
+
+    async def test(pool, controller):
+        results = await pool.send_many(
+            [message("a@example.com"), message("b@example.com"), message("c@example.com")]
+        )
+        assert results == [True, False, True]
+        assert pool.stats()["failures"] == 1
+
+    run(test, sink)
+    assert sink.received == ["a@example.com", "c@example.com"]
@@ -0,0 +1,68 @@
+"""
+manage.py commands run with the settings of an env file given with -c.
+"""
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from vmail.vmail_router import KeyHasher
+
+MANAGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "manage.py")
+SEED = "seed of the env file"
+
+
+def manage(tmp: str, *args: str, stdin: str = ""):
+    """
+    Run manage.py in tmp with its vmail.env settings.
+    """
+    env = {key: value for key, value in os.environ.items() if not key.startswith("VMAIL_")}
+    subprocess.run(
+        [sys.executable, MANAGE, "-c", "vmail.env", *args],
+        cwd=tmp,
+        env=env,
+        input=stdin,
+        text=True,
+        capture_output=True,
+        check=True,
+    )
+
+
+def database(tmp: str) -> str:
+    path = os.path.join(tmp, "vmail.db")
+    with open(os.path.join(tmp, "vmail.env"), "w") as f:
+        f.write(f"VMAIL_DB_CONNECTION_STRING=sqlite:///{path}\nVMAIL_VERIFY_SEED={SEED}\n")
+    manage(tmp, "initialize")
+    return path
+
+
+def keys(path: str) -> list:
+    connection = sqlite3.connect(path)
+    try:
+        return [row[0] for row in connection.execute("SELECT address FROM email")]
+    finally:
+        connection.close()
+
+
+def test_rehash_uses_env_file_seed():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = database(tmp)
+        now = time.time()
+        connection = sqlite3.connect(path)
+        connection.execute(
+            "INSERT INTO email (address, tcreated, trequested, tverified) VALUES (?, ?, ?, ?)",
+            (KeyHasher(SEED, scheme=0).hash("someone@example.com"), now, now, now),
+        )
+        connection.commit()
+        connection.close()
+        manage(tmp, "rehash", stdin="someone@example.com\n")
+        assert keys(path) == [KeyHasher(SEED).hash("someone@example.com")]
+
+
+def test_import_uses_env_file_seed():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = database(tmp)
+        manage(tmp, "import", stdin="someone@example.com\n")
+        assert keys(path) == [KeyHasher(SEED).hash("someone@example.com")]
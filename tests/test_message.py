@@ -0,0 +1,65 @@
+"""
+Headers of rendered verification messages.
+"""
+import email
+import email.header
+import email.policy
+import os
+
+from vmail.vmail_router import message
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "vmail", "templates")
+
+
+def render(recipient: str, name=None, sender_name="vmail") -> email.message.EmailMessage:
+    template = message.VerificationTemplate(
+        TEMPLATE_PATH, sender="vmail@example.com", sender_name=sender_name
+    )
+    raw = template.render(recipient, "123456", "http://localhost/verify/123456", name=name)
+    assert raw.recipients == [recipient]
+    return email.message_from_bytes(raw.data, policy=email.policy.SMTPUTF8)
+
+
+def to(data: bytes) -> bytes:
+    return next(line for line in data.split(b"\r\n") if line.startswith(b"To: "))
+
+
+def test_ascii_recipient():
+    parsed = render("someone@example.com")
+    assert parsed["To"] == "someone@example.com"
+    assert parsed["From"] == "vmail <vmail@example.com>"
+
+
+def test_display_name():
+    parsed = render("someone@example.com", name="Jane Doe")
+    assert parsed["To"].addresses[0].display_name == "Jane Doe"
+    parsed = render("someone@example.com", name='Doe, Jane "JD"')
+    assert parsed["To"].addresses[0].display_name == 'Doe, Jane "JD"'
+    assert parsed["To"].addresses[0].addr_spec == "someone@example.com"
+
+
+def test_non_ascii_display_name_is_encoded():
+    template = message.VerificationTemplate(TEMPLATE_PATH, sender="vmail@example.com")
+    raw = template.render("someone@example.com", "123456", "http://x", name="Jöhn Döe")
+    assert to(raw.data).isascii()
+    parsed = email.message_from_bytes(raw.data, policy=email.policy.default)
+    assert parsed["To"].addresses[0].display_name == "Jöhn Döe"
+
+
+def test_smtputf8_recipient_is_not_encoded():
+    recipient = "jöhn@exämple.com"
+    template = message.VerificationTemplate(TEMPLATE_PATH, sender="vmail@example.com")
+    raw = template.render(recipient, "123456", "http://x")
+    assert to(raw.data) == f"To: {recipient}".encode("utf-8")
+    raw = template.render(recipient, "123456", "http://x", name="Jöhn")
+    encoded_name, address = to(raw.data)[len(b"To: ") :].split(b" <")
+    decoded = email.header.make_header(email.header.decode_header(encoded_name.decode()))
+    assert str(decoded) == "Jöhn"
+    assert address == f"{recipient}>".encode("utf-8")
+
+
+def test_line_breaks_in_name_do_not_add_headers():
+    template = message.VerificationTemplate(TEMPLATE_PATH, sender="vmail@example.com")
+    raw = template.render("someone@example.com", "123456", "http://x", name="Jane\r\nBcc: x@y")
+    assert to(raw.data) == b'To: "Jane Bcc: x@y" <someone@example.com>'
+    assert b"\r\nBcc:" not in raw.data
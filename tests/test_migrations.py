@@ -0,0 +1,42 @@
+"""
+Migrations of databases created by earlier releases.
+"""
+import asyncio
+import os
+import tempfile
+
+import sqlalchemy
+
+from vmail.vmail_router import db, migrations
+
+
+async def upgrade_unversioned(path: str):
+    engine = db.create_engine(f"sqlite:///{path}")
+    try:
+        async with engine.begin() as connection:
+            # The email table of releases without migrations
+            await connection.execute(
+                sqlalchemy.text(
+                    "CREATE TABLE email (address VARCHAR NOT NULL PRIMARY KEY, token VARCHAR, "
+                    "tcreated FLOAT NOT NULL, trequested FLOAT, tverified FLOAT)"
+                )
+            )
+            # Six digit OTPs collide
+            for address in ("a", "b"):
+                await connection.execute(
+                    sqlalchemy.text(
+                        "INSERT INTO email (address, token, tcreated, trequested) "
+                        "VALUES (:address, '123456', 1, 1)"
+                    ),
+                    {"address": address},
+                )
+        applied = await migrations.upgrade(engine)
+        assert [migration.version for migration in applied] == list(range(1, migrations.HEAD + 1))
+        assert await migrations.current_version(engine) == migrations.HEAD
+    finally:
+        await engine.dispose()
+
+
+def test_upgrade_with_shared_tokens():
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(upgrade_unversioned(os.path.join(tmp, "vmail.db")))
@@ -0,0 +1,161 @@
+"""
+StatusHub waiters, and the /verified long poll and event stream built on it.
+"""
+import asyncio
+import json
+import os
+import tempfile
+
+import fastapi
+import httpx
+import sqlalchemy.ext.asyncio
+
+import vmail.config
+from vmail.vmail_router import db, migrations, model, notify, repo, router
+
+ADDRESS = "someone@example.com"
+
+
+def test_publish_wakes_waiters_of_key():
+    async def main():
+        hub = notify.StatusHub(notify.LocalNotifier())
+        with hub.subscribe("a") as first, hub.subscribe("a") as second, hub.subscribe("b") as other:
+            assert hub.waiting == 3
+            await hub.publish("a", model.VerifiedEnum.verified)
+            assert await hub.wait(first, 1) == model.VerifiedEnum.verified
+            assert await hub.wait(second, 1) == model.VerifiedEnum.verified
+            assert not other.done()
+        assert hub.waiting == 0
+        assert hub.stats()["keys"] == 0
+        assert hub.stats()["delivered"] == 2
+
+    asyncio.run(main())
+
+
+def test_wait_times_out():
+    async def main():
+        hub = notify.StatusHub(notify.LocalNotifier())
+        with hub.subscribe("a") as change:
+            assert await hub.wait(change, 0.01) is None
+            # A timed out wait leaves the subscription usable
+            await hub.publish("a", model.VerifiedEnum.verified)
+            assert await hub.wait(change, 1) == model.VerifiedEnum.verified
+        assert hub.stats()["timeouts"] == 1
+
+    asyncio.run(main())
+
+
+def test_subscribe_overflow():
+    async def main():
+        hub = notify.StatusHub(notify.LocalNotifier(), max_waiters=1)
+        with hub.subscribe("a"):
+            try:
+                with hub.subscribe("b"):
+                    raise AssertionError("subscribed past max_waiters")
+            except OverflowError:
+                pass
+        with hub.subscribe("b"):
+            assert hub.waiting == 1
+
+    asyncio.run(main())
+
+
+def run(test, max_waiters: int = 10):
+    """
+    Run coroutine function test(client, verify) against a router on a new
+    database with ADDRESS registered, where verify() verifies ADDRESS.
+    """
+
+    async def main(path):
+        engine = db.create_engine(f"sqlite:///{path}")
+        await migrations.initialize(engine)
+        session_factory = sqlalchemy.ext.asyncio.async_sessionmaker(engine, expire_on_commit=False)
+        hub = notify.StatusHub(notify.LocalNotifier(), max_waiters=max_waiters)
+
+        async def get_repository():
+            async with session_factory() as session:
+                yield repo.VmailRepo(session, status_hub=hub)
+
+        async def verify():
+            async with session_factory() as session:
+                state = await repo.VmailRepo(session, status_hub=hub).verify(
+                    "123456", email_address=ADDRESS
+                )
+            assert state == model.VerifiedEnum.verified
+
+        async with session_factory() as session:
+            await repo.VmailRepo(session).register(ADDRESS, "123456")
+        app = fastapi.FastAPI()
+        app.include_router(router.get_vmail_router(vmail.config.get_settings, get_repository))
+        notify.STATUS_HUB = hub
+        try:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                await test(client, verify)
+            assert hub.waiting == 0
+        finally:
+            notify.STATUS_HUB = None
+            await engine.dispose()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(main(os.path.join(tmp, "vmail.db")))
+
+
+def events(body: str) -> list:
+    return [
+        json.loads(line[len("data: ") :]) for line in body.splitlines() if line.startswith("data: ")
+    ]
+
+
+def test_long_poll_wakes_on_verify():
+    async def test(client, verify):
+        request = asyncio.ensure_future(
+            client.get("/verified", params={"email": ADDRESS, "wait": 30})
+        )
+        await asyncio.sleep(0.2)
+        assert not request.done()
+        await verify()
+        response = await asyncio.wait_for(request, 5)
+        assert response.json()["verified"] == model.VerifiedEnum.verified
+
+    run(test)
+
+
+def test_stream_wakes_on_verify():
+    async def test(client, verify):
+        request = asyncio.ensure_future(
+            client.get("/verified/stream", params={"email": ADDRESS, "timeout": 30})
+        )
+        await asyncio.sleep(0.2)
+        assert not request.done()
+        await verify()
+        response = await asyncio.wait_for(request, 5)
+        assert response.headers["content-type"].startswith("text/event-stream")
+        states = [event["verified"] for event in events(response.text)]
+        assert states == [model.VerifiedEnum.unverified, model.VerifiedEnum.verified]
+
+    run(test)
+
+
+def test_stream_of_verified_address_ends_at_once():
+    async def test(client, verify):
+        await verify()
+        response = await client.get("/verified/stream", params={"email": ADDRESS})
+        assert [event["verified"] for event in events(response.text)] == [
+            model.VerifiedEnum.verified
+        ]
+
+    run(test)
+
+
+def test_overflow_answers_503():
+    async def test(client, verify):
+        for path, params in (("/verified", {"wait": 1}), ("/verified/stream", {"timeout": 1})):
+            response = await client.get(path, params={"email": ADDRESS, **params})
+            assert response.status_code == 503, path
+            assert response.headers["retry-after"] == "1"
+        # Requests that do not wait are still answered
+        response = await client.get("/verified", params={"email": ADDRESS})
+        assert response.status_code == 200
+
+    run(test, max_waiters=0)
@@ -0,0 +1,121 @@
+"""
+OutboxSender delivering queued verification emails to an aiosmtpd server.
+"""
+import asyncio
+import email
+import email.policy
+import os
+import socket
+import tempfile
+import time
+
+import aiosmtpd.controller
+import sqlalchemy
+import sqlalchemy.ext.asyncio
+
+import vmail.vmail_router
+from vmail.vmail_router import db, mailer, migrations, model, outbox, repo
+
+ADDRESS = "someone@example.com"
+QUEUE = dict(url="http://localhost/verify/123456", name=None, app_name=None)
+
+
+class Sink:
+    def __init__(self, reject: bool = False):
+        self.reject = reject
+        self.received = []
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.reject:
+            return "550 Rejected"
+        self.received.append((envelope.rcpt_tos, envelope.content))
+        return "250 OK"
+
+
+def run(test, sink: Sink):
+    """
+    Run coroutine function test(session_factory) on a new database with a
+    verification email to ADDRESS queued, and the shared SMTP pool
+    connected to a server delivering to sink.
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    controller = aiosmtpd.controller.Controller(sink, hostname="127.0.0.1", port=port)
+    controller.start()
+
+    async def main(path):
+        engine = db.create_engine(f"sqlite:///{path}")
+        await migrations.initialize(engine)
+        session_factory = sqlalchemy.ext.asyncio.async_sessionmaker(engine, expire_on_commit=False)
+        async with session_factory() as session:
+            await repo.VmailRepo(session).register(ADDRESS, "123456", queue=QUEUE)
+        vmail.vmail_router.SMTP_POOL = mailer.SMTPPool("127.0.0.1", port)
+        try:
+            await test(session_factory)
+        finally:
+            await vmail.vmail_router.close_smtp_pool()
+            await engine.dispose()
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(main(os.path.join(tmp, "vmail.db")))
+    finally:
+        controller.stop()
+
+
+async def entries(session_factory):
+    async with session_factory() as session:
+        return list(await session.scalars(sqlalchemy.select(db.Outbox)))
+
+
+def test_queued_message_is_delivered():
+    sink = Sink()
+
+    async def test(session_factory):
+        sender = outbox.OutboxSender(session_factory)
+        assert await sender.run_once() == 1
+        assert sender.stats() == {"sent": 1, "failed": 0, "abandoned": 0}
+        assert await entries(session_factory) == []
+        assert await sender.run_once() == 0
+        async with session_factory() as session:
+            state = await repo.VmailRepo(session).verify("123456", email_address=ADDRESS)
+        assert state == model.VerifiedEnum.verified
+
+    run(test, sink)
+    [(recipients, content)] = sink.received
+    assert recipients == [ADDRESS]
+    message = email.message_from_bytes(content, policy=email.policy.default)
+    assert message["To"] == ADDRESS
+    parts = [part.get_content() for part in message.walk() if not part.is_multipart()]
+    assert any("123456" in part for part in parts)
+
+
+def test_failed_send_is_retried_later():
+    sink = Sink(reject=True)
+
+    async def test(session_factory):
+        sender = outbox.OutboxSender(session_factory, backoff_seconds=60)
+        assert await sender.run_once() == 1
+        [entry] = await entries(session_factory)
+        assert entry.attempts == 1
+        assert entry.last_error == "send failed"
+        assert entry.tnext > time.time() + 50
+        # Not due again until the backoff has passed
+        assert await sender.run_once() == 0
+        assert sender.stats() == {"sent": 0, "failed": 1, "abandoned": 0}
+
+    run(test, sink)
+    assert sink.received == []
+
+
+def test_message_is_abandoned_after_max_attempts():
+    sink = Sink(reject=True)
+
+    async def test(session_factory):
+        sender = outbox.OutboxSender(session_factory, max_attempts=1)
+        assert await sender.run_once() == 1
+        assert await entries(session_factory) == []
+        assert sender.stats() == {"sent": 0, "failed": 1, "abandoned": 1}
+
+    run(test, sink)
@@ -0,0 +1,154 @@
+"""
+Statements issued by VmailRepo.register, against a temporary SQLite database.
+"""
+import asyncio
+import os
+import tempfile
+import time
+
+import sqlalchemy
+import sqlalchemy.ext.asyncio
+
+from vmail.vmail_router import db, hash_candidates, hash_something, migrations, model, repo
+
+ADDRESS = "someone@example.com"
+
+
+class Statements:
+    def __init__(self, engine: sqlalchemy.ext.asyncio.AsyncEngine):
+        self.executed = []
+        sqlalchemy.event.listen(engine.sync_engine, "before_cursor_execute", self._execute)
+
+    def _execute(self, connection, cursor, statement, *args):
+        self.executed.append(statement.split(None, 1)[0].upper())
+
+
+def run(test):
+    """
+    Run coroutine function test(engine, session_factory) on a new database.
+    """
+
+    async def main(path):
+        engine = db.create_engine(f"sqlite:///{path}")
+        await migrations.initialize(engine)
+        try:
+            await test(engine, sqlalchemy.ext.asyncio.async_sessionmaker(engine, expire_on_commit=False))
+        finally:
+            await engine.dispose()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(main(os.path.join(tmp, "vmail.db")))
+
+
+async def insert(session_factory, key: str, **values):
+    async with session_factory() as session:
+        await session.execute(sqlalchemy.insert(db.Email).values(address=key, **values))
+        await session.commit()
+
+
+async def fetch(session_factory, key: str):
+    async with session_factory() as session:
+        return (
+            await session.execute(sqlalchemy.select(db.Email.token).where(db.Email.address == key))
+        ).first()
+
+
+async def register(session_factory, statements: Statements, token: str) -> repo.Registration:
+    statements.executed.clear()
+    async with session_factory() as session:
+        return await repo.VmailRepo(session).register(ADDRESS, token)
+
+
+def test_register_new_address():
+    async def test(engine, session_factory):
+        statements = Statements(engine)
+        registration = await register(session_factory, statements, "token1")
+        assert registration == repo.Registration(model.VerifiedEnum.pending, True)
+        # The insert, and the lookup of the address under the fallback scheme
+        assert statements.executed == ["INSERT", "SELECT"]
+        assert (await fetch(session_factory, hash_something(ADDRESS))).token == "token1"
+
+    run(test)
+
+
+def test_register_existing_address():
+    async def test(engine, session_factory):
+        statements = Statements(engine)
+        await register(session_factory, statements, "token1")
+        registration = await register(session_factory, statements, "token2")
+        assert registration == repo.Registration(model.VerifiedEnum.pending, True)
+        assert statements.executed == ["INSERT", "UPDATE"]
+        assert (await fetch(session_factory, hash_something(ADDRESS))).token == "token2"
+
+    run(test)
+
+
+def test_register_verified_address():
+    async def test(engine, session_factory):
+        now = time.time()
+        key = hash_something(ADDRESS)
+        await insert(session_factory, key, tcreated=now, trequested=now, tverified=now)
+        statements = Statements(engine)
+        registration = await register(session_factory, statements, "token1")
+        assert registration == repo.Registration(model.VerifiedEnum.verified, False)
+        assert statements.executed == ["INSERT", "UPDATE"]
+        assert (await fetch(session_factory, key)).token is None
+
+    run(test)
+
+
+def test_register_moves_legacy_row():
+    async def test(engine, session_factory):
+        now = time.time()
+        legacy = hash_candidates(ADDRESS)[1]
+        await insert(session_factory, legacy, tcreated=now - 60, trequested=now - 60, token="legacy")
+        statements = Statements(engine)
+        registration = await register(session_factory, statements, "token1")
+        assert registration == repo.Registration(model.VerifiedEnum.pending, True)
+        assert statements.executed == ["INSERT", "SELECT", "DELETE", "UPDATE", "UPDATE"]
+        assert await fetch(session_factory, legacy) is None
+        assert (await fetch(session_factory, hash_something(ADDRESS))).token == "token1"
+
+    run(test)
+
+
+def test_register_again_within_the_second():
+    """
+    An existing row registered again at its creation time is not taken for
+    a new one, so a legacy row of the address is left alone.
+    """
+
+    async def test(engine, session_factory):
+        now = float(int(time.time()))
+        key = hash_something(ADDRESS)
+        legacy = hash_candidates(ADDRESS)[1]
+        async with session_factory() as session:
+            assert await repo.VmailRepo(session)._register(ADDRESS, "token1", now, 0) is None
+            await session.commit()
+        await insert(session_factory, legacy, tcreated=now, trequested=now, token="legacy")
+        async with session_factory() as session:
+            assert await repo.VmailRepo(session)._register(ADDRESS, "token2", now, 0) is None
+            await session.commit()
+        assert (await fetch(session_factory, key)).token == "token2"
+        assert (await fetch(session_factory, legacy)).token == "legacy"
+
+    run(test)
+
+
+def test_register_after_failed_send():
+    """
+    A token withdrawn after a failed send does not hold back the next
+    registration with the cooldown.
+    """
+
+    async def test(engine, session_factory):
+        async with session_factory() as session:
+            repository = repo.VmailRepo(session)
+            assert (await repository.register(ADDRESS, "token1", cooldown_seconds=60)).assigned
+            assert not (await repository.register(ADDRESS, "token2", cooldown_seconds=60)).assigned
+            assert await repository.verification_failed(ADDRESS, "token1")
+            registration = await repository.register(ADDRESS, "token3", cooldown_seconds=60)
+        assert registration == repo.Registration(model.VerifiedEnum.pending, True)
+        assert (await fetch(session_factory, hash_something(ADDRESS))).token == "token3"
+
+    run(test)
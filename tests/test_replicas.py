@@ -0,0 +1,131 @@
+"""
+Routing of status reads to a replica, with the primary and the replica in
+two SQLite files. Nothing is replicated, so a read shows where it was sent.
+"""
+import asyncio
+import os
+import tempfile
+
+import sqlalchemy.ext.asyncio
+
+from vmail.vmail_router import cache, db, hash_something, migrations, model, replicas, repo
+
+ADDRESS = "someone@example.com"
+OTHER = "other@example.com"
+
+
+def run(test, initialize_replica: bool = True, **kwargs):
+    """
+    Run coroutine function test(session_factory, replica_set) on a new
+    primary database with ADDRESS registered, and an empty replica.
+    """
+
+    async def main(tmp):
+        engine = db.create_engine(f"sqlite:///{os.path.join(tmp, 'primary.db')}")
+        replica_engine = db.create_engine(f"sqlite:///{os.path.join(tmp, 'replica.db')}")
+        await migrations.initialize(engine)
+        if initialize_replica:
+            await migrations.initialize(replica_engine)
+        session_factory = sqlalchemy.ext.asyncio.async_sessionmaker(engine, expire_on_commit=False)
+        async with session_factory() as session:
+            await repo.VmailRepo(session).register(ADDRESS, "123456")
+        replica_set = replicas.ReplicaSet([replica_engine], **kwargs)
+        try:
+            await test(session_factory, replica_set)
+        finally:
+            await replica_set.dispose()
+            await engine.dispose()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(main(tmp))
+
+
+async def read(session_factory, replica_set, email_address: str = ADDRESS, **kwargs):
+    async with session_factory() as session:
+        repository = repo.VmailRepo(session, replica_set=replica_set, **kwargs)
+        return await repository.read(email_address)
+
+
+async def register(session_factory, replica_set, email_address: str, token: str):
+    async with session_factory() as session:
+        repository = repo.VmailRepo(session, replica_set=replica_set)
+        return await repository.register(email_address, token)
+
+
+def test_reads_go_to_replica():
+    async def test(session_factory, replica_set):
+        assert await read(session_factory, replica_set) is None
+        [replica] = replica_set.replicas
+        assert replica.reads == 1
+        assert replica_set.primary_reads == 0
+        # Without replicas the primary is read
+        assert (await read(session_factory, None)).verified == model.VerifiedEnum.unverified
+
+    run(test)
+
+
+def test_writes_are_read_from_primary_within_window():
+    async def test(session_factory, replica_set):
+        await register(session_factory, replica_set, OTHER, "654321")
+        assert (await read(session_factory, replica_set, OTHER)).verified == (
+            model.VerifiedEnum.unverified
+        )
+        assert replica_set.primary_reads == 1
+        # A batch holding a recently written address is read from the primary
+        async with session_factory() as session:
+            result = await repo.VmailRepo(session, replica_set=replica_set).read_many(
+                [ADDRESS, OTHER]
+            )
+        assert set(result) == {ADDRESS, OTHER}
+        assert replica_set.primary_reads == 2
+        await asyncio.sleep(0.6)
+        assert await read(session_factory, replica_set, OTHER) is None
+        assert replica_set.replicas[0].reads == 1
+
+    run(test, read_your_writes_seconds=0.5)
+
+
+def test_failed_replica_is_skipped_until_it_recovers():
+    async def test(session_factory, replica_set):
+        [replica] = replica_set.replicas
+        # The replica has no tables, so the read fails over to the primary
+        assert (await read(session_factory, replica_set)).verified == model.VerifiedEnum.unverified
+        assert not replica.healthy
+        assert replica.failures == 1
+        await read(session_factory, replica_set)
+        assert replica.reads == 1
+        assert replica_set.primary_reads == 1
+        await replica_set.check()
+        assert not replica.healthy
+        await migrations.initialize(replica.engine)
+        await replica_set.check()
+        assert replica.healthy
+        assert await read(session_factory, replica_set) is None
+
+    run(test, initialize_replica=False)
+
+
+class WritingRepo(repo.VmailRepo):
+    """
+    Repository recording a write of ADDRESS after reading rows.
+    """
+
+    async def _read_instances(self, email_addresses):
+        result = await super()._read_instances(email_addresses)
+        self._replica_set.wrote(hash_something(ADDRESS))
+        return result
+
+
+def test_replica_reads_do_not_fill_cache_for_written_keys():
+    async def test(session_factory, replica_set):
+        status_cache = cache.StatusCache(cache.LocalBackend())
+        async with session_factory() as session:
+            repository = WritingRepo(session, status_cache=status_cache, replica_set=replica_set)
+            assert await repository.read_many([ADDRESS, OTHER]) == {}
+        assert replica_set.replicas[0].reads == 1
+        assert await status_cache.backend.get(hash_something(ADDRESS)) is None
+        assert await status_cache.backend.get(hash_something(OTHER)) == cache.StatusCache.NOT_FOUND
+        state = (await read(session_factory, replica_set, status_cache=status_cache)).verified
+        assert state == model.VerifiedEnum.unverified
+
+    run(test)
@@ -0,0 +1,122 @@
+"""
+/verify/{token} with the key of the verification URL.
+"""
+import asyncio
+import contextlib
+import os
+import tempfile
+
+import fastapi
+import httpx
+import sqlalchemy.ext.asyncio
+
+import vmail.config
+from vmail.vmail_router import db, hash_something, is_key, migrations, repo, router, shards
+
+ADDRESS = "someone@example.com"
+MALFORMED = ["zz", "1:zz", "abc", "0:" + "a" * 64, "9:" + "a" * 64, "a" * 63, "A" * 64]
+
+
+def run(test, compact: bool = False, n_shards: int = 0):
+    """
+    Run coroutine function test(client) against a router on new databases,
+    sharded over n_shards databases if given.
+    """
+
+    async def main(tmp):
+        paths = [os.path.join(tmp, f"vmail{i}.db") for i in range(max(1, n_shards))]
+        engines = [db.create_engine(f"sqlite:///{path}", compact_schema=compact) for path in paths]
+        for engine in engines:
+            await migrations.initialize(engine)
+        shard_set = shards.ShardSet(engines)
+
+        @contextlib.asynccontextmanager
+        async def open_repository():
+            if n_shards:
+                repository = repo.ShardedVmailRepo(shard_set)
+                try:
+                    yield repository
+                finally:
+                    await repository.close()
+                return
+            async with shard_set.session_factories[0]() as session:
+                yield repo.VmailRepo(session)
+
+        async def get_repository():
+            async with open_repository() as repository:
+                yield repository
+
+        app = fastapi.FastAPI()
+        app.include_router(router.get_vmail_router(vmail.config.get_settings, get_repository))
+        async with open_repository() as repository:
+            await repository.register(ADDRESS, "123456")
+        try:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                await test(client, open_repository)
+        finally:
+            await shard_set.dispose()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(main(tmp))
+
+
+def test_is_key():
+    assert is_key(hash_something(ADDRESS))
+    assert is_key("a" * 64)
+    for key in MALFORMED:
+        assert not is_key(key), key
+
+
+def test_verify_malformed_key():
+    async def test(client, open_repository):
+        for key in MALFORMED:
+            response = await client.get("/verify/123456", params={"key": key})
+            assert response.status_code == 404, key
+        response = await client.get("/verify/123456", params={"key": hash_something(ADDRESS)})
+        assert response.status_code == 200
+        assert response.json()["state"]
+
+    for compact in (False, True):
+        run(test, compact)
+    run(test, n_shards=2)
+
+
+def test_verify_ambiguous_token():
+    async def test(client, open_repository):
+        async with open_repository() as repository:
+            # OTPs are only unique per address
+            await repository.register("other@example.com", "123456")
+        response = await client.get("/verify/123456")
+        assert response.status_code == 409
+        response = await client.get("/verify/123456", params={"email": ADDRESS})
+        assert response.status_code == 200
+
+    run(test)
+    run(test, n_shards=2)
+
+
+def test_repository_verify_malformed_key():
+    async def main(path):
+        engine = db.create_engine(f"sqlite:///{path}", compact_schema=True)
+        await migrations.initialize(engine)
+        try:
+            async with sqlalchemy.ext.asyncio.AsyncSession(engine) as session:
+                repository = repo.VmailRepo(session)
+                await repository.register(ADDRESS, "123456")
+                for key in MALFORMED:
+                    assert await repository.verify("123456", key=key) is None
+        finally:
+            await engine.dispose()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(main(os.path.join(tmp, "vmail.db")))
+
+
+def test_sharded_verify_malformed_key():
+    async def test(client, open_repository):
+        async with open_repository() as repository:
+            for key in MALFORMED:
+                assert await repository.verify("123456", key=key) is None
+
+    run(test, n_shards=2)
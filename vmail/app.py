@@ -2,18 +2,34 @@
 FastAPI vmail application for validating and verifying emails.
 """
 
+import asyncio
 import contextlib
+import hashlib
 import logging
+import math
 import typing
 
 import fastapi
 import fastapi.middleware.cors
 import fastapi.security
-import sqlalchemy
+import sqlalchemy.ext.asyncio
 
 from .config import get_settings
 
 from . import __version__
+from .vmail_router import admission
+from .vmail_router import cache
+from .vmail_router import db
+from .vmail_router import deliverability
+from .vmail_router import metrics
+from .vmail_router import notify
+from .vmail_router import outbox
+from .vmail_router import profiling
+from .vmail_router import ratelimit
+from .vmail_router import reaper
+from .vmail_router import replicas
+from .vmail_router import shards
+from .vmail_router import get_smtp_pool, close_smtp_pool, get_verification_template
 from .vmail_router import repo
 from .vmail_router import router
 
@@ -23,30 +39,201 @@ L = logging.getLogger("vmail")
 settings = get_settings()
 
 ENGINE = None
+SESSION_FACTORY = None
+REPLICA_SET = None
+SHARD_SET = None
 
 
-def get_engine():
+def _create_engine(connection_string: str) -> sqlalchemy.ext.asyncio.AsyncEngine:
+    engine = db.create_engine(
+        connection_string,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_recycle=settings.db_pool_recycle,
+        pool_timeout=settings.db_pool_timeout,
+        pool_pre_ping=settings.db_pool_pre_ping,
+        compact_schema=settings.db_compact_schema,
+    )
+    if settings.metrics_enabled:
+        metrics.instrument_engine(engine)
+    if settings.profile_enabled:
+        profiling.instrument_engine(engine)
+    return engine
+
+
+def get_engine() -> sqlalchemy.ext.asyncio.AsyncEngine:
     global ENGINE
     if ENGINE is None:
-        ENGINE = sqlalchemy.create_engine(
-            settings.db_connection_string, pool_pre_ping=True
-        )
+        ENGINE = _create_engine(settings.db_connection_string)
     return ENGINE
 
 
+def get_shard_set() -> typing.Optional[shards.ShardSet]:
+    """
+    Return the shard databases, or None if the database is not sharded.
+    """
+    global SHARD_SET
+    if SHARD_SET is None and settings.db_shard_connection_strings:
+        SHARD_SET = shards.ShardSet(
+            [_create_engine(url) for url in settings.db_shard_connection_strings]
+        )
+    return SHARD_SET
+
+
+def get_replica_set() -> typing.Optional[replicas.ReplicaSet]:
+    """
+    Return the read replicas, or None if no replicas are configured or the
+    database is sharded.
+    """
+    global REPLICA_SET
+    if (
+        REPLICA_SET is None
+        and settings.db_replica_connection_strings
+        and not settings.db_shard_connection_strings
+    ):
+        REPLICA_SET = replicas.ReplicaSet(
+            [_create_engine(url) for url in settings.db_replica_connection_strings],
+            read_your_writes_seconds=settings.db_read_your_writes_seconds,
+            check_interval_seconds=settings.db_replica_check_interval_seconds,
+        )
+    return REPLICA_SET
+
+
+def get_session_factory() -> sqlalchemy.ext.asyncio.async_sessionmaker:
+    global SESSION_FACTORY
+    if SESSION_FACTORY is None:
+        SESSION_FACTORY = sqlalchemy.ext.asyncio.async_sessionmaker(
+            bind=get_engine(), expire_on_commit=False
+        )
+    return SESSION_FACTORY
+
+
 async def create_db_and_tables():
     L.debug("db connect")
 
 
+def _pool_checked_out() -> typing.Optional[float]:
+    engines = SHARD_SET.engines if SHARD_SET is not None else [ENGINE] if ENGINE is not None else []
+    stats = [db.pool_stats(engine) for engine in engines]
+    if not stats or None in stats:
+        return None
+    return sum(engine_stats["checked_out"] for engine_stats in stats)
+
+
+metrics.REGISTRY.register(
+    metrics.Gauge("vmail_db_pool_checked_out", "Database connections in use.", _pool_checked_out)
+)
+metrics.REGISTRY.register(
+    metrics.Gauge(
+        "vmail_status_waiters",
+        "Requests waiting for a verification state change.",
+        lambda: notify.STATUS_HUB.waiting if notify.STATUS_HUB is not None else 0,
+    )
+)
+metrics.REGISTRY.register(
+    metrics.Gauge(
+        "vmail_admission_queued",
+        "Requests waiting for admission.",
+        lambda: admission.ADMISSION.queued if admission.ADMISSION is not None else 0,
+    )
+)
+metrics.REGISTRY.register(
+    metrics.Gauge(
+        "vmail_smtp_idle_sessions",
+        "Pooled SMTP sessions waiting for reuse.",
+        lambda: get_smtp_pool().stats()["idle"],
+    )
+)
+
+
+def hash_api_key(api_key: str) -> bytes:
+    return hashlib.sha256(api_key.encode("utf-8")).digest()
+
+
+def _session_factories() -> typing.List[sqlalchemy.ext.asyncio.async_sessionmaker]:
+    if get_shard_set() is not None:
+        return get_shard_set().session_factories
+    return [get_session_factory()]
+
+
+def create_outbox_sender() -> outbox.OutboxSender:
+    return outbox.OutboxSender(
+        _session_factories(),
+        concurrency=settings.outbox_concurrency,
+        poll_seconds=settings.outbox_poll_seconds,
+        max_attempts=settings.outbox_max_attempts,
+        backoff_seconds=settings.outbox_backoff_seconds,
+        backoff_max_seconds=settings.outbox_backoff_max_seconds,
+        lease_seconds=settings.outbox_lease_seconds,
+    )
+
+
+def create_reaper() -> reaper.Reaper:
+    return reaper.Reaper(
+        _session_factories(),
+        token_timeout_seconds=settings.verify_timeout_seconds,
+        retention_seconds=settings.reap_retention_seconds,
+        batch_size=settings.reap_batch_size,
+        interval_seconds=settings.reap_interval_seconds,
+    )
+
+
 def create_application() -> fastapi.FastAPI:
     @contextlib.asynccontextmanager
     async def lifespan(fastapi_app: fastapi.FastAPI):
         L.debug("lifespan connect")
-        engine = get_engine()
         await create_db_and_tables()
+        if not settings.lazy_startup:
+            if get_shard_set() is None:
+                get_engine()
+            get_smtp_pool()
+            get_verification_template()
+        prewarm = None
+        if settings.dns_prewarm_domains:
+            prewarm = asyncio.create_task(
+                deliverability.get_resolver().prewarm(settings.dns_prewarm_domains)
+            )
+        sender = None
+        if settings.outbox_enabled and settings.outbox_worker:
+            outbox.SENDER = create_outbox_sender()
+            sender = asyncio.create_task(outbox.SENDER.run())
+        check_replicas = None
+        if get_replica_set() is not None:
+            check_replicas = asyncio.create_task(get_replica_set().run())
+        listen = None
+        if settings.status_notify_url:
+            listen = asyncio.create_task(notify.get_status_hub().run())
+        watch = None
+        if settings.loop_block_threshold_seconds > 0:
+            profiling.WATCHDOG = profiling.LoopWatchdog(settings.loop_block_threshold_seconds)
+            watch = asyncio.create_task(profiling.WATCHDOG.run())
+        reap = None
+        if settings.reap_interval_seconds > 0:
+            reaper.REAPER = create_reaper()
+            reap = asyncio.create_task(reaper.REAPER.run())
         yield
+        if check_replicas is not None:
+            check_replicas.cancel()
+            await get_replica_set().dispose()
+        if listen is not None:
+            listen.cancel()
+        if watch is not None:
+            watch.cancel()
+            profiling.WATCHDOG = None
+        if reap is not None:
+            reap.cancel()
+            reaper.REAPER = None
+        if prewarm is not None:
+            prewarm.cancel()
+        if sender is not None:
+            sender.cancel()
+            outbox.SENDER = None
         L.debug("lifespan disconnect")
-        engine.dispose()
+        await close_smtp_pool()
+        if ENGINE is not None:
+            await ENGINE.dispose()
+        if SHARD_SET is not None:
+            await SHARD_SET.dispose()
 
     app = fastapi.FastAPI(
         title="Vmail",
@@ -55,6 +242,12 @@ def create_application() -> fastapi.FastAPI:
         lifespan=lifespan,
     )
 
+    if settings.profile_enabled:
+        app.add_middleware(profiling.ProfileMiddleware, profiler=profiling.get_profiler())
+
+    if settings.metrics_enabled:
+        app.add_middleware(metrics.MetricsMiddleware)
+
     app.add_middleware(
         fastapi.middleware.cors.CORSMiddleware,
         allow_origins=["*"],
@@ -66,43 +259,139 @@ def create_application() -> fastapi.FastAPI:
     api_key_header = fastapi.security.APIKeyHeader(name="X-API-Key")
 
 
-    def custom_header_dependency(x_api_key: str=fastapi.Header())->str:
-        print(f"XAPIKEY = {x_api_key}")
-        return x_api_key
-
+    api_key_index = {hash_api_key(value): name for name, value in settings.api_keys.items()}
 
-    def get_api_key(api_key: str = fastapi.Security(api_key_header)) -> str:
-        if api_key in settings.api_keys.values():
-            return api_key
+    async def get_api_key(api_key: str = fastapi.Security(api_key_header)) -> str:
+        """
+        Dependency returning the name of the presented API key.
+        """
+        with profiling.span("auth"):
+            name = api_key_index.get(hash_api_key(api_key))
+        if name is not None:
+            return name
         raise fastapi.HTTPException(
             status_code=fastapi.status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or missing API Key",
         )
 
-    @contextlib.contextmanager
-    def get_repository() -> typing.Iterator[repo.VmailRepo]:
-        session = sqlalchemy.orm.sessionmaker(bind=get_engine())()
-        repository = repo.VmailRepo(session)
+    async def check_rate_limit(
+        request: fastapi.Request, client: str = fastapi.Depends(get_api_key)
+    ):
+        """
+        Dependency applying settings.rate_limits to the API key and route.
+        """
+        limiter = ratelimit.get_rate_limiter()
+        if limiter is None:
+            return
+        with profiling.span("ratelimit"):
+            wait = await limiter.check(client, request.scope["route"].path)
+        if wait > 0:
+            raise fastapi.HTTPException(
+                status_code=fastapi.status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Rate limit exceeded",
+                headers={"Retry-After": str(math.ceil(wait))},
+            )
+
+    async def admit(request: fastapi.Request) -> typing.AsyncIterator[None]:
+        """
+        Dependency holding a slot of the route's admission class for the
+        request, including the use of its repository.
+        """
+        controller = admission.get_admission_controller()
+        route = request.scope["route"].path
+        limiter = None
+        if controller is not None:
+            limiter = controller.limiter(route)
+        if limiter is None or admission.is_long_poll(route, request.query_params.get("wait")):
+            yield
+            return
+        try:
+            async with limiter.acquire():
+                yield
+        except admission.Overloaded as e:
+            raise fastapi.HTTPException(
+                status_code=fastapi.status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server overloaded",
+                headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))},
+            )
+
+    async def get_repository() -> typing.AsyncIterator[repo.VmailRepo]:
+        """
+        Dependency providing a vmail repository for routes that use the database.
+
+        The session only checks out a pooled connection when the first
+        statement is executed. With sharded databases the repository opens a
+        session on each shard it uses.
+        """
+        if get_shard_set() is not None:
+            sharded = repo.ShardedVmailRepo(
+                get_shard_set(),
+                status_cache=cache.get_status_cache(),
+                rehash_on_read=settings.hash_rehash_on_read,
+                status_hub=notify.get_status_hub(),
+            )
+            try:
+                yield sharded
+            except Exception:
+                await sharded.rollback()
+                raise
+            finally:
+                await sharded.close()
+            return
+        session = get_session_factory()()
+        repository = repo.VmailRepo(
+            session,
+            status_cache=cache.get_status_cache(),
+            rehash_on_read=settings.hash_rehash_on_read,
+            replica_set=get_replica_set(),
+            status_hub=notify.get_status_hub(),
+        )
         try:
             L.debug("start yield repo")
             yield repository
             L.debug("end yield repo")
         except Exception:
-            session.rollback()
+            await session.rollback()
+            raise
         finally:
-            session.close()
+            await session.close()
 
-    @app.middleware("http")
-    async def db_session_middleware(request: fastapi.Request, call_next):
+    @app.get("/stats", include_in_schema=False, dependencies=[fastapi.Depends(get_api_key)])
+    async def get_stats():
         """
-        Adds the vmail repository instance to the state property of each request.
+        Runtime statistics for sizing and monitoring.
+        """
+        return {
+            "pool": db.pool_stats(get_engine()) if SHARD_SET is None else None,
+            "shards": SHARD_SET.stats() if SHARD_SET is not None else None,
+            "replicas": REPLICA_SET.stats() if REPLICA_SET is not None else None,
+            "dns": deliverability.get_resolver().stats(),
+            "status_cache": (
+                cache.get_status_cache().stats() if settings.status_cache_enabled else None
+            ),
+            "smtp": get_smtp_pool().stats(),
+            "outbox": outbox.SENDER.stats() if outbox.SENDER is not None else None,
+            "reaper": reaper.REAPER.stats() if reaper.REAPER is not None else None,
+            "register": router.REGISTRATIONS.stats(),
+            "status_hub": notify.STATUS_HUB.stats() if notify.STATUS_HUB is not None else None,
+            "profiling": profiling.PROFILER.stats() if profiling.PROFILER is not None else None,
+            "event_loop": profiling.WATCHDOG.stats() if profiling.WATCHDOG is not None else None,
+            "rate_limit": (
+                ratelimit.get_rate_limiter().stats() if settings.rate_limits else None
+            ),
+            "admission": admission.ADMISSION.stats() if admission.ADMISSION is not None else None,
+        }
 
-        Grabbing the repository is a low-cost operation as it is just instantiating the class.
+    @app.get("/metrics", include_in_schema=False, dependencies=[fastapi.Depends(get_api_key)])
+    async def get_metrics():
+        """
+        Metrics in the Prometheus text format.
         """
-        with get_repository() as repository:
-            request.state.vmailrepo = repository
-            response = await call_next(request)
-            return response
+        if not settings.metrics_enabled:
+            raise fastapi.HTTPException(status_code=404, detail="Not found")
+        return fastapi.responses.PlainTextResponse(
+            metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE
+        )
 
     @app.get("/favicon.ico", include_in_schema=False)
     async def get_favicon():
@@ -115,9 +404,11 @@ def create_application() -> fastapi.FastAPI:
     app.include_router(
         router.get_vmail_router(
             get_settings,
+            get_repository,
             dependencies=[
                 fastapi.Depends(get_api_key),
-                fastapi.Depends(custom_header_dependency)
+                fastapi.Depends(check_rate_limit),
+                fastapi.Depends(admit),
             ],
         ),
         prefix="",
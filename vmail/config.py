@@ -18,13 +18,70 @@ class Settings(pydantic_settings.BaseSettings):
     smtp_ssl: bool = True
     smtp_credentials: bool = True
     smtp_checkcerts: bool = True
+    smtp_pool_size: int = 4
+    smtp_idle_timeout: float = 60
     verify_seed: str = "replace me with some random seed string"
-    verify_url: str = "http://localhost:8001/verify/{token}"
+    verify_seed_legacy: typing.Optional[str] = None
+    hash_scheme: int = 1
+    hash_fallback_schemes: typing.List[int] = [0]
+    hash_rehash_on_read: bool = False
+    verify_url: str = "http://localhost:8001/verify/{token}?key={key}"
     verify_timeout_seconds: float = 15 * 60
     otp_digits: int = 6
+    register_cooldown_seconds: float = 30
+    reap_interval_seconds: float = 0
+    reap_retention_seconds: float = 30 * 24 * 3600
+    reap_batch_size: int = 1000
+    outbox_enabled: bool = False
+    outbox_worker: bool = True
+    outbox_concurrency: int = 4
+    outbox_poll_seconds: float = 5
+    outbox_max_attempts: int = 8
+    outbox_backoff_seconds: float = 10
+    outbox_backoff_max_seconds: float = 3600
+    outbox_lease_seconds: float = 300
     db_connection_string: str = "sqlite:///test.db"
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_recycle: int = -1
+    db_pool_timeout: float = 30.0
+    db_pool_pre_ping: bool = False
+    db_replica_connection_strings: typing.List[str] = []
+    db_replica_check_interval_seconds: float = 5
+    db_read_your_writes_seconds: float = 5
+    db_shard_connection_strings: typing.List[str] = []
+    db_compact_schema: bool = False
+    lazy_startup: bool = False
     api_keys: typing.Dict[str, str] = {"test": "test"}
+    rate_limits: typing.Dict[str, str] = {}
+    rate_limit_url: typing.Optional[str] = None
+    admission_limits: typing.Dict[str, int] = {}
+    admission_queue_size: int = 100
+    admission_queue_timeout_seconds: float = 5
+    dns_timeout: float = 5
+    dns_cache_ttl: float = 3600
+    dns_negative_ttl: float = 300
+    dns_cache_size: int = 10000
+    dns_prewarm_domains: typing.List[str] = []
+    status_cache_enabled: bool = True
+    status_cache_size: int = 100000
+    status_cache_ttl: float = 60
+    status_cache_url: typing.Optional[str] = None
+    status_notify_url: typing.Optional[str] = None
+    verified_wait_max_seconds: float = 60
+    verified_wait_heartbeat_seconds: float = 15
+    verified_wait_max_waiters: int = 10000
+    metrics_enabled: bool = True
+    profile_enabled: bool = False
+    profile_token: typing.Optional[str] = None
+    profile_sample_rate: float = 0
+    profile_dir: str = "profiles"
+    loop_block_threshold_seconds: float = 0
+    batch_max_size: int = 10000
+    batch_chunk_size: int = 500
     template_path: str = os.path.join(current_folder, "templates")
+    template_reload: bool = False
+    template_render_in_thread: bool = False
 
 
 @functools.lru_cache()
@@ -1,15 +1,17 @@
 """
 Implements the vmail_router module for vmail.
 """
+import asyncio
 import hashlib
 import logging
-import math
-import random
+import re
+import secrets
 import typing
 
-import fastapi_mail
-
 from ..config import get_settings
+from . import mailer
+from . import message
+from . import profiling
 
 __version__ = "0.3.1"
 
@@ -17,19 +19,71 @@ L = logging.getLogger("vmail_router")
 
 settings = get_settings()
 
-mail_conf = fastapi_mail.ConnectionConfig(
-    MAIL_USERNAME=settings.smtp_user,
-    MAIL_PASSWORD=settings.smtp_password,
-    MAIL_FROM=settings.smtp_from,
-    MAIL_PORT=settings.smtp_port,
-    MAIL_SERVER=settings.smtp_host,
-    MAIL_FROM_NAME=settings.smtp_name,
-    MAIL_STARTTLS=settings.smtp_starttls,
-    MAIL_SSL_TLS=settings.smtp_ssl,
-    USE_CREDENTIALS=settings.smtp_credentials,
-    VALIDATE_CERTS=settings.smtp_checkcerts,
-    TEMPLATE_FOLDER=settings.template_path,
-)
+MAIL_CONF = None
+
+
+def get_mail_conf():
+    """
+    Return the fastapi_mail connection configuration, creating it on first use.
+
+    Messages are sent through SMTPPool, so fastapi_mail is only imported by
+    code that asks for this configuration, not at application startup.
+    """
+    global MAIL_CONF
+    if MAIL_CONF is None:
+        import fastapi_mail
+
+        MAIL_CONF = fastapi_mail.ConnectionConfig(
+            MAIL_USERNAME=settings.smtp_user,
+            MAIL_PASSWORD=settings.smtp_password,
+            MAIL_FROM=settings.smtp_from,
+            MAIL_PORT=settings.smtp_port,
+            MAIL_SERVER=settings.smtp_host,
+            MAIL_FROM_NAME=settings.smtp_name,
+            MAIL_STARTTLS=settings.smtp_starttls,
+            MAIL_SSL_TLS=settings.smtp_ssl,
+            USE_CREDENTIALS=settings.smtp_credentials,
+            VALIDATE_CERTS=settings.smtp_checkcerts,
+            TEMPLATE_FOLDER=settings.template_path,
+        )
+    return MAIL_CONF
+
+
+def __getattr__(name: str):
+    # mail_conf was a module attribute built at import
+    if name == "mail_conf":
+        return get_mail_conf()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+SMTP_POOL = None
+
+
+def get_smtp_pool() -> mailer.SMTPPool:
+    """
+    Return the shared SMTP connection pool, creating it on first use.
+    """
+    global SMTP_POOL
+    if SMTP_POOL is None:
+        SMTP_POOL = mailer.SMTPPool(
+            hostname=settings.smtp_host,
+            port=settings.smtp_port,
+            username=settings.smtp_user if settings.smtp_credentials else None,
+            password=settings.smtp_password if settings.smtp_credentials else None,
+            use_tls=settings.smtp_ssl,
+            start_tls=settings.smtp_starttls,
+            validate_certs=settings.smtp_checkcerts,
+            size=settings.smtp_pool_size,
+            idle_timeout=settings.smtp_idle_timeout,
+        )
+    return SMTP_POOL
+
+
+async def close_smtp_pool():
+    global SMTP_POOL
+    if SMTP_POOL is not None:
+        await SMTP_POOL.close()
+        SMTP_POOL = None
 
 
 def create_otp() -> str:
@@ -37,18 +91,140 @@ def create_otp() -> str:
     Create a random one time passcode.
 
     Returns:
-        Random string of length settings.otp_digitsm defaults to 6
+        Random string of length settings.otp_digitsm defaults to 6, drawn from
+        the operating system CSPRNG
     """
-    digits = ["0", "1", "2", "3", "4", "5", "6", "7", "8", "9"]
-    otp_str = ""
     try:
         ndigits = settings.otp_digits
     except AttributeError:
         ndigits = 6
-    for i in range(0, ndigits):
-        idx = math.floor(random.random() * 10)
-        otp_str += digits[idx]
-    return otp_str
+    return str(secrets.randbelow(10**ndigits)).zfill(ndigits)
+
+
+def _sha256_hasher(seed: str) -> typing.Callable[[str], str]:
+    """
+    Scheme 0, the original unversioned keys: hex SHA-256 of seed + text.
+    """
+    base = hashlib.sha256(seed.encode("utf-8"))
+
+    def hasher(text: str) -> str:
+        h = base.copy()
+        h.update(text.encode("utf-8"))
+        return h.hexdigest()
+
+    return hasher
+
+
+def _blake2b_hasher(seed: str) -> typing.Callable[[str], str]:
+    """
+    Scheme 1: keyed BLAKE2b-256 of text, prefixed with "1:".
+    """
+    key = seed.encode("utf-8")
+    if len(key) > hashlib.blake2b.MAX_KEY_SIZE:
+        key = hashlib.blake2b(key).digest()
+    base = hashlib.blake2b(key=key, digest_size=32)
+
+    def hasher(text: str) -> str:
+        h = base.copy()
+        h.update(text.encode("utf-8"))
+        return "1:" + h.hexdigest()
+
+    return hasher
+
+
+HASH_SCHEMES = {
+    0: _sha256_hasher,
+    1: _blake2b_hasher,
+}
+
+class KeyHasher:
+    """
+    Address keys of one deployment: keys of its hash scheme and seed, and
+    the keys of its fallback schemes for rows not yet rehashed.
+    """
+
+    def __init__(
+        self,
+        seed: str,
+        scheme: int = 1,
+        fallback_schemes: typing.Sequence[int] = (),
+        legacy_seed: typing.Optional[str] = None,
+    ):
+        """
+        Args:
+            seed: Seed of the current scheme
+            scheme: Hash scheme of new keys
+            fallback_schemes: Schemes of keys that rows may still be stored
+                under
+            legacy_seed: Seed of the fallback schemes, if not seed
+        """
+        self.scheme = scheme
+        self.fallback_schemes = [fallback for fallback in fallback_schemes if fallback != scheme]
+        # Hash functions with their seeds preloaded
+        self._hash = HASH_SCHEMES[scheme](seed)
+        self._fallbacks = [
+            HASH_SCHEMES[fallback](seed if legacy_seed is None else legacy_seed)
+            for fallback in self.fallback_schemes
+        ]
+
+    @classmethod
+    def from_settings(cls, settings) -> "KeyHasher":
+        return cls(
+            settings.verify_seed,
+            scheme=settings.hash_scheme,
+            fallback_schemes=settings.hash_fallback_schemes,
+            legacy_seed=settings.verify_seed_legacy,
+        )
+
+    def hash(self, text: str) -> str:
+        """
+        Key of text under the current scheme.
+        """
+        return self._hash(text)
+
+    def candidates(self, text: str) -> typing.List[str]:
+        """
+        Keys under which text may be stored: the current scheme first,
+        followed by the keys of the fallback schemes.
+        """
+        return [self._hash(text)] + [fallback(text) for fallback in self._fallbacks]
+
+
+KEY_HASHER = None
+
+
+def get_key_hasher() -> KeyHasher:
+    """
+    Return the KeyHasher of the application settings.
+    """
+    global KEY_HASHER
+    if KEY_HASHER is None:
+        KEY_HASHER = KeyHasher.from_settings(settings)
+    return KEY_HASHER
+
+
+def hash_scheme(key: str) -> int:
+    """
+    Return the scheme version of a key produced by hash_something.
+    """
+    prefix, sep, _ = key.partition(":")
+    if not sep:
+        return 0
+    return int(prefix)
+
+
+_DIGEST = re.compile("[0-9a-f]{64}")
+
+
+def is_key(value: str) -> bool:
+    """
+    Return whether value has the form of a key produced by hash_something:
+    64 hex digits, prefixed with "<version>:" for schemes 1 and later.
+    """
+    prefix, sep, digest = value.rpartition(":")
+    if sep and not (prefix.isdigit() and int(prefix) in HASH_SCHEMES and int(prefix) > 0):
+        return False
+    return _DIGEST.fullmatch(digest) is not None
 
 
 def hash_something(text: str) -> str:
@@ -56,16 +232,74 @@ def hash_something(text: str) -> str:
     Create a unique hash string for the provided input. This should not be used
     to encrypt passwords, but rather to obfuscate unique strings like email addresses.
 
+    The hash uses settings.hash_scheme. Keys of scheme 1 and later carry a
+    "<version>:" prefix, keys without a prefix are scheme 0.
+
     Args:
         text: Unique string
 
     Returns:
         Unique string obfustaced
     """
-    h = hashlib.new("sha256")
-    h.update(settings.verify_seed.encode("utf-8"))
-    h.update(text.encode("utf-8"))
-    return h.hexdigest()
+    return get_key_hasher().hash(text)
+
+
+def hash_candidates(text: str) -> typing.List[str]:
+    """
+    Keys under which text may be stored: the current scheme first, followed
+    by the settings.hash_fallback_schemes keys of rows not yet rehashed.
+    """
+    return get_key_hasher().candidates(text)
+
+
+TEMPLATE = None
+
+
+def get_verification_template() -> message.VerificationTemplate:
+    """
+    Return the compiled verification email template, loading it on first use.
+    """
+    global TEMPLATE
+    if TEMPLATE is None:
+        TEMPLATE = message.VerificationTemplate(
+            settings.template_path,
+            sender=settings.smtp_from,
+            sender_name=settings.smtp_name,
+            auto_reload=settings.template_reload,
+        )
+    return TEMPLATE
+
+
+def build_verification_message(
+    recipient: str,
+    otp: str,
+    verify_url: str,
+    name: typing.Optional[str] = None,
+    app_name: typing.Optional[str] = None,
+) -> mailer.RawMessage:
+    """
+    Render the verification email for recipient.
+    """
+    return get_verification_template().render(
+        recipient, otp, verify_url, name=name, app_name=app_name
+    )
+
+
+async def build_verification_messages(
+    requests: typing.Sequence[typing.Dict[str, typing.Any]]
+) -> typing.List[mailer.RawMessage]:
+    """
+    Render verification emails for a sequence of VerificationTemplate.render
+    keyword arguments, in a worker thread if settings.template_render_in_thread.
+    """
+    template = get_verification_template()
+
+    def render() -> typing.List[mailer.RawMessage]:
+        return [template.render(**request) for request in requests]
+
+    if settings.template_render_in_thread:
+        return await asyncio.to_thread(render)
+    return render()
 
 
 async def send_verification_email(
@@ -76,30 +310,13 @@ async def send_verification_email(
     app_name: typing.Optional[str] = None,
 ) -> bool:
     L.debug("send_verification_email")
-    if name is None:
-        name = email
-    if app_name is None:
-        app_name = ""
-    message = fastapi_mail.MessageSchema(
-        subject="Fastapi-Mail module",
-        recipients=[
-            email,
-        ],
-        template_body={
-            "name": name,
-            "email": email,
-            "url": verify_url,
-            "otp": otp,
-            "application_name": app_name,
-        },
-        subtype=fastapi_mail.MessageType.html,
-    )
-    fm = fastapi_mail.FastMail(mail_conf)
+    with profiling.span("render"):
+        messages = await build_verification_messages(
+            [dict(recipient=email, otp=otp, url=verify_url, name=name, app_name=app_name)]
+        )
     L.debug(f"Sending to {email}")
-    try:
-        await fm.send_message(message, template_name="verify_email.html")
+    with profiling.span("smtp"):
+        sent = await get_smtp_pool().send(messages[0])
+    if sent:
         L.debug(f"Message sent to {email}")
-        return True
-    except Exception as e:
-        L.error(e)
-    return False
+    return sent
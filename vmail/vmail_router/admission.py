@@ -0,0 +1,262 @@
+"""
+Adaptive concurrency limits per class of route.
+
+Routes are grouped by the dependency that dominates their latency: the
+``smtp`` class (``/register``) and the ``db`` class (the status and
+verification routes). settings.admission_limits sets the maximum number of
+requests of a class handled at once by a worker; a class without a limit is
+not limited. Requests over the limit wait in a bounded FIFO queue, and are
+rejected with 503 and Retry-After when the queue is full, when the wait they
+can expect exceeds admission_queue_timeout_seconds, or when they have waited
+that long.
+
+The limit of each class adapts to its latency, measured from admission to the
+end of the request, like the gradient limits of Netflix's concurrency-limits:
+while the short term latency stays within twice its long term average, the
+limit grows towards the maximum, and as it rises beyond, the limit shrinks in
+proportion. A slow SMTP relay therefore lowers the limit of /register without
+affecting the status routes, and requests stop piling up on the slow
+dependency while holding a database session each.
+
+Long polls (``/verified`` with a positive ``wait``) and event streams
+(``/verified/stream``, which has no class) are not limited, as they are
+bounded by verified_wait_max_waiters instead.
+"""
+import asyncio
+import collections
+import contextlib
+import math
+import typing
+
+from ..config import get_settings
+from . import metrics
+
+ROUTE_CLASSES = {
+    "/register": "smtp",
+    "/valid": "db",
+    "/valid/batch": "db",
+    "/verified": "db",
+    "/verified/batch": "db",
+    "/verify/{token}": "db",
+}
+
+ADMISSION_SHED = metrics.REGISTRY.register(
+    metrics.Counter(
+        "vmail_admission_shed_total",
+        "Requests rejected by admission control.",
+        ["route_class", "reason"],
+    )
+)
+
+
+def is_long_poll(route: str, wait: typing.Optional[str]) -> bool:
+    """
+    Return whether a request for route path with the wait query parameter
+    is a long poll, which admission control leaves alone.
+    """
+    if route != "/verified" or wait is None:
+        return False
+    try:
+        seconds = float(wait)
+    except ValueError:
+        return False
+    return 0 < seconds < math.inf
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request is not admitted.
+    """
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdaptiveLimiter:
+    def __init__(
+        self,
+        name: str,
+        max_limit: int,
+        min_limit: int = 1,
+        max_queue: int = 100,
+        queue_timeout_seconds: float = 5,
+        tolerance: float = 2.0,
+        smoothing: float = 0.2,
+    ):
+        """
+        Args:
+            name: Route class, for stats and metrics
+            max_limit: Maximum number of requests handled at once
+            min_limit: Minimum the limit shrinks to
+            max_queue: Maximum number of requests waiting for admission
+            queue_timeout_seconds: Longest a request may wait for admission
+            tolerance: Ratio of short to long term latency above which the
+                limit shrinks
+            smoothing: Weight of each update of the limit
+        """
+        self.name = name
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.limit = float(max_limit)
+        self.max_queue = max_queue
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.inflight = 0
+        self._queue: typing.Deque[asyncio.Future] = collections.deque()
+        # Exponential moving averages of latency, in seconds
+        self.latency: typing.Optional[float] = None
+        self.baseline: typing.Optional[float] = None
+        self.admitted = 0
+        self.queued_total = 0
+        self.shed: typing.Dict[str, int] = {"queue_full": 0, "deadline": 0, "timeout": 0}
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def expected_wait(self) -> float:
+        """
+        Seconds a request joining the queue now can expect to wait.
+        """
+        if self.latency is None:
+            return 0.0
+        return (len(self._queue) + 1) * self.latency / max(1.0, self.limit)
+
+    def _shed(self, reason: str, retry_after: float) -> Overloaded:
+        self.shed[reason] += 1
+        ADMISSION_SHED.inc(self.name, reason)
+        return Overloaded(reason, retry_after)
+
+    async def _admit(self):
+        if not self._queue and self.inflight < int(self.limit):
+            self.inflight += 1
+            self.admitted += 1
+            return
+        if len(self._queue) >= self.max_queue:
+            raise self._shed("queue_full", self.expected_wait())
+        wait = self.expected_wait()
+        if wait > self.queue_timeout_seconds:
+            raise self._shed("deadline", wait)
+        admission = asyncio.get_running_loop().create_future()
+        self._queue.append(admission)
+        self.queued_total += 1
+        try:
+            await asyncio.wait({admission}, timeout=self.queue_timeout_seconds)
+        except asyncio.CancelledError:
+            if admission.done():
+                self._release()
+            else:
+                self._queue.remove(admission)
+            raise
+        if not admission.done():
+            self._queue.remove(admission)
+            raise self._shed("timeout", self.expected_wait())
+        self.admitted += 1
+
+    def _release(self):
+        self.inflight -= 1
+        # Hand the freed slots to waiting requests, counting them in flight
+        # now so no new request takes them first
+        while self._queue and self.inflight < int(self.limit):
+            self._queue.popleft().set_result(None)
+            self.inflight += 1
+
+    def _observe(self, latency: float):
+        if self.latency is None:
+            self.latency = self.baseline = latency
+            return
+        self.latency += 0.1 * (latency - self.latency)
+        self.baseline += 0.01 * (self.latency - self.baseline)
+        # Only grow the limit when it is being used
+        if self.latency <= self.baseline * self.tolerance and self.inflight < self.limit / 2:
+            return
+        gradient = max(0.5, min(1.0, self.tolerance * self.baseline / self.latency))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        limit = self.limit * (1 - self.smoothing) + target * self.smoothing
+        self.limit = max(float(self.min_limit), min(float(self.max_limit), limit))
+
+    @contextlib.asynccontextmanager
+    async def acquire(self) -> typing.AsyncIterator[None]:
+        """
+        Hold one of the limiter's slots for the enclosed block.
+
+        Raises:
+            Overloaded if the request is rejected.
+        """
+        await self._admit()
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+        try:
+            yield
+        finally:
+            self._observe(loop.time() - t0)
+            self._release()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "max_limit": self.max_limit,
+            "inflight": self.inflight,
+            "queued": len(self._queue),
+            "queued_total": self.queued_total,
+            "admitted": self.admitted,
+            "latency_seconds": self.latency,
+            "baseline_seconds": self.baseline,
+            "shed": dict(self.shed),
+        }
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        limits: typing.Dict[str, int],
+        max_queue: int = 100,
+        queue_timeout_seconds: float = 5,
+        route_classes: typing.Dict[str, str] = ROUTE_CLASSES,
+    ):
+        self.route_classes = route_classes
+        self.limiters = {
+            name: AdaptiveLimiter(
+                name,
+                limit,
+                max_queue=max_queue,
+                queue_timeout_seconds=queue_timeout_seconds,
+            )
+            for name, limit in limits.items()
+        }
+
+    def limiter(self, route: str) -> typing.Optional[AdaptiveLimiter]:
+        """
+        Return the limiter for route path, or None if it is not limited.
+        """
+        return self.limiters.get(self.route_classes.get(route))
+
+    @property
+    def queued(self) -> int:
+        return sum(limiter.queued for limiter in self.limiters.values())
+
+    def stats(self) -> dict:
+        return {name: limiter.stats() for name, limiter in self.limiters.items()}
+
+
+ADMISSION = None
+
+
+def get_admission_controller() -> typing.Optional[AdmissionController]:
+    """
+    Return the configured admission controller, or None if no limits are set.
+    """
+    global ADMISSION
+    settings = get_settings()
+    if not settings.admission_limits:
+        return None
+    if ADMISSION is None:
+        ADMISSION = AdmissionController(
+            settings.admission_limits,
+            max_queue=settings.admission_queue_size,
+            queue_timeout_seconds=settings.admission_queue_timeout_seconds,
+        )
+    return ADMISSION
@@ -0,0 +1,284 @@
+"""
+In-process caching primitives.
+"""
+import collections
+import contextlib
+import time
+import typing
+
+from ..config import get_settings
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded LRU cache with a time to live per entry.
+
+    Entries are evicted least recently used first once max_entries is reached,
+    and are treated as absent once expired.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: typing.Hashable, default: typing.Any = MISSING) -> typing.Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: typing.Hashable, value: typing.Any, ttl: typing.Optional[float] = None):
+        if ttl is None:
+            ttl = self.ttl
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, key: typing.Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class CacheBackend(typing.Protocol):
+    """
+    Storage for StatusCache entries. Implementations shared between processes
+    (e.g. RedisBackend) let several workers see each other's invalidations.
+    """
+
+    async def get(self, key: str) -> typing.Optional[int]:
+        ...
+
+    async def set(self, key: str, value: int, ttl: float):
+        ...
+
+    async def delete(self, key: str):
+        ...
+
+    async def get_many(self, keys: typing.Sequence[str]) -> typing.List[typing.Optional[int]]:
+        ...
+
+    async def set_many(self, items: typing.Mapping[str, int], ttl: float):
+        ...
+
+    async def delete_many(self, keys: typing.Sequence[str]):
+        ...
+
+
+class LocalBackend:
+    """
+    In-process backend. A single instance may be handed to several
+    StatusCache objects to stand in for a shared backend in tests.
+    """
+
+    def __init__(self, max_entries: int = 100000):
+        self._cache = TTLCache(max_entries=max_entries)
+
+    async def get(self, key: str) -> typing.Optional[int]:
+        return self._cache.get(key, None)
+
+    async def set(self, key: str, value: int, ttl: float):
+        self._cache.set(key, value, ttl=ttl)
+
+    async def delete(self, key: str):
+        self._cache.delete(key)
+
+    async def get_many(self, keys: typing.Sequence[str]) -> typing.List[typing.Optional[int]]:
+        return [self._cache.get(key, None) for key in keys]
+
+    async def set_many(self, items: typing.Mapping[str, int], ttl: float):
+        for key, value in items.items():
+            self._cache.set(key, value, ttl=ttl)
+
+    async def delete_many(self, keys: typing.Sequence[str]):
+        for key in keys:
+            self._cache.delete(key)
+
+
+class RedisBackend:
+    """
+    Backend shared between workers through Redis. Requires the redis package.
+    """
+
+    def __init__(self, url: str, prefix: str = "vmail:status:"):
+        import redis.asyncio
+
+        self._redis = redis.asyncio.from_url(url)
+        self._prefix = prefix
+
+    async def get(self, key: str) -> typing.Optional[int]:
+        value = await self._redis.get(self._prefix + key)
+        return None if value is None else int(value)
+
+    async def set(self, key: str, value: int, ttl: float):
+        await self._redis.set(self._prefix + key, value, px=int(ttl * 1000))
+
+    async def delete(self, key: str):
+        await self._redis.delete(self._prefix + key)
+
+    async def get_many(self, keys: typing.Sequence[str]) -> typing.List[typing.Optional[int]]:
+        if not keys:
+            return []
+        values = await self._redis.mget([self._prefix + key for key in keys])
+        return [None if value is None else int(value) for value in values]
+
+    async def set_many(self, items: typing.Mapping[str, int], ttl: float):
+        if not items:
+            return
+        pipeline = self._redis.pipeline(transaction=False)
+        for key, value in items.items():
+            pipeline.set(self._prefix + key, value, px=int(ttl * 1000))
+        await pipeline.execute()
+
+    async def delete_many(self, keys: typing.Sequence[str]):
+        if keys:
+            await self._redis.delete(*[self._prefix + key for key in keys])
+
+
+class Fill:
+    """
+    Keys being loaded into a StatusCache. Keys invalidated while the load
+    runs are marked stale, as the loaded state may predate the change.
+    """
+
+    def __init__(self, keys: typing.Sequence[str]):
+        self.keys = keys
+        self.stale: typing.Set[str] = set()
+
+
+class StatusCache:
+    """
+    Cache of hashed address to verification state.
+
+    Addresses that are not registered are cached as NOT_FOUND so repeated
+    status checks of unknown addresses are also served from the cache.
+
+    Entries are stored with fill() inside filling(), which drops the keys
+    invalidated by this process between the database read and the store.
+    """
+
+    NOT_FOUND = -1
+
+    def __init__(self, backend: CacheBackend, ttl: float = 60):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stale_fills = 0
+        self._fills: typing.Dict[str, typing.List[Fill]] = {}
+
+    async def get(self, key: str) -> typing.Optional[int]:
+        value = await self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def get_many(self, keys: typing.Sequence[str]) -> typing.List[typing.Optional[int]]:
+        """
+        Return the cached states of keys in one backend round trip, None for
+        keys that are not cached.
+        """
+        values = await self.backend.get_many(keys)
+        n_misses = values.count(None)
+        self.misses += n_misses
+        self.hits += len(values) - n_misses
+        return values
+
+    async def set(self, key: str, value: int):
+        await self.backend.set(key, value, self.ttl)
+
+    async def set_many(self, items: typing.Mapping[str, int]):
+        await self.backend.set_many(items, self.ttl)
+
+    @contextlib.contextmanager
+    def filling(self, keys: typing.Sequence[str]) -> typing.Iterator[Fill]:
+        """
+        Track a load of keys, to be entered before the database is read.
+        """
+        fill = Fill(keys)
+        for key in keys:
+            self._fills.setdefault(key, []).append(fill)
+        try:
+            yield fill
+        finally:
+            for key in keys:
+                fills = self._fills[key]
+                fills.remove(fill)
+                if not fills:
+                    del self._fills[key]
+
+    async def fill(self, fill: Fill, items: typing.Mapping[str, int]):
+        """
+        Store the loaded states of items, except for the keys invalidated
+        since fill was started.
+        """
+        if fill.stale:
+            self.stale_fills += len(fill.stale.intersection(items))
+            items = {key: value for key, value in items.items() if key not in fill.stale}
+        if len(items) == 1:
+            [(key, value)] = items.items()
+            await self.backend.set(key, value, self.ttl)
+        elif items:
+            await self.backend.set_many(items, self.ttl)
+
+    def _mark_stale(self, key: str):
+        for fill in self._fills.get(key, ()):
+            fill.stale.add(key)
+
+    async def invalidate(self, key: str):
+        self.invalidations += 1
+        self._mark_stale(key)
+        await self.backend.delete(key)
+
+    async def invalidate_many(self, keys: typing.Sequence[str]):
+        self.invalidations += len(keys)
+        for key in keys:
+            self._mark_stale(key)
+        await self.backend.delete_many(keys)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "stale_fills": self.stale_fills,
+        }
+
+
+STATUS_CACHE = None
+
+
+def get_status_cache() -> typing.Optional[StatusCache]:
+    """
+    Return the configured status cache, or None if caching is disabled.
+    """
+    global STATUS_CACHE
+    settings = get_settings()
+    if not settings.status_cache_enabled:
+        return None
+    if STATUS_CACHE is None:
+        if settings.status_cache_url:
+            backend = RedisBackend(settings.status_cache_url)
+        else:
+            backend = LocalBackend(max_entries=settings.status_cache_size)
+        STATUS_CACHE = StatusCache(backend, ttl=settings.status_cache_ttl)
+    return STATUS_CACHE
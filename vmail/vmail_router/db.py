@@ -2,20 +2,269 @@
 Database definition for vmail application
 """
 import time
+import typing
 
+import sqlalchemy
+import sqlalchemy.engine
+import sqlalchemy.ext.asyncio
 import sqlalchemy.orm
+import sqlalchemy.pool
+
+from . import metrics
+from . import profiling
 
 SQL_BASE = sqlalchemy.orm.declarative_base()
 
+# Map synchronous driver names to their asyncio counterparts.
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "sqlite+pysqlite": "aiosqlite",
+    "postgresql": "psycopg",
+    "postgresql+psycopg2": "psycopg",
+}
+
+
+def async_connection_string(connection_string: str) -> str:
+    """
+    Return the connection string with an asyncio capable driver.
+
+    Connection strings that already name an async driver (e.g. sqlite+aiosqlite,
+    postgresql+psycopg) are returned unchanged.
+    """
+    url = sqlalchemy.engine.make_url(connection_string)
+    driver = ASYNC_DRIVERS.get(url.drivername)
+    if driver is None:
+        return connection_string
+    url = url.set(drivername=f"{url.get_backend_name()}+{driver}")
+    return url.render_as_string(hide_password=False)
+
+
+class PoolStats:
+    """
+    Counters describing connection pool usage.
+
+    Wait time covers the full checkout, including opening a new DBAPI
+    connection when the pool has none idle.
+    """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.overflow_max = 0
+
+    def as_dict(self, pool: typing.Optional[sqlalchemy.pool.QueuePool] = None) -> dict:
+        result = {
+            "checkouts": self.checkouts,
+            "wait_seconds_total": self.wait_seconds_total,
+            "wait_seconds_max": self.wait_seconds_max,
+            "wait_seconds_mean": (
+                self.wait_seconds_total / self.checkouts if self.checkouts else 0.0
+            ),
+            "overflow_max": self.overflow_max,
+        }
+        if pool is not None:
+            result.update(
+                {
+                    "size": pool.size(),
+                    "checked_out": pool.checkedout(),
+                    "overflow": pool.overflow(),
+                }
+            )
+        return result
+
+
+class InstrumentedPool(sqlalchemy.pool.AsyncAdaptedQueuePool):
+    """
+    AsyncAdaptedQueuePool that records checkout counts, wait time and overflow.
+    """
+
+    # SQLAlchemy names a pool's logger after its class; keep the pool's
+    # echo_pool and debug output under sqlalchemy.pool, where the logging
+    # configuration of SQLAlchemy applies to it
+    _sqla_logger_namespace = "sqlalchemy.pool.impl.AsyncAdaptedQueuePool"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def connect(self):
+        t0 = time.perf_counter()
+        connection = super().connect()
+        elapsed = time.perf_counter() - t0
+        stats = self.stats
+        stats.checkouts += 1
+        stats.wait_seconds_total += elapsed
+        stats.wait_seconds_max = max(stats.wait_seconds_max, elapsed)
+        stats.overflow_max = max(stats.overflow_max, self.overflow())
+        metrics.DB_POOL_WAIT_SECONDS.observe(elapsed)
+        profiling.record("pool", elapsed)
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+def create_engine(
+    connection_string: str,
+    pool_size: int = 5,
+    max_overflow: int = 10,
+    pool_recycle: int = -1,
+    pool_timeout: float = 30.0,
+    pool_pre_ping: bool = False,
+    compact_schema: bool = False,
+    **kwargs,
+) -> sqlalchemy.ext.asyncio.AsyncEngine:
+    """
+    Create an AsyncEngine for the provided connection string.
+
+    Pool sizing options only apply to dialects that use a queue pool; in-memory
+    SQLite for example uses a single static connection.
+
+    compact_schema selects the layout the Key and Time columns of the email
+    table are read and written in through this engine, normally
+    settings.db_compact_schema.
+    """
+    url = sqlalchemy.engine.make_url(async_connection_string(connection_string))
+    pool_class = url.get_dialect().get_pool_class(url)
+    if issubclass(pool_class, sqlalchemy.pool.QueuePool):
+        kwargs.update(
+            poolclass=InstrumentedPool,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=pool_timeout,
+        )
+    engine = sqlalchemy.ext.asyncio.create_async_engine(
+        url, pool_recycle=pool_recycle, pool_pre_ping=pool_pre_ping, **kwargs
+    )
+    # Each engine has its own dialect, which the column types receive
+    engine.dialect.vmail_compact_schema = compact_schema
+    return engine
+
+
+def pool_stats(engine: sqlalchemy.ext.asyncio.AsyncEngine) -> typing.Optional[dict]:
+    """
+    Return pool usage for engine, or None if the pool is not instrumented.
+    """
+    pool = engine.pool
+    if not isinstance(pool, InstrumentedPool):
+        return None
+    return pool.stats.as_dict(pool)
+
+
+def pack_key(key: str) -> bytes:
+    """
+    Binary form of an address key: the digest, preceded by the scheme
+    version byte for keys of scheme 1 and later.
+    """
+    prefix, sep, digest = key.rpartition(":")
+    if not sep:
+        return bytes.fromhex(digest)
+    return bytes([int(prefix)]) + bytes.fromhex(digest)
+
+
+def unpack_key(value: bytes) -> str:
+    """
+    Address key of a value written by pack_key.
+    """
+    # Digests are 32 bytes, so an odd length means a scheme byte
+    if len(value) % 2:
+        return f"{value[0]}:{value[1:].hex()}"
+    return value.hex()
+
+
+def compact_schema(dialect: sqlalchemy.engine.Dialect) -> bool:
+    """
+    Return whether the engine of dialect uses the compact layout, as set by
+    create_engine.
+    """
+    return getattr(dialect, "vmail_compact_schema", False)
+
+
+class Key(sqlalchemy.types.TypeDecorator):
+    """
+    Address key, stored as text or, with the compact schema, as the bytes of
+    pack_key.
+    """
+
+    impl = sqlalchemy.types.String
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if compact_schema(dialect):
+            return dialect.type_descriptor(sqlalchemy.types.LargeBinary(33))
+        return dialect.type_descriptor(sqlalchemy.types.String())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not compact_schema(dialect):
+            return value
+        return pack_key(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None or not compact_schema(dialect):
+            return value
+        return unpack_key(bytes(value))
+
+
+class Time(sqlalchemy.types.TypeDecorator):
+    """
+    Epoch time in seconds, stored as a float or, with the compact schema, as
+    a whole number of seconds.
+    """
+
+    impl = sqlalchemy.types.Float
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if compact_schema(dialect):
+            return dialect.type_descriptor(sqlalchemy.types.BigInteger())
+        return dialect.type_descriptor(sqlalchemy.types.Float())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not compact_schema(dialect):
+            return value
+        return int(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return value
+        return float(value)
+
+
+def key_order(key: str, compact: bool) -> typing.Union[str, bytes]:
+    """
+    Sort key giving address keys the order the database compares them in,
+    compact telling whether it uses the compact layout.
+    """
+    return pack_key(key) if compact else key
+
+
 class Email(SQL_BASE):
     """
     Implements SQLAlchemy ORM for storing hashed email addresses for verification.
     """
 
     __tablename__ = "email"
+    __table_args__ = (
+        sqlalchemy.Index(
+            "ix_email_token",
+            "token",
+            sqlite_where=sqlalchemy.text("token IS NOT NULL"),
+            postgresql_where=sqlalchemy.text("token IS NOT NULL"),
+        ),
+        sqlalchemy.Index("ix_email_trequested_tverified", "trequested", "tverified"),
+        sqlalchemy.Index(
+            "ix_email_unverified_tlast",
+            sqlalchemy.text("coalesce(trequested, tcreated)"),
+            sqlite_where=sqlalchemy.text("tverified IS NULL"),
+            postgresql_where=sqlalchemy.text("tverified IS NULL"),
+        ),
+    )
 
     address: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
-        doc="Hash of email address", primary_key=True
+        Key, doc="Hash of email address", primary_key=True
     )
 
     token: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
@@ -25,19 +274,94 @@ class Email(SQL_BASE):
     )
 
     tcreated: sqlalchemy.orm.Mapped[float] = sqlalchemy.orm.mapped_column(
-        sqlalchemy.types.Float, doc="Time when entry was created", default=time.time
+        Time, doc="Time when entry was created", default=time.time
     )
 
     trequested: sqlalchemy.orm.Mapped[float] = sqlalchemy.orm.mapped_column(
-        sqlalchemy.types.Float,
+        Time,
         doc="Time when a request to verify was sent, NULL if unsent",
         nullable=True,
         default=None,
     )
 
     tverified: sqlalchemy.orm.Mapped[float] = sqlalchemy.orm.mapped_column(
-        sqlalchemy.types.Float,
+        Time,
         doc="Time when entry was verified or NULL for unverified",
         nullable=True,
         default=None,
     )
+
+
+class SchemaVersion(SQL_BASE):
+    """
+    Records the schema migrations applied to the database.
+    """
+
+    __tablename__ = "schema_version"
+
+    version: sqlalchemy.orm.Mapped[int] = sqlalchemy.orm.mapped_column(
+        doc="Migration version number", primary_key=True, autoincrement=False
+    )
+
+    description: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
+        doc="Summary of the migration", nullable=True, default=None
+    )
+
+    tapplied: sqlalchemy.orm.Mapped[float] = sqlalchemy.orm.mapped_column(
+        sqlalchemy.types.Float, doc="Time when migration was applied", default=time.time
+    )
+
+
+class Outbox(SQL_BASE):
+    """
+    Verification emails waiting to be sent.
+
+    Unlike the email table this holds the plain text recipient address, so
+    rows are deleted once the message has been delivered to the SMTP server
+    or has exhausted its retries.
+    """
+
+    __tablename__ = "outbox"
+    __table_args__ = (sqlalchemy.Index("ix_outbox_tnext", "tnext"),)
+
+    id: sqlalchemy.orm.Mapped[int] = sqlalchemy.orm.mapped_column(
+        primary_key=True, autoincrement=True
+    )
+
+    recipient: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
+        doc="Email address the message is sent to"
+    )
+
+    token: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
+        doc="One time passcode included in the message"
+    )
+
+    url: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
+        doc="Verification URL included in the message"
+    )
+
+    name: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
+        doc="Recipient name", nullable=True, default=None
+    )
+
+    app_name: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
+        doc="Name of the application requesting verification", nullable=True, default=None
+    )
+
+    attempts: sqlalchemy.orm.Mapped[int] = sqlalchemy.orm.mapped_column(
+        doc="Number of send attempts made", default=0
+    )
+
+    tcreated: sqlalchemy.orm.Mapped[float] = sqlalchemy.orm.mapped_column(
+        sqlalchemy.types.Float, doc="Time when the message was queued", default=time.time
+    )
+
+    tnext: sqlalchemy.orm.Mapped[float] = sqlalchemy.orm.mapped_column(
+        sqlalchemy.types.Float,
+        doc="Time after which the message may be (re)tried",
+        default=time.time,
+    )
+
+    last_error: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
+        doc="Error from the most recent failed attempt", nullable=True, default=None
+    )
@@ -0,0 +1,200 @@
+"""
+Asynchronous, cached domain deliverability checks.
+
+This follows the checks made by email_validator with check_deliverability
+enabled (MX, falling back to globally reachable A / AAAA records, and a
+reject-all SPF policy), but resolves without blocking the event loop and
+caches the outcome per domain.
+"""
+import asyncio
+import ipaddress
+import logging
+import time
+import typing
+
+from . import cache
+from . import metrics
+from . import singleflight
+from ..config import get_settings
+
+L = logging.getLogger("vmail.deliverability")
+
+
+class AsyncResolver(typing.Protocol):
+    """
+    Interface of the resolver used for lookups, satisfied by
+    dns.asyncresolver.Resolver. A stub implementing resolve() can be
+    provided for testing.
+    """
+
+    async def resolve(self, qname: str, rdtype: str) -> typing.Iterable:
+        ...
+
+
+class DomainStatus(typing.NamedTuple):
+    # True unless the domain is known not to accept email
+    deliverable: bool
+    # Reason the domain is undeliverable, or the reason deliverability is unknown.
+    # Cached entries hold a template with a {domain} placeholder.
+    message: typing.Optional[str] = None
+
+
+def _is_global_addr(address: str) -> bool:
+    try:
+        return ipaddress.ip_address(address).is_global
+    except ValueError:
+        return False
+
+
+class DomainResolver:
+    """
+    Checks domain deliverability with a per-domain TTL cache.
+
+    Undeliverable domains (NXDOMAIN, no MX or address records, null MX) are
+    cached for negative_ttl. Inconclusive lookups (timeouts, no answering name
+    servers) are reported deliverable, as email_validator does, and are not
+    cached. Concurrent checks of the same domain share a single lookup.
+    """
+
+    def __init__(
+        self,
+        resolver: typing.Optional[AsyncResolver] = None,
+        ttl: float = 3600,
+        negative_ttl: float = 300,
+        max_entries: int = 10000,
+        timeout: float = 5,
+    ):
+        if resolver is None:
+            # dnspython is imported here rather than with the module, it
+            # is a large part of application startup
+            import dns.asyncresolver
+
+            resolver = dns.asyncresolver.Resolver()
+            resolver.lifetime = timeout
+        self._resolver = resolver
+        self._negative_ttl = negative_ttl
+        self._cache = cache.TTLCache(max_entries=max_entries, ttl=ttl)
+        self._inflight = singleflight.SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.lookups = 0
+        self.lookup_errors = 0
+        self.lookup_seconds_total = 0.0
+        self.lookup_seconds_max = 0.0
+
+    async def check(self, domain: str, domain_i18n: typing.Optional[str] = None) -> DomainStatus:
+        """
+        Return the deliverability of domain (the ASCII form of the domain name).
+
+        domain_i18n is the form used in messages, defaults to domain.
+        """
+        domain = domain.lower()
+        status = self._cache.get(domain)
+        if status is not cache.MISSING:
+            self.hits += 1
+        else:
+            self.misses += 1
+            status = await self._inflight.do(domain, lambda: self._lookup(domain))
+        if status.message is not None:
+            status = status._replace(message=status.message.format(domain=domain_i18n or domain))
+        return status
+
+    async def prewarm(self, domains: typing.Iterable[str]):
+        """
+        Populate the cache for domains, e.g. common providers, at startup.
+        """
+        domains = list(domains)
+        await asyncio.gather(*[self.check(domain) for domain in domains])
+        L.info("Prewarmed deliverability cache with %s domains", len(domains))
+
+    def stats(self) -> dict:
+        checks = self.hits + self.misses
+        return {
+            "entries": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / checks if checks else 0.0,
+            "coalesced": self._inflight.coalesced,
+            "lookups": self.lookups,
+            "lookup_errors": self.lookup_errors,
+            "lookup_seconds_total": self.lookup_seconds_total,
+            "lookup_seconds_max": self.lookup_seconds_max,
+            "lookup_seconds_mean": (
+                self.lookup_seconds_total / self.lookups if self.lookups else 0.0
+            ),
+        }
+
+    async def _lookup(self, domain: str) -> DomainStatus:
+        t0 = time.perf_counter()
+        try:
+            status = await self._resolve(domain)
+        finally:
+            elapsed = time.perf_counter() - t0
+            self.lookups += 1
+            self.lookup_seconds_total += elapsed
+            self.lookup_seconds_max = max(self.lookup_seconds_max, elapsed)
+            metrics.DNS_LOOKUP_SECONDS.observe(elapsed)
+        if status.deliverable and status.message is not None:
+            self.lookup_errors += 1
+        elif status.deliverable:
+            self._cache.set(domain, status)
+        else:
+            self._cache.set(domain, status, ttl=self._negative_ttl)
+        return status
+
+    async def _resolve_any(self, domain: str, rdtype: str) -> typing.List:
+        import dns.resolver
+
+        try:
+            return list(await self._resolver.resolve(domain, rdtype))
+        except dns.resolver.NoAnswer:
+            return []
+
+    async def _resolve(self, domain: str) -> DomainStatus:
+        import dns.exception
+        import dns.resolver
+
+        try:
+            mx = await self._resolve_any(domain, "MX")
+            if mx:
+                # RFC 7505: a null MX record means the domain accepts no email
+                if all(str(r.exchange).rstrip(".") == "" for r in mx):
+                    return DomainStatus(False, "The domain name {domain} does not accept email.")
+                return DomainStatus(True)
+            # No MX, fall back to a globally reachable A or AAAA record
+            reachable = False
+            for rdtype in ("A", "AAAA"):
+                if any(_is_global_addr(r.address) for r in await self._resolve_any(domain, rdtype)):
+                    reachable = True
+                    break
+            if not reachable:
+                return DomainStatus(False, "The domain name {domain} does not accept email.")
+            for r in await self._resolve_any(domain, "TXT"):
+                if b"".join(r.strings) == b"v=spf1 -all":
+                    return DomainStatus(False, "The domain name {domain} does not send email.")
+            return DomainStatus(True)
+        except dns.resolver.NXDOMAIN:
+            return DomainStatus(False, "The domain name {domain} does not exist.")
+        except dns.resolver.NoNameservers:
+            return DomainStatus(True, "no_nameservers")
+        except dns.exception.Timeout:
+            return DomainStatus(True, "timeout")
+        except Exception as e:
+            L.error("Deliverability check of %s failed: %s", domain, e)
+            return DomainStatus(True, "lookup_error")
+
+
+RESOLVER = None
+
+
+def get_resolver() -> DomainResolver:
+    global RESOLVER
+    if RESOLVER is None:
+        settings = get_settings()
+        RESOLVER = DomainResolver(
+            ttl=settings.dns_cache_ttl,
+            negative_ttl=settings.dns_negative_ttl,
+            max_entries=settings.dns_cache_size,
+            timeout=settings.dns_timeout,
+        )
+    return RESOLVER
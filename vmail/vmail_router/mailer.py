@@ -0,0 +1,183 @@
+"""
+Pooled SMTP connections for sending verification emails.
+
+Opening an SMTP session costs a TCP connect, possibly a TLS handshake and an
+AUTH exchange. SMTPPool keeps up to size authenticated sessions open and
+reuses them across messages. Sessions idle for longer than idle_timeout are
+closed rather than reused, and a session dropped by the server is replaced
+transparently.
+"""
+import asyncio
+import collections
+import email.message
+import logging
+import time
+import typing
+
+from . import metrics
+
+if typing.TYPE_CHECKING:
+    # Imported on first connect, to keep it out of application startup
+    import aiosmtplib
+
+L = logging.getLogger("vmail.mailer")
+
+
+class RawMessage(typing.NamedTuple):
+    """
+    A message already serialized for sending.
+    """
+
+    sender: str
+    recipients: typing.List[str]
+    data: bytes
+
+
+Message = typing.Union[email.message.Message, RawMessage]
+
+
+class SMTPPool:
+    def __init__(
+        self,
+        hostname: str,
+        port: int,
+        username: typing.Optional[str] = None,
+        password: typing.Optional[str] = None,
+        use_tls: bool = False,
+        start_tls: bool = False,
+        validate_certs: bool = True,
+        size: int = 4,
+        idle_timeout: float = 60,
+        timeout: float = 60,
+    ):
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.start_tls = start_tls
+        self.validate_certs = validate_certs
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle: typing.Deque[typing.Tuple["aiosmtplib.SMTP", float]] = collections.deque()
+        self._semaphore = None
+        self.connects = 0
+        self.reconnects = 0
+        self.sent = 0
+        self.failures = 0
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "idle": len(self._idle),
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "sent": self.sent,
+            "failures": self.failures,
+        }
+
+    async def _connect(self) -> "aiosmtplib.SMTP":
+        import aiosmtplib
+
+        smtp = aiosmtplib.SMTP(
+            hostname=self.hostname,
+            port=self.port,
+            use_tls=self.use_tls,
+            start_tls=self.start_tls,
+            validate_certs=self.validate_certs,
+            timeout=self.timeout,
+        )
+        await smtp.connect()
+        if self.username is not None:
+            await smtp.login(self.username, self.password)
+        self.connects += 1
+        return smtp
+
+    @staticmethod
+    async def _close(smtp: "aiosmtplib.SMTP"):
+        try:
+            await smtp.quit()
+        except Exception:
+            smtp.close()
+
+    async def _acquire(self) -> "aiosmtplib.SMTP":
+        now = time.monotonic()
+        while self._idle:
+            smtp, last_used = self._idle.pop()
+            if smtp.is_connected and now - last_used < self.idle_timeout:
+                return smtp
+            await self._close(smtp)
+        return await self._connect()
+
+    def _release(self, smtp: "aiosmtplib.SMTP"):
+        self._idle.append((smtp, time.monotonic()))
+
+    @staticmethod
+    async def _transmit(smtp: "aiosmtplib.SMTP", message: Message):
+        if isinstance(message, RawMessage):
+            await smtp.sendmail(message.sender, message.recipients, message.data)
+        else:
+            await smtp.send_message(message)
+
+    async def _send(self, smtp: "aiosmtplib.SMTP", message: Message) -> "aiosmtplib.SMTP":
+        """
+        Send message on smtp, reconnecting once if the server dropped the session.
+
+        Returns the session that was used.
+        """
+        import aiosmtplib
+
+        try:
+            await self._transmit(smtp, message)
+        except (aiosmtplib.SMTPServerDisconnected, ConnectionError):
+            L.debug("SMTP session closed by server, reconnecting")
+            self.reconnects += 1
+            smtp.close()
+            smtp = await self._connect()
+            await self._transmit(smtp, message)
+        return smtp
+
+    async def send_many(self, messages: typing.Sequence[Message]) -> typing.List[bool]:
+        """
+        Send messages in order over a single pooled session.
+
+        Returns:
+            Success of each message.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+        results = []
+        async with self._semaphore:
+            smtp = None
+            for message in messages:
+                t0 = time.perf_counter()
+                try:
+                    if smtp is None:
+                        smtp = await self._acquire()
+                    smtp = await self._send(smtp, message)
+                    self.sent += 1
+                    results.append(True)
+                    metrics.SMTP_SEND_SECONDS.observe(time.perf_counter() - t0, "sent")
+                except Exception as e:
+                    metrics.SMTP_SEND_SECONDS.observe(time.perf_counter() - t0, "failed")
+                    recipients = (
+                        message.recipients if isinstance(message, RawMessage) else message["To"]
+                    )
+                    L.error("Sending to %s failed: %s", recipients, e)
+                    self.failures += 1
+                    results.append(False)
+                    if smtp is not None:
+                        smtp.close()
+                        smtp = None
+            if smtp is not None:
+                self._release(smtp)
+        return results
+
+    async def send(self, message: Message) -> bool:
+        return (await self.send_many([message]))[0]
+
+    async def close(self):
+        while self._idle:
+            smtp, _ = self._idle.pop()
+            await self._close(smtp)
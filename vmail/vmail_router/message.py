@@ -0,0 +1,151 @@
+"""
+Rendering of verification emails.
+
+The Jinja template is compiled once and the parts of the MIME message that
+are the same for every recipient (structure, sender, subject, part headers)
+are serialized once. Rendering a message then only substitutes the recipient
+fields into the template and assembles bytes ready for SMTP.
+"""
+import base64
+import email.header
+import email.utils
+import re
+import socket
+import typing
+import uuid
+
+from .mailer import RawMessage
+
+if typing.TYPE_CHECKING:
+    # Imported when the template is compiled, to keep it out of application startup
+    import jinja2
+
+CRLF = "\r\n"
+
+
+# Characters that require a display name to be quoted, as in email.utils.formataddr
+_SPECIALS = re.compile(r'[][\\()<>@,:;".]')
+
+
+def _header(value: str) -> str:
+    if value.isascii():
+        return value
+    return email.header.Header(value, "utf-8").encode(linesep=CRLF)
+
+
+def _address(name: typing.Optional[str], address: str) -> str:
+    """
+    Format an address header value. Only the display name is RFC 2047
+    encoded; the address is kept as is, so a non-ASCII address is sent in
+    UTF-8 for SMTPUTF8, which email.utils.formataddr refuses.
+    """
+    if name is not None:
+        # Line breaks in a display name would start a new header
+        name = " ".join(name.split())
+    if not name:
+        return address
+    if not name.isascii():
+        name = _header(name)
+    elif _SPECIALS.search(name):
+        name = f'"{email.utils.quote(name)}"'
+    return f"{name} <{address}>"
+
+
+class VerificationTemplate:
+    def __init__(
+        self,
+        template_path: str,
+        sender: str,
+        sender_name: typing.Optional[str] = None,
+        subject: str = "Fastapi-Mail module",
+        template_name: str = "verify_email.html",
+        auto_reload: bool = False,
+    ):
+        """
+        Args:
+            template_path: Folder containing the template
+            sender: Envelope and From address
+            sender_name: Display name for the From address
+            subject: Message subject
+            template_name: Name of the HTML template in template_path
+            auto_reload: Check the template file for changes on each render,
+                for development
+        """
+        self.sender = sender
+        self.template_name = template_name
+        self.auto_reload = auto_reload
+        import jinja2
+
+        self._env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(template_path),
+            autoescape=True,
+            auto_reload=auto_reload,
+        )
+        self._template = self._env.get_template(template_name)
+        # make_msgid() would otherwise look up the host name for every message
+        self._msgid_domain = socket.getfqdn()
+        boundary = f"=============vmail{uuid.uuid4().hex}=="
+        self._head = CRLF.join(
+            [
+                f'Content-Type: multipart/mixed; charset="utf-8"; boundary="{boundary}"',
+                "MIME-Version: 1.0",
+                f"From: {_address(sender_name, sender)}",
+                f"Subject: {_header(subject)}",
+                "",
+            ]
+        ).encode("utf-8")
+        self._body_head = CRLF.join(
+            [
+                "",
+                f"--{boundary}",
+                'Content-Type: text/html; charset="utf-8"',
+                "MIME-Version: 1.0",
+                "Content-Transfer-Encoding: base64",
+                "",
+                "",
+            ]
+        ).encode("ascii")
+        self._tail = f"{CRLF}--{boundary}--{CRLF}".encode("ascii")
+
+    @property
+    def template(self) -> "jinja2.Template":
+        if self.auto_reload:
+            # Returns the cached template unless the file has changed
+            self._template = self._env.get_template(self.template_name)
+        return self._template
+
+    def render(
+        self,
+        recipient: str,
+        otp: str,
+        url: str,
+        name: typing.Optional[str] = None,
+        app_name: typing.Optional[str] = None,
+    ) -> RawMessage:
+        """
+        Render the verification message for recipient, addressed to name if
+        given.
+        """
+        to = _address(name, recipient)
+        if name is None:
+            name = recipient
+        if app_name is None:
+            app_name = ""
+        body = self.template.render(
+            name=name,
+            email=recipient,
+            url=url,
+            otp=otp,
+            application_name=app_name,
+        )
+        headers = CRLF.join(
+            [
+                f"Date: {email.utils.formatdate(localtime=True)}",
+                f"Message-ID: {email.utils.make_msgid(domain=self._msgid_domain)}",
+                f"To: {to}",
+                "",
+            ]
+        ).encode("utf-8")
+        encoded = base64.encodebytes(body.encode("utf-8")).replace(b"\n", b"\r\n")
+        data = b"".join([self._head, headers, self._body_head, encoded, self._tail])
+        return RawMessage(sender=self.sender, recipients=[recipient], data=data)
@@ -0,0 +1,201 @@
+"""
+Minimal metrics registry rendered in the Prometheus text exposition format.
+
+Metrics are module level and updated in-process; each worker reports its own
+values, which Prometheus aggregates. Observing a value is a dict lookup and a
+few additions, so instrumentation can stay on the hot path.
+"""
+import bisect
+import time
+import typing
+
+import sqlalchemy
+import sqlalchemy.ext.asyncio
+
+# Upper bounds in seconds, from sub-millisecond database queries to
+# multi-second SMTP sends and DNS timeouts.
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _labels(names: typing.Sequence[str], values: typing.Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: typing.Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: typing.Dict[tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> typing.List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: typing.Sequence[str] = (),
+        buckets: typing.Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket..., count above the last bucket, sum]
+        self._values: typing.Dict[tuple, typing.List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> typing.List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ("le",)
+        for labels, series in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket{_labels(names, labels + (bound,))} {cumulative}"
+                )
+            label_text = _labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {series[-1]}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """
+    Gauge read from a callback when metrics are rendered, for values that are
+    already tracked elsewhere (e.g. pool size).
+    """
+
+    def __init__(self, name: str, documentation: str, fn: typing.Callable[[], typing.Optional[float]]):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+
+    def render(self) -> typing.List[str]:
+        value = self.fn()
+        if value is None:
+            return []
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {value}",
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: typing.Dict[str, typing.Any] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.register(
+    Histogram("vmail_http_request_seconds", "Request latency by route.", ["method", "route"])
+)
+HTTP_RESPONSES = REGISTRY.register(
+    Counter("vmail_http_responses_total", "Responses by route and status code.", ["method", "route", "status"])
+)
+DB_QUERY_SECONDS = REGISTRY.register(
+    Histogram("vmail_db_query_seconds", "Duration of SQL statements.")
+)
+DB_POOL_WAIT_SECONDS = REGISTRY.register(
+    Histogram("vmail_db_pool_wait_seconds", "Time to check out a pooled database connection.")
+)
+SMTP_SEND_SECONDS = REGISTRY.register(
+    Histogram("vmail_smtp_send_seconds", "Duration of sending one message over SMTP.", ["result"])
+)
+DNS_LOOKUP_SECONDS = REGISTRY.register(
+    Histogram("vmail_dns_lookup_seconds", "Duration of uncached domain deliverability lookups.")
+)
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    DB_QUERY_SECONDS.observe(time.perf_counter() - connection.info["query_start"].pop())
+
+
+def _handle_error(context):
+    starts = context.connection.info.get("query_start") if context.connection else None
+    if starts:
+        DB_QUERY_SECONDS.observe(time.perf_counter() - starts.pop())
+
+
+def instrument_engine(engine: sqlalchemy.ext.asyncio.AsyncEngine):
+    """
+    Record the count and duration of statements executed by engine.
+    """
+    sync_engine = engine.sync_engine
+    if sqlalchemy.event.contains(sync_engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    sqlalchemy.event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    sqlalchemy.event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+    sqlalchemy.event.listen(sync_engine, "handle_error", _handle_error)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency and status code of each HTTP request,
+    labelled with the route path template so label cardinality stays bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        t0 = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - t0
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            HTTP_REQUEST_SECONDS.observe(elapsed, scope["method"], path)
+            HTTP_RESPONSES.inc(scope["method"], path, str(status[0]))
@@ -0,0 +1,248 @@
+"""
+Versioned schema migrations for the vmail database.
+
+Each migration is applied in its own transaction and recorded in the
+schema_version table. Migration statements are written to be idempotent so
+that databases created by older versions of ``manage.py initialize`` can be
+brought up to date regardless of which objects they already contain.
+
+A freshly initialized database is created from the current ORM metadata and
+stamped with the latest version.
+
+The layout of the email table, with text keys and float times or with the
+compact binary keys and integer times of settings.db_compact_schema, is not
+part of the version. The layout is set on the engine by db.create_engine,
+initialize() creates the table in the layout of its engine, and convert()
+rewrites the table from one layout to the other.
+"""
+import logging
+import typing
+
+import sqlalchemy
+import sqlalchemy.ext.asyncio
+
+from .db import SQL_BASE, Email, Outbox, SchemaVersion, pack_key, unpack_key
+
+L = logging.getLogger("vmail.migrations")
+
+
+class Migration(typing.NamedTuple):
+    """
+    A schema change. Statements are SQL strings or callables receiving a
+    synchronous Connection.
+    """
+
+    version: int
+    description: str
+    statements: typing.Sequence[typing.Union[str, typing.Callable]]
+
+
+MIGRATIONS: typing.List[Migration] = [
+    Migration(
+        1,
+        "Index email.token and request / verification times",
+        [
+            # Not unique: older databases may hold the same token for two
+            # addresses. Migration 4 replaces the unique index earlier
+            # releases created here.
+            "CREATE INDEX IF NOT EXISTS ix_email_token ON email (token) "
+            "WHERE token IS NOT NULL",
+            "CREATE INDEX IF NOT EXISTS ix_email_trequested_tverified "
+            "ON email (trequested, tverified)",
+        ],
+    ),
+    Migration(
+        2,
+        "Add outbox table for queued verification emails",
+        [lambda connection: Outbox.__table__.create(connection, checkfirst=True)],
+    ),
+    Migration(
+        3,
+        "Index the last activity of unverified addresses for the reaper",
+        [
+            "CREATE INDEX IF NOT EXISTS ix_email_unverified_tlast "
+            "ON email (coalesce(trequested, tcreated)) WHERE tverified IS NULL",
+        ],
+    ),
+    Migration(
+        4,
+        "Allow the same token for different addresses",
+        [
+            "DROP INDEX IF EXISTS ix_email_token",
+            "CREATE INDEX IF NOT EXISTS ix_email_token ON email (token) "
+            "WHERE token IS NOT NULL",
+        ],
+    ),
+]
+
+HEAD = MIGRATIONS[-1].version
+
+
+def _current_version(connection: sqlalchemy.Connection) -> int:
+    inspector = sqlalchemy.inspect(connection)
+    if not inspector.has_table(SchemaVersion.__tablename__):
+        return 0
+    version = connection.scalar(sqlalchemy.select(sqlalchemy.func.max(SchemaVersion.version)))
+    return version or 0
+
+
+def _record(connection: sqlalchemy.Connection, migration: Migration):
+    connection.execute(
+        sqlalchemy.insert(SchemaVersion).values(
+            version=migration.version, description=migration.description
+        )
+    )
+
+
+async def current_version(engine: sqlalchemy.ext.asyncio.AsyncEngine) -> int:
+    """
+    Return the schema version of the database, 0 if it has never been migrated.
+    """
+    async with engine.connect() as connection:
+        return await connection.run_sync(_current_version)
+
+
+async def initialize(engine: sqlalchemy.ext.asyncio.AsyncEngine) -> int:
+    """
+    Create all tables and stamp a new database with the latest version.
+
+    An existing database is left at its recorded version; use upgrade() to
+    migrate it.
+    """
+    async with engine.begin() as connection:
+        version = await connection.run_sync(_current_version)
+        is_new = not await connection.run_sync(
+            lambda c: sqlalchemy.inspect(c).has_table("email")
+        )
+        await connection.run_sync(SQL_BASE.metadata.create_all)
+        if is_new:
+            for migration in MIGRATIONS:
+                await connection.run_sync(_record, migration)
+            version = HEAD
+    return version
+
+
+async def upgrade(
+    engine: sqlalchemy.ext.asyncio.AsyncEngine, target: typing.Optional[int] = None
+) -> typing.List[Migration]:
+    """
+    Apply pending migrations up to and including target (default latest).
+
+    Returns:
+        The migrations that were applied.
+    """
+    if target is None:
+        target = HEAD
+    async with engine.begin() as connection:
+        await connection.run_sync(
+            SchemaVersion.__table__.create, checkfirst=True
+        )
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version > target:
+            break
+        async with engine.begin() as connection:
+            if migration.version <= await connection.run_sync(_current_version):
+                continue
+            L.info("Applying migration %s: %s", migration.version, migration.description)
+            for statement in migration.statements:
+                if callable(statement):
+                    await connection.run_sync(statement)
+                else:
+                    await connection.execute(sqlalchemy.text(statement))
+            await connection.run_sync(_record, migration)
+        applied.append(migration)
+    return applied
+
+
+def _email_table(metadata: sqlalchemy.MetaData, name: str, compact: bool) -> sqlalchemy.Table:
+    """
+    Table with the columns of Email in the compact or the original layout.
+    """
+    key_type = sqlalchemy.types.LargeBinary(33) if compact else sqlalchemy.types.String()
+    time_type = sqlalchemy.types.BigInteger() if compact else sqlalchemy.types.Float()
+    return sqlalchemy.Table(
+        name,
+        metadata,
+        sqlalchemy.Column("address", key_type, primary_key=True),
+        sqlalchemy.Column("token", sqlalchemy.types.String(), nullable=True),
+        sqlalchemy.Column("tcreated", time_type, nullable=False),
+        sqlalchemy.Column("trequested", time_type, nullable=True),
+        sqlalchemy.Column("tverified", time_type, nullable=True),
+    )
+
+
+def _is_compact(connection: sqlalchemy.Connection) -> bool:
+    columns = sqlalchemy.inspect(connection).get_columns(Email.__tablename__)
+    address = next(column for column in columns if column["name"] == "address")
+    return isinstance(address["type"], sqlalchemy.types.LargeBinary)
+
+
+async def is_compact(engine: sqlalchemy.ext.asyncio.AsyncEngine) -> bool:
+    """
+    Return True if the email table has the compact layout.
+    """
+    async with engine.connect() as connection:
+        return await connection.run_sync(_is_compact)
+
+
+def _convert(connection: sqlalchemy.Connection, compact: bool, batch_size: int) -> int:
+    metadata = sqlalchemy.MetaData()
+    source = _email_table(metadata, Email.__tablename__, not compact)
+    target = _email_table(metadata, "email_convert", compact)
+    target.drop(connection, checkfirst=True)
+    target.create(connection)
+    if compact:
+        key, time = pack_key, int
+    else:
+        key, time = (lambda value: unpack_key(bytes(value))), float
+    n_rows = 0
+    after = None
+    while True:
+        statement = sqlalchemy.select(source).order_by(source.c.address).limit(batch_size)
+        if after is not None:
+            statement = statement.where(source.c.address > after)
+        rows = connection.execute(statement).all()
+        if not rows:
+            break
+        after = rows[-1].address
+        connection.execute(
+            target.insert(),
+            [
+                {
+                    "address": key(row.address),
+                    "token": row.token,
+                    "tcreated": time(row.tcreated),
+                    "trequested": None if row.trequested is None else time(row.trequested),
+                    "tverified": None if row.tverified is None else time(row.tverified),
+                }
+                for row in rows
+            ],
+        )
+        n_rows += len(rows)
+        L.info("Converted %s rows", n_rows)
+    source.drop(connection)
+    connection.exec_driver_sql("ALTER TABLE email_convert RENAME TO email")
+    if connection.dialect.name == "postgresql":
+        connection.exec_driver_sql("ALTER INDEX email_convert_pkey RENAME TO email_pkey")
+    for index in Email.__table__.indexes:
+        index.create(connection)
+    return n_rows
+
+
+async def convert(
+    engine: sqlalchemy.ext.asyncio.AsyncEngine, compact: bool, batch_size: int = 10000
+) -> typing.Optional[int]:
+    """
+    Rewrite the email table in the compact layout, or back to the original
+    layout, in one transaction. The table is copied in batches of
+    batch_size rows, ordered by key, and replaced by the copy.
+
+    Returns:
+        Number of rows converted, or None if the table already has the
+        requested layout.
+    """
+    async with engine.begin() as connection:
+        if await connection.run_sync(_is_compact) == compact:
+            return None
+        return await connection.run_sync(_convert, compact, batch_size)
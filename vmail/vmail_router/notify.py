@@ -0,0 +1,186 @@
+"""
+Notification of verification state changes to waiting requests.
+
+Requests waiting for an address to be verified (``/verified?wait=`` and
+``/verified/stream``) subscribe to its key on the worker's StatusHub before
+reading its state, so a change made between the read and the wait is not
+missed. VmailRepo.verify publishes the new state to the hub, which resolves
+the waiting futures of the key; no waiter queries the database again.
+
+Changes made by other workers arrive through the hub's notifier. The default
+LocalNotifier reaches only the current worker; with status_notify_url set,
+RedisNotifier publishes to a Redis channel every worker listens to.
+"""
+import asyncio
+import contextlib
+import logging
+import typing
+
+from ..config import get_settings
+
+L = logging.getLogger("vmail.notify")
+
+Deliver = typing.Callable[[str, int], None]
+
+
+class Notifier(typing.Protocol):
+    """
+    Transport of state changes between workers.
+    """
+
+    async def publish(self, key: str, state: int):
+        ...
+
+    async def listen(self, deliver: Deliver):
+        """
+        Call deliver(key, state) for each change published by any worker,
+        until cancelled.
+        """
+        ...
+
+
+class LocalNotifier:
+    """
+    Notifier for a single worker, which needs no transport.
+    """
+
+    async def publish(self, key: str, state: int):
+        pass
+
+    async def listen(self, deliver: Deliver):
+        pass
+
+
+class RedisNotifier:
+    """
+    Notifier shared between workers through Redis pub/sub. Requires the
+    redis package.
+    """
+
+    def __init__(self, url: str, channel: str = "vmail:status"):
+        import redis.asyncio
+
+        self._redis = redis.asyncio.from_url(url)
+        self._channel = channel
+
+    async def publish(self, key: str, state: int):
+        await self._redis.publish(self._channel, f"{state} {key}")
+
+    async def listen(self, deliver: Deliver):
+        pubsub = self._redis.pubsub()
+        await pubsub.subscribe(self._channel)
+        try:
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                state, _, key = message["data"].decode("utf-8").partition(" ")
+                deliver(key, int(state))
+        finally:
+            await pubsub.aclose()
+
+
+class StatusHub:
+    """
+    Futures of the requests waiting on each address key.
+    """
+
+    def __init__(self, notifier: Notifier, max_waiters: int = 10000):
+        self.notifier = notifier
+        self.max_waiters = max_waiters
+        self._waiters: typing.Dict[str, typing.Set[asyncio.Future]] = {}
+        self.waiting = 0
+        self.published = 0
+        self.delivered = 0
+        self.timeouts = 0
+
+    @contextlib.contextmanager
+    def subscribe(self, key: str) -> typing.Iterator[asyncio.Future]:
+        """
+        Return a future resolved with the next state published for key.
+
+        Raises:
+            OverflowError if max_waiters requests are already waiting.
+        """
+        if self.waiting >= self.max_waiters:
+            raise OverflowError("Too many waiting requests.")
+        change = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, set()).add(change)
+        self.waiting += 1
+        try:
+            yield change
+        finally:
+            self.waiting -= 1
+            waiters = self._waiters.get(key)
+            if waiters is not None:
+                waiters.discard(change)
+                if not waiters:
+                    del self._waiters[key]
+
+    async def wait(self, change: asyncio.Future, timeout: float) -> typing.Optional[int]:
+        """
+        Wait up to timeout seconds for change, from subscribe(), without
+        cancelling it.
+
+        Returns:
+            The published state, or None on timeout.
+        """
+        done, _ = await asyncio.wait({change}, timeout=timeout)
+        if not done:
+            self.timeouts += 1
+            return None
+        return change.result()
+
+    def _deliver(self, key: str, state: int):
+        for change in self._waiters.pop(key, ()):
+            if not change.done():
+                change.set_result(state)
+                self.delivered += 1
+
+    async def publish(self, key: str, state: int):
+        """
+        Resolve the waiters of key on this worker and notify the others.
+        A notifier error is logged rather than raised, as the change itself
+        has already been stored.
+        """
+        self.published += 1
+        self._deliver(key, state)
+        try:
+            await self.notifier.publish(key, state)
+        except Exception as e:
+            L.warning("Could not publish status change: %s", e)
+
+    async def run(self):
+        """
+        Deliver changes published by other workers until cancelled.
+        """
+        while True:
+            try:
+                await self.notifier.listen(self._deliver)
+            except Exception as e:
+                L.error("Status notifier error: %s", e)
+            await asyncio.sleep(1)
+
+    def stats(self) -> dict:
+        return {
+            "notifier": type(self.notifier).__name__,
+            "waiting": self.waiting,
+            "keys": len(self._waiters),
+            "published": self.published,
+            "delivered": self.delivered,
+            "timeouts": self.timeouts,
+        }
+
+
+STATUS_HUB = None
+
+
+def get_status_hub() -> StatusHub:
+    global STATUS_HUB
+    if STATUS_HUB is None:
+        settings = get_settings()
+        if settings.status_notify_url:
+            notifier = RedisNotifier(settings.status_notify_url)
+        else:
+            notifier = LocalNotifier()
+        STATUS_HUB = StatusHub(notifier, max_waiters=settings.verified_wait_max_waiters)
+    return STATUS_HUB
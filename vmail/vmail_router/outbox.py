@@ -0,0 +1,180 @@
+"""
+Background delivery of queued verification emails.
+
+When outbox_enabled is set, /register queues the verification email in the
+outbox table and returns immediately. An OutboxSender, run either in the
+application lifespan or by ``manage.py send``, drains the outbox with bounded
+concurrency, sending each group of claimed messages over one pooled SMTP
+session and retrying failed sends with exponential backoff. The token is
+recorded against the address when the message is queued, and its expiration
+time restarts once the message has been handed to the SMTP server.
+
+With sharded databases the sender is given one session factory per shard,
+and each entry is confirmed on the shard it was claimed from, which is the
+shard of its recipient.
+"""
+import asyncio
+import logging
+import random
+import typing
+
+import sqlalchemy.ext.asyncio
+
+from . import KeyHasher, build_verification_messages, get_smtp_pool, settings
+from . import cache
+from . import repo
+from .db import Outbox
+
+L = logging.getLogger("vmail.outbox")
+
+
+class OutboxSender:
+    def __init__(
+        self,
+        session_factory: typing.Union[
+            sqlalchemy.ext.asyncio.async_sessionmaker,
+            typing.Sequence[sqlalchemy.ext.asyncio.async_sessionmaker],
+        ],
+        concurrency: int = 4,
+        poll_seconds: float = 5,
+        max_attempts: int = 8,
+        backoff_seconds: float = 10,
+        backoff_max_seconds: float = 3600,
+        lease_seconds: float = 300,
+        key_hasher: typing.Optional[KeyHasher] = None,
+    ):
+        if isinstance(session_factory, sqlalchemy.ext.asyncio.async_sessionmaker):
+            session_factory = [session_factory]
+        self._session_factories = list(session_factory)
+        self.concurrency = concurrency
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.lease_seconds = lease_seconds
+        self.key_hasher = key_hasher
+        self._wakeup = asyncio.Event()
+        self.sent = 0
+        self.failed = 0
+        self.abandoned = 0
+
+    def wake(self):
+        """
+        Process the outbox now rather than at the next poll.
+        """
+        self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "abandoned": self.abandoned,
+        }
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.backoff_max_seconds, self.backoff_seconds * 2 ** (attempts - 1))
+        return delay * random.uniform(0.9, 1.1)
+
+    async def _deliver(
+        self,
+        entries: typing.List[Outbox],
+        session_factory: sqlalchemy.ext.asyncio.async_sessionmaker,
+    ):
+        messages = await build_verification_messages(
+            [
+                dict(
+                    recipient=entry.recipient,
+                    otp=entry.token,
+                    url=entry.url,
+                    name=entry.name,
+                    app_name=entry.app_name,
+                )
+                for entry in entries
+            ]
+        )
+        results = await get_smtp_pool().send_many(messages)
+        for entry, sent in zip(entries, results):
+            await self._confirm(entry, sent, session_factory)
+
+    async def _confirm(
+        self,
+        entry: Outbox,
+        sent: bool,
+        session_factory: sqlalchemy.ext.asyncio.async_sessionmaker,
+    ):
+        async with session_factory() as session:
+            if sent:
+                self.sent += 1
+                repository = repo.VmailRepo(
+                    session,
+                    status_cache=cache.get_status_cache(),
+                    rehash_on_read=settings.hash_rehash_on_read,
+                    key_hasher=self.key_hasher,
+                )
+                # Entries queued by register already hold their token
+                if not await repository.verification_sent(entry.recipient, entry.token):
+                    try:
+                        await repository.verification_requested(entry.recipient, entry.token)
+                    except ValueError:
+                        L.warning("Token for outbox entry %s already recorded", entry.id)
+                await repo.OutboxRepo(session).complete(entry.id)
+                return
+            self.failed += 1
+            if entry.attempts >= self.max_attempts:
+                self.abandoned += 1
+                L.error("Abandoning outbox entry %s after %s attempts", entry.id, entry.attempts)
+                await repo.OutboxRepo(session).complete(entry.id)
+                return
+            await repo.OutboxRepo(session).retry(
+                entry.id, self.backoff(entry.attempts), "send failed"
+            )
+
+    async def run_once(self) -> int:
+        """
+        Send all messages that are currently due.
+
+        Returns:
+            Number of messages processed.
+        """
+        n_processed = 0
+        for session_factory in self._session_factories:
+            while True:
+                async with session_factory() as session:
+                    entries = await repo.OutboxRepo(session).claim(
+                        self.concurrency * 4, self.lease_seconds
+                    )
+                if not entries:
+                    break
+                groups = [entries[i :: self.concurrency] for i in range(self.concurrency)]
+                await asyncio.gather(
+                    *[self._deliver(group, session_factory) for group in groups if group]
+                )
+                n_processed += len(entries)
+        return n_processed
+
+    async def run(self):
+        """
+        Drain the outbox until cancelled.
+        """
+        L.info("Outbox sender started")
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.run_once()
+            except Exception as e:
+                L.error("Outbox sender error: %s", e)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+
+SENDER: typing.Optional[OutboxSender] = None
+
+
+def wake():
+    """
+    Wake the in-process sender, if one is running.
+    """
+    if SENDER is not None:
+        SENDER.wake()
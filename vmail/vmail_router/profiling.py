@@ -0,0 +1,331 @@
+"""
+Opt-in profiling of individual requests.
+
+With profile_enabled set, ProfileMiddleware profiles requests that carry the
+X-Vmail-Profile header with the value of profile_token, and a random
+profile_sample_rate share of the others. A profiled request is run under
+cProfile, its profile is written to profile_dir for inspection with pstats or
+snakeviz, and its response carries a Server-Timing header with the time spent
+in each phase (auth, ratelimit, db, pool, dns, render, smtp) and in total.
+
+cProfile records every coroutine the event loop runs while the request is in
+progress, not only the request's own, so profiles are clearest on a quiet
+worker. Only one request is profiled at a time; others triggered meanwhile get
+the Server-Timing header only. Phases are timed through span() and record(),
+which do nothing outside a profiled request.
+
+LoopWatchdog logs the stack of the event loop thread whenever the loop has not
+run for loop_block_threshold_seconds, which points at the synchronous call
+blocking it.
+"""
+import asyncio
+import contextlib
+import contextvars
+import hmac
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+import typing
+
+import sqlalchemy
+import sqlalchemy.ext.asyncio
+
+from ..config import get_settings
+from . import metrics
+
+L = logging.getLogger("vmail.profiling")
+
+HEADER = "x-vmail-profile"
+
+LOOP_BLOCKS = metrics.REGISTRY.register(
+    metrics.Counter(
+        "vmail_event_loop_blocks_total",
+        "Times the event loop did not run for longer than the block threshold.",
+    )
+)
+
+
+class Timings:
+    """
+    Time spent in each phase of one request.
+    """
+
+    def __init__(self):
+        # phase -> [seconds, count]
+        self.spans: typing.Dict[str, typing.List[float]] = {}
+
+    def add(self, phase: str, seconds: float):
+        span = self.spans.get(phase)
+        if span is None:
+            span = self.spans[phase] = [0.0, 0]
+        span[0] += seconds
+        span[1] += 1
+
+    def header(self, total: float) -> str:
+        """
+        Return a Server-Timing header value, durations in milliseconds.
+        """
+        parts = [
+            f'{phase};dur={seconds * 1000:.2f};desc="{count}x"'
+            for phase, (seconds, count) in self.spans.items()
+        ]
+        parts.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(parts)
+
+
+TIMINGS: contextvars.ContextVar[typing.Optional[Timings]] = contextvars.ContextVar(
+    "vmail_timings", default=None
+)
+
+
+def record(phase: str, seconds: float):
+    """
+    Add seconds to phase of the request being profiled, if any.
+    """
+    timings = TIMINGS.get()
+    if timings is not None:
+        timings.add(phase, seconds)
+
+
+@contextlib.contextmanager
+def span(phase: str) -> typing.Iterator[None]:
+    """
+    Time the enclosed block as phase of the request being profiled, if any.
+    """
+    timings = TIMINGS.get()
+    if timings is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(phase, time.perf_counter() - t0)
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if TIMINGS.get() is not None:
+        connection.info["profile_start"] = time.perf_counter()
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    t0 = connection.info.pop("profile_start", None)
+    if t0 is not None:
+        record("db", time.perf_counter() - t0)
+
+
+def instrument_engine(engine: sqlalchemy.ext.asyncio.AsyncEngine):
+    """
+    Time the statements executed by engine as the db phase.
+    """
+    sync_engine = engine.sync_engine
+    if sqlalchemy.event.contains(sync_engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    sqlalchemy.event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    sqlalchemy.event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class RequestProfiler:
+    def __init__(
+        self,
+        directory: str,
+        token: typing.Optional[str] = None,
+        sample_rate: float = 0.0,
+    ):
+        """
+        Args:
+            directory: Directory the profiles are written to
+            token: Value of the X-Vmail-Profile header requesting a profile,
+                None to profile sampled requests only
+            sample_rate: Share of requests profiled without the header
+        """
+        self.directory = directory
+        self._token = token.encode("utf-8") if token else None
+        self.sample_rate = sample_rate
+        self._profile = None
+        self.requested = 0
+        self.sampled = 0
+        self.profiled = 0
+        self.busy = 0
+
+    def triggered(self, scope) -> bool:
+        """
+        Return whether the request of ASGI scope is to be profiled.
+        """
+        if self._token is not None:
+            for name, value in scope["headers"]:
+                if name == HEADER.encode("latin-1") and hmac.compare_digest(value, self._token):
+                    self.requested += 1
+                    return True
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            self.sampled += 1
+            return True
+        return False
+
+    def start(self):
+        """
+        Start a cProfile profile, or return None if one is already running.
+        """
+        if self._profile is not None:
+            self.busy += 1
+            return None
+        import cProfile
+
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        return self._profile
+
+    async def finish(self, profile, scope, timings: Timings, elapsed: float):
+        """
+        Stop profile and write it to the profile directory.
+        """
+        profile.disable()
+        self._profile = None
+        self.profiled += 1
+        route = getattr(scope.get("route"), "path", None) or "unmatched"
+        name = "{}-{}-{}-{}-{}.prof".format(
+            time.strftime("%Y%m%dT%H%M%S"),
+            os.getpid(),
+            self.profiled,
+            scope["method"],
+            re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root",
+        )
+        path = os.path.join(self.directory, name)
+
+        def dump():
+            os.makedirs(self.directory, exist_ok=True)
+            profile.dump_stats(path)
+
+        try:
+            await asyncio.to_thread(dump)
+        except OSError as e:
+            L.error("Could not write profile %s: %s", path, e)
+            return
+        L.info(
+            "Profiled %s %s in %.1f ms to %s: %s",
+            scope["method"],
+            route,
+            elapsed * 1000,
+            path,
+            timings.header(elapsed),
+        )
+
+    def stats(self) -> dict:
+        return {
+            "requested": self.requested,
+            "sampled": self.sampled,
+            "profiled": self.profiled,
+            "busy": self.busy,
+        }
+
+
+class ProfileMiddleware:
+    """
+    ASGI middleware profiling the requests selected by a RequestProfiler.
+    """
+
+    def __init__(self, app, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.profiler.triggered(scope):
+            return await self.app(scope, receive, send)
+        timings = Timings()
+        reset = TIMINGS.set(timings)
+        profile = self.profiler.start()
+        t0 = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                header = timings.header(time.perf_counter() - t0).encode("latin-1")
+                message = dict(
+                    message, headers=list(message.get("headers", [])) + [(b"server-timing", header)]
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - t0
+            TIMINGS.reset(reset)
+            if profile is not None:
+                await self.profiler.finish(profile, scope, timings, elapsed)
+
+
+class LoopWatchdog:
+    """
+    Thread reporting event loop stalls with the stack of the blocking call.
+    """
+
+    def __init__(self, threshold_seconds: float):
+        self.threshold_seconds = threshold_seconds
+        self.interval_seconds = threshold_seconds / 4
+        self._beat = time.monotonic()
+        self.blocks = 0
+        self.longest_seconds = 0.0
+
+    def _watch(self, thread_id: int, stop: threading.Event):
+        reported = None
+        while not stop.wait(self.interval_seconds):
+            beat = self._beat
+            # The loop is due to beat again interval_seconds after a beat
+            stalled = time.monotonic() - beat - self.interval_seconds
+            if stalled <= self.threshold_seconds:
+                continue
+            self.longest_seconds = max(self.longest_seconds, stalled)
+            if beat == reported:
+                continue
+            reported = beat
+            self.blocks += 1
+            LOOP_BLOCKS.inc()
+            frame = sys._current_frames().get(thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            L.warning("Event loop blocked for over %.3f s in:\n%s", stalled, stack)
+
+    async def run(self):
+        """
+        Watch the running event loop until cancelled.
+        """
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._watch,
+            args=(threading.get_ident(), stop),
+            name="vmail-loop-watchdog",
+            daemon=True,
+        )
+        thread.start()
+        try:
+            while True:
+                self._beat = time.monotonic()
+                await asyncio.sleep(self.interval_seconds)
+        finally:
+            stop.set()
+
+    def stats(self) -> dict:
+        return {
+            "threshold_seconds": self.threshold_seconds,
+            "blocks": self.blocks,
+            "longest_seconds": self.longest_seconds,
+        }
+
+
+PROFILER = None
+WATCHDOG = None
+
+
+def get_profiler() -> RequestProfiler:
+    global PROFILER
+    if PROFILER is None:
+        settings = get_settings()
+        PROFILER = RequestProfiler(
+            settings.profile_dir,
+            token=settings.profile_token,
+            sample_rate=settings.profile_sample_rate,
+        )
+    return PROFILER
@@ -0,0 +1,159 @@
+"""
+Token bucket rate limiting per API key and route.
+
+Limits are configured in settings.rate_limits as ``"<requests>/<seconds>"``
+strings keyed by route path (e.g. ``"/register"``), by ``"<key name>:<route
+path>"`` to override the limit of one client, or by ``"*"`` for all other
+routes. Each API key gets its own bucket per route, holding up to
+``requests`` tokens and refilled at ``requests / seconds`` tokens per second.
+"""
+import time
+import typing
+
+from ..config import get_settings
+
+
+class Limit(typing.NamedTuple):
+    requests: int
+    seconds: float
+
+    @classmethod
+    def parse(cls, spec: str) -> "Limit":
+        requests, _, seconds = spec.partition("/")
+        return cls(int(requests), float(seconds or 1))
+
+    @property
+    def refill(self) -> float:
+        return self.requests / self.seconds
+
+
+class RateLimitBackend(typing.Protocol):
+    """
+    Storage for token buckets. Implementations shared between processes
+    (e.g. RedisBackend) apply one limit across all workers.
+    """
+
+    async def acquire(self, bucket: str, capacity: int, refill: float) -> float:
+        """
+        Take a token from bucket.
+
+        Returns:
+            0 if a token was taken, otherwise seconds until one is available.
+        """
+        ...
+
+
+class LocalBackend:
+    """
+    In-process backend. Limits apply per worker.
+    """
+
+    def __init__(self):
+        self._buckets: typing.Dict[str, typing.Tuple[float, float]] = {}
+
+    async def acquire(self, bucket: str, capacity: int, refill: float) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(bucket, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * refill)
+        if tokens >= 1:
+            self._buckets[bucket] = (tokens - 1, now)
+            return 0.0
+        self._buckets[bucket] = (tokens, now)
+        return (1 - tokens) / refill
+
+
+_REDIS_ACQUIRE = """
+local capacity = tonumber(ARGV[1])
+local refill = tonumber(ARGV[2])
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - updated) * refill)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / refill
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("PEXPIRE", KEYS[1], math.ceil(capacity / refill * 1000))
+return tostring(wait)
+"""
+
+
+class RedisBackend:
+    """
+    Backend shared between workers through Redis. Requires the redis package.
+    """
+
+    def __init__(self, url: str, prefix: str = "vmail:rate:"):
+        import redis.asyncio
+
+        self._redis = redis.asyncio.from_url(url)
+        self._acquire = self._redis.register_script(_REDIS_ACQUIRE)
+        self._prefix = prefix
+
+    async def acquire(self, bucket: str, capacity: int, refill: float) -> float:
+        wait = await self._acquire(keys=[self._prefix + bucket], args=[capacity, refill])
+        return float(wait)
+
+
+class RateLimiter:
+    def __init__(self, backend: RateLimitBackend, limits: typing.Dict[str, str]):
+        self.backend = backend
+        self.limits = {name: Limit.parse(spec) for name, spec in limits.items()}
+        self.allowed = 0
+        self.limited = 0
+
+    def limit(self, client: str, route: str) -> typing.Optional[Limit]:
+        for name in (f"{client}:{route}", route, "*"):
+            limit = self.limits.get(name)
+            if limit is not None:
+                return limit
+        return None
+
+    async def check(self, client: str, route: str) -> float:
+        """
+        Count a request by client to route.
+
+        Returns:
+            0 if the request is allowed, otherwise seconds until it would be.
+        """
+        limit = self.limit(client, route)
+        if limit is None:
+            return 0.0
+        wait = await self.backend.acquire(f"{client}:{route}", limit.requests, limit.refill)
+        if wait > 0:
+            self.limited += 1
+        else:
+            self.allowed += 1
+        return wait
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self.backend).__name__,
+            "allowed": self.allowed,
+            "limited": self.limited,
+        }
+
+
+RATE_LIMITER = None
+
+
+def get_rate_limiter() -> typing.Optional[RateLimiter]:
+    """
+    Return the configured rate limiter, or None if no limits are set.
+    """
+    global RATE_LIMITER
+    settings = get_settings()
+    if not settings.rate_limits:
+        return None
+    if RATE_LIMITER is None:
+        if settings.rate_limit_url:
+            backend = RedisBackend(settings.rate_limit_url)
+        else:
+            backend = LocalBackend()
+        RATE_LIMITER = RateLimiter(backend, settings.rate_limits)
+    return RATE_LIMITER
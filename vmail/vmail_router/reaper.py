@@ -0,0 +1,120 @@
+"""
+Removal of stale rows from the email table.
+
+Tokens that can no longer be verified are removed, and addresses that were
+never verified are deleted once they have not been requested for
+reap_retention_seconds. Rows are processed in batches of reap_batch_size,
+each in its own transaction, so the job never holds locks on much of the
+table. A Reaper runs periodically in the application lifespan when
+reap_interval_seconds is set, or once from ``manage.py reap``. With sharded
+databases it is given one session factory per shard and reaps each in turn.
+"""
+import asyncio
+import logging
+import time
+import typing
+
+import sqlalchemy.ext.asyncio
+
+from . import cache
+from . import repo
+
+L = logging.getLogger("vmail.reaper")
+
+
+class ReapResult(typing.NamedTuple):
+    expired_tokens: int
+    purged: int
+    batches: int
+    elapsed: float
+
+
+class Reaper:
+    def __init__(
+        self,
+        session_factory: typing.Union[
+            sqlalchemy.ext.asyncio.async_sessionmaker,
+            typing.Sequence[sqlalchemy.ext.asyncio.async_sessionmaker],
+        ],
+        token_timeout_seconds: float = 15 * 60,
+        retention_seconds: float = 30 * 24 * 3600,
+        batch_size: int = 1000,
+        interval_seconds: float = 3600,
+    ):
+        if isinstance(session_factory, sqlalchemy.ext.asyncio.async_sessionmaker):
+            session_factory = [session_factory]
+        self._session_factories = list(session_factory)
+        self.token_timeout_seconds = token_timeout_seconds
+        self.retention_seconds = max(retention_seconds, token_timeout_seconds)
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self.runs = 0
+        self.expired_tokens = 0
+        self.purged = 0
+        self.last: typing.Optional[ReapResult] = None
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "expired_tokens": self.expired_tokens,
+            "purged": self.purged,
+            "last": self.last._asdict() if self.last is not None else None,
+        }
+
+    async def _drain(self, method: str, before: float) -> typing.Tuple[int, int]:
+        n_total = batches = 0
+        for session_factory in self._session_factories:
+            while True:
+                async with session_factory() as session:
+                    repository = repo.VmailRepo(session, status_cache=cache.get_status_cache())
+                    n_batch = await getattr(repository, method)(before, batch_size=self.batch_size)
+                batches += 1
+                n_total += n_batch
+                if n_batch < self.batch_size:
+                    break
+                # Let other work use the database between batches
+                await asyncio.sleep(0)
+        return n_total, batches
+
+    async def run_once(self) -> ReapResult:
+        """
+        Remove expired tokens and purge stale unverified addresses.
+        """
+        t0 = time.perf_counter()
+        now = time.time()
+        expired_tokens, token_batches = await self._drain(
+            "expire_tokens", now - self.token_timeout_seconds
+        )
+        purged, purge_batches = await self._drain("purge_unverified", now - self.retention_seconds)
+        result = ReapResult(
+            expired_tokens=expired_tokens,
+            purged=purged,
+            batches=token_batches + purge_batches,
+            elapsed=time.perf_counter() - t0,
+        )
+        self.runs += 1
+        self.expired_tokens += expired_tokens
+        self.purged += purged
+        self.last = result
+        return result
+
+    async def run(self):
+        """
+        Reap every interval_seconds until cancelled.
+        """
+        L.info("Reaper started")
+        while True:
+            try:
+                result = await self.run_once()
+                L.info(
+                    "Removed %s expired tokens, purged %s addresses in %.3fs",
+                    result.expired_tokens,
+                    result.purged,
+                    result.elapsed,
+                )
+            except Exception as e:
+                L.error("Reaper error: %s", e)
+            await asyncio.sleep(self.interval_seconds)
+
+
+REAPER: typing.Optional[Reaper] = None
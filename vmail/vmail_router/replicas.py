@@ -0,0 +1,155 @@
+"""
+Routing of read-only queries to database replicas.
+
+Status reads (read, read_many) are sent to one of the replica engines, taken
+round-robin, while every write goes to the primary. A replica that fails a
+query or a periodic health check is skipped until it passes a check again,
+and reads fall back to the primary when no replica is healthy.
+
+Replicas lag the primary, so addresses written through this process are read
+from the primary for read_your_writes_seconds afterwards. Writes made by other
+workers are not tracked; the window should exceed the replication lag.
+"""
+import asyncio
+import logging
+import typing
+
+import sqlalchemy
+import sqlalchemy.ext.asyncio
+
+from . import cache
+from . import db
+
+L = logging.getLogger("vmail.replicas")
+
+
+class Replica:
+    def __init__(self, engine: sqlalchemy.ext.asyncio.AsyncEngine):
+        self.engine = engine
+        self.session_factory = sqlalchemy.ext.asyncio.async_sessionmaker(
+            bind=engine, expire_on_commit=False
+        )
+        self.name = engine.url.render_as_string(hide_password=True)
+        self.healthy = True
+        self.reads = 0
+        self.failures = 0
+        self.last_error: typing.Optional[str] = None
+
+    def stats(self) -> dict:
+        return {
+            "healthy": self.healthy,
+            "reads": self.reads,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "pool": db.pool_stats(self.engine),
+        }
+
+
+class ReplicaSet:
+    def __init__(
+        self,
+        engines: typing.Sequence[sqlalchemy.ext.asyncio.AsyncEngine],
+        read_your_writes_seconds: float = 5,
+        check_interval_seconds: float = 5,
+        check_timeout_seconds: float = 2,
+        max_tracked_writes: int = 100000,
+    ):
+        """
+        Args:
+            engines: Replica engines
+            read_your_writes_seconds: Time after a write during which the
+                address is read from the primary
+            check_interval_seconds: Time between health checks in run()
+            check_timeout_seconds: Time allowed for a health check query
+            max_tracked_writes: Maximum number of recently written addresses
+                remembered
+        """
+        self.replicas = [Replica(engine) for engine in engines]
+        self.check_interval_seconds = check_interval_seconds
+        self.check_timeout_seconds = check_timeout_seconds
+        self._recent_writes = cache.TTLCache(
+            max_entries=max_tracked_writes, ttl=read_your_writes_seconds
+        )
+        self._next = 0
+        self.primary_reads = 0
+
+    def wrote(self, key: str):
+        """
+        Record a write of key, so it is read from the primary for a while.
+        """
+        self._recent_writes.set(key, True)
+
+    def recently_wrote(self, key: str) -> bool:
+        """
+        Return whether key is within the read-your-writes window.
+        """
+        return self._recent_writes.get(key, False)
+
+    def choose(self, keys: typing.Iterable[str]) -> typing.Optional[Replica]:
+        """
+        Return the replica to read keys from, or None to read from the primary.
+        """
+        if any(self.recently_wrote(key) for key in keys):
+            self.primary_reads += 1
+            return None
+        n_replicas = len(self.replicas)
+        for i in range(n_replicas):
+            replica = self.replicas[(self._next + i) % n_replicas]
+            if replica.healthy:
+                self._next = (self._next + i + 1) % n_replicas
+                replica.reads += 1
+                return replica
+        self.primary_reads += 1
+        return None
+
+    def failed(self, replica: Replica, error: Exception):
+        """
+        Take replica out of rotation until it passes a health check.
+        """
+        if replica.healthy:
+            L.warning("Replica %s failed, reading from others: %s", replica.name, error)
+        replica.healthy = False
+        replica.failures += 1
+        replica.last_error = str(error)
+
+    @staticmethod
+    async def _ping(replica: Replica):
+        # Read the table rather than SELECT 1, so a replica that is reachable
+        # but not yet restored or migrated is also kept out of rotation
+        async with replica.engine.connect() as connection:
+            await connection.execute(sqlalchemy.select(db.Email.address).limit(1))
+
+    async def _check(self, replica: Replica):
+        try:
+            await asyncio.wait_for(self._ping(replica), timeout=self.check_timeout_seconds)
+        except Exception as e:
+            self.failed(replica, e)
+            return
+        if not replica.healthy:
+            L.info("Replica %s recovered", replica.name)
+        replica.healthy = True
+
+    async def check(self):
+        """
+        Run a health check query on every replica.
+        """
+        await asyncio.gather(*[self._check(replica) for replica in self.replicas])
+
+    async def run(self):
+        """
+        Check the replicas every check_interval_seconds until cancelled.
+        """
+        while True:
+            await self.check()
+            await asyncio.sleep(self.check_interval_seconds)
+
+    async def dispose(self):
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+    def stats(self) -> dict:
+        return {
+            "primary_reads": self.primary_reads,
+            "tracked_writes": len(self._recent_writes),
+            "replicas": {replica.name: replica.stats() for replica in self.replicas},
+        }
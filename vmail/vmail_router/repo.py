@@ -2,63 +2,269 @@
 Repository implementation for vmail.
 """
 
+import asyncio
+import contextlib
+import hmac
 import time
 import typing
 
 import sqlalchemy
-import sqlalchemy.orm
 import sqlalchemy.exc
-from . import hash_something
+import sqlalchemy.ext.asyncio
+import sqlalchemy.orm.exc
+from . import HASH_SCHEMES, KeyHasher, get_key_hasher, is_key
+from . import cache
 from . import model
-from .db import Email
+from . import notify
+from . import replicas
+from . import shards
+from .db import Email, Outbox, compact_schema, key_order, pack_key
+
+
+class AmbiguousToken(Exception):
+    """
+    Raised by verify when a token given without its address or key is held
+    by more than one address.
+    """
+
+
+class Registration(typing.NamedTuple):
+    state: model.VerifiedEnum
+    # True if a new token was assigned and should be sent
+    assigned: bool
 
 
 class BaseRepo:
-    def __init__(self, session: sqlalchemy.orm.Session):
+    def __init__(self, session: sqlalchemy.ext.asyncio.AsyncSession):
         self._session = session
 
-    def __exit__(self, exc_type, exc_value, exc_traceback) -> None:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback) -> None:
         if any([exc_type, exc_value, exc_traceback]):
-            self._session.rollback()
+            await self._session.rollback()
             return
         try:
-            self._session.commit()
+            await self._session.commit()
         except sqlalchemy.exc.DatabaseError as e:
-            self._session.rollback()
+            await self._session.rollback()
             raise e
 
+    async def rollback(self):
+        await self._session.rollback()
+
+    async def close(self):
+        await self._session.close()
+
 
 class VmailRepo(BaseRepo):
-    def clear(self) -> int:
+    def __init__(
+        self,
+        session: sqlalchemy.ext.asyncio.AsyncSession,
+        status_cache: typing.Optional[cache.StatusCache] = None,
+        rehash_on_read: bool = False,
+        replica_set: typing.Optional[replicas.ReplicaSet] = None,
+        status_hub: typing.Optional[notify.StatusHub] = None,
+        key_hasher: typing.Optional[KeyHasher] = None,
+    ):
+        """
+        Args:
+            session: Database session
+            status_cache: Optional cache that read() and read_many() read
+                through. Entries are invalidated when the state of an address
+                is changed through this repository.
+            rehash_on_read: Move rows found under a fallback hash scheme key
+                to the current scheme key when they are read.
+            replica_set: Optional replicas that read() and read_many() query
+                instead of session. Addresses changed through this repository
+                are read from session for a while afterwards.
+            status_hub: Optional hub that verify() publishes verified
+                addresses to.
+            key_hasher: Keys of addresses, by default those of the
+                application settings.
+        """
+        super().__init__(session)
+        self._key_hasher = key_hasher or get_key_hasher()
+        self._status_cache = status_cache
+        self._rehash_on_read = rehash_on_read
+        self._rehashed = False
+        self._replica_set = replica_set
+        self._status_hub = status_hub
+
+    async def _invalidate(self, key: str):
+        if self._replica_set is not None:
+            self._replica_set.wrote(key)
+        if self._status_cache is not None:
+            await self._status_cache.invalidate(key)
+
+    async def _invalidate_many(self, keys: typing.Sequence[str]):
+        if self._replica_set is not None:
+            for key in keys:
+                self._replica_set.wrote(key)
+        if self._status_cache is not None:
+            await self._status_cache.invalidate_many(keys)
+
+    async def clear(self) -> int:
         try:
-            n_deleted = self._session.query(Email).delete()
-            self._session.commit()
-            return n_deleted
+            result = await self._session.execute(sqlalchemy.delete(Email))
+            await self._session.commit()
+            return result.rowcount
         except Exception as e:
-            self._session.rollback()
+            await self._session.rollback()
             raise e
 
-    def save(self, email_address: str):
-        hashed = hash_something(email_address)
+    async def save(self, email_address: str):
+        hashed = self._key_hasher.hash(email_address)
         self._session.add(Email(address=hashed))
         try:
-            self._session.commit()
+            await self._session.commit()
         except sqlalchemy.exc.DatabaseError as e:
-            self._session.rollback()
+            await self._session.rollback()
             raise e
+        await self._invalidate(hashed)
 
-    def get_instance(self, email_address: str) -> typing.Optional[Email]:
-        key = hash_something(email_address)
-        instance = self._session.query(Email).filter(Email.address == key).first()
-        if not instance:
-            return None
-        return instance
+    async def _get_instance_by_key(
+        self, key: str, session: typing.Optional[sqlalchemy.ext.asyncio.AsyncSession] = None
+    ) -> typing.Optional[Email]:
+        return await (session or self._session).scalar(
+            sqlalchemy.select(Email).where(Email.address == key).limit(1)
+        )
 
-    def get_instance_by_token(self, token: str) -> typing.Optional[Email]:
-        instance = self._session.query(Email).filter(Email.token == token).first()
-        if instance is None:
-            return None
-        return instance
+    async def _rehash(self, moves: typing.List[typing.Tuple[Email, str]]) -> bool:
+        """
+        Change the primary key of rows found under a fallback scheme key to
+        the current scheme key, in a savepoint. The move is committed by the
+        caller's own commit, or by _read_instances for reads.
+
+        Returns:
+            False if the rows could not be moved, e.g. because another worker
+            moved them first.
+        """
+        if not moves or not self._rehash_on_read:
+            return True
+        try:
+            async with self._session.begin_nested():
+                for instance, key in moves:
+                    instance.address = key
+        except (sqlalchemy.exc.IntegrityError, sqlalchemy.orm.exc.StaleDataError):
+            return False
+        self._rehashed = True
+        return True
+
+    async def _get_instances(
+        self,
+        email_addresses: typing.Sequence[str],
+        session: typing.Optional[sqlalchemy.ext.asyncio.AsyncSession] = None,
+        rehash: bool = True,
+    ) -> typing.Dict[str, Email]:
+        """
+        Fetch the rows of email_addresses, trying the current and fallback
+        hash scheme keys in one query.
+
+        Rows found under a fallback key are moved to the current key, unless
+        rehash is False or they were read from another session (a replica).
+        """
+        keys = {}
+        for email_address in email_addresses:
+            for key in self._key_hasher.candidates(email_address):
+                keys[key] = email_address
+        result = {}
+        legacy = {}
+        instances = await (session or self._session).scalars(
+            sqlalchemy.select(Email).where(Email.address.in_(list(keys)))
+        )
+        for instance in instances:
+            email_address = keys[instance.address]
+            if instance.address == self._key_hasher.hash(email_address):
+                result[email_address] = instance
+            else:
+                legacy.setdefault(email_address, instance)
+        moves = []
+        for email_address, instance in legacy.items():
+            if email_address not in result:
+                result[email_address] = instance
+                moves.append((instance, self._key_hasher.hash(email_address)))
+        if session is not None or not rehash:
+            return result
+        if not await self._rehash(moves):
+            # Another worker moved the rows first, they now have the current key
+            return await self._get_instances(email_addresses, rehash=False)
+        return result
+
+    async def get_instance(
+        self,
+        email_address: str,
+        session: typing.Optional[sqlalchemy.ext.asyncio.AsyncSession] = None,
+    ) -> typing.Optional[Email]:
+        if not self._key_hasher.fallback_schemes:
+            return await self._get_instance_by_key(self._key_hasher.hash(email_address), session)
+        instances = await self._get_instances([email_address], session)
+        return instances.get(email_address)
+
+    async def _read_instances(
+        self, email_addresses: typing.Sequence[str]
+    ) -> typing.Tuple[typing.Dict[str, Email], bool]:
+        """
+        Fetch the rows of email_addresses from a replica if one is available,
+        otherwise from the primary session.
+
+        Returns:
+            The rows by email address, and whether they were read from a
+            replica.
+        """
+
+        async def fetch(session=None):
+            if len(email_addresses) == 1:
+                instance = await self.get_instance(email_addresses[0], session)
+                return {} if instance is None else {email_addresses[0]: instance}
+            return await self._get_instances(email_addresses, session)
+
+        replica = None
+        if self._replica_set is not None:
+            replica = self._replica_set.choose(
+                [self._key_hasher.hash(email_address) for email_address in email_addresses]
+            )
+        if replica is not None:
+            try:
+                async with replica.session_factory() as session:
+                    return await fetch(session), True
+            except sqlalchemy.exc.DBAPIError as e:
+                self._replica_set.failed(replica, e)
+        instances = await fetch()
+        if self._rehashed:
+            # A read has nothing else pending, so only the moves are committed
+            self._rehashed = False
+            await self._session.commit()
+        return instances, False
+
+    async def _fill(
+        self, fill: cache.Fill, states: typing.Dict[str, int], from_replica: bool
+    ):
+        if from_replica:
+            # A replica may not have caught up with a write made since the
+            # read was routed, so only the primary fills those keys
+            states = {
+                key: state
+                for key, state in states.items()
+                if not self._replica_set.recently_wrote(key)
+            }
+        await self._status_cache.fill(fill, states)
+
+    async def get_instance_by_token(self, token: str) -> typing.Optional[Email]:
+        return await self._session.scalar(
+            sqlalchemy.select(Email).where(Email.token == token).limit(1)
+        )
+
+    async def keys_by_token(self, token: str, limit: int = 2) -> typing.List[str]:
+        """
+        Keys of at most limit addresses holding token.
+        """
+        return list(
+            await self._session.scalars(
+                sqlalchemy.select(Email.address).where(Email.token == token).limit(limit)
+            )
+        )
 
     @classmethod
     def _is_verified(cls, email: Email) -> model.VerifiedEnum:
@@ -74,14 +280,353 @@ class VmailRepo(BaseRepo):
             return model.VerifiedEnum.pending
         return model.VerifiedEnum.verified
 
-    def read(self, email_address: str) -> typing.Optional[model.EmailAddress]:
-        instance = self.get_instance(email_address)
-        if instance is None:
+    @classmethod
+    def _state(cls, email: typing.Optional[Email]) -> typing.Optional[model.VerifiedEnum]:
+        return None if email is None else cls._is_verified(email)
+
+    async def read(self, email_address: str) -> typing.Optional[model.EmailAddress]:
+        key = self._key_hasher.hash(email_address)
+        if self._status_cache is not None:
+            state = await self._status_cache.get(key)
+            if state == cache.StatusCache.NOT_FOUND:
+                return None
+            if state is not None:
+                return model.EmailAddress(address=email_address, verified=state)
+        with contextlib.ExitStack() as stack:
+            if self._status_cache is not None:
+                fill = stack.enter_context(self._status_cache.filling([key]))
+            instances, from_replica = await self._read_instances([email_address])
+            verified = VmailRepo._state(instances.get(email_address))
+            if self._status_cache is not None:
+                await self._fill(
+                    fill,
+                    {key: cache.StatusCache.NOT_FOUND if verified is None else verified},
+                    from_replica,
+                )
+        if verified is None:
             return None
-        verified = VmailRepo._is_verified(instance)
         return model.EmailAddress(address=email_address, verified=verified)
 
-    def verification_requested(self, email_address: str, token: str) -> typing.Optional[float]:
+    async def read_many(
+        self, email_addresses: typing.Iterable[str], chunk_size: int = 500
+    ) -> typing.Dict[str, model.EmailAddress]:
+        """
+        Read the verification state of many addresses.
+
+        Rows are fetched with one IN (...) query per chunk of chunk_size
+        addresses.
+
+        Returns:
+            Dict of email address to EmailAddress for the addresses that
+            are registered. Unknown addresses are omitted.
+        """
+        hash_key = self._key_hasher.hash
+        keys = {hash_key(email_address): email_address for email_address in email_addresses}
+        key_list = list(keys)
+        result = {}
+        if self._status_cache is not None:
+            uncached = []
+            for key, state in zip(key_list, await self._status_cache.get_many(key_list)):
+                if state is None:
+                    uncached.append(key)
+                elif state != cache.StatusCache.NOT_FOUND:
+                    result[keys[key]] = model.EmailAddress(address=keys[key], verified=state)
+            key_list = uncached
+        for start in range(0, len(key_list), chunk_size):
+            chunk_keys = key_list[start : start + chunk_size]
+            chunk = [keys[key] for key in chunk_keys]
+            with contextlib.ExitStack() as stack:
+                if self._status_cache is not None:
+                    fill = stack.enter_context(self._status_cache.filling(chunk_keys))
+                instances, from_replica = await self._read_instances(chunk)
+                states = {}
+                for key, email_address in zip(chunk_keys, chunk):
+                    verified = VmailRepo._state(instances.get(email_address))
+                    if verified is not None:
+                        result[email_address] = model.EmailAddress(
+                            address=email_address, verified=verified
+                        )
+                    states[key] = cache.StatusCache.NOT_FOUND if verified is None else verified
+                if self._status_cache is not None:
+                    await self._fill(fill, states, from_replica)
+        return result
+
+    async def rehash(self, email_addresses: typing.Sequence[str]) -> int:
+        """
+        Move the rows of email_addresses stored under a fallback scheme key to
+        the current scheme key, with one SELECT and one executemany UPDATE.
+
+        Returns:
+            Number of rows moved
+        """
+        keys = {}
+        for email_address in email_addresses:
+            current, *fallbacks = self._key_hasher.candidates(email_address)
+            keys[current] = current
+            for key in fallbacks:
+                keys[key] = current
+        found = set(
+            await self._session.scalars(
+                sqlalchemy.select(Email.address).where(Email.address.in_(list(keys)))
+            )
+        )
+        moves = {}
+        for key in found:
+            current = keys[key]
+            if key != current and current not in found:
+                moves.setdefault(current, key)
+        if not moves:
+            return 0
+        table = Email.__table__
+        try:
+            await self._session.execute(
+                table.update()
+                .where(table.c.address == sqlalchemy.bindparam("old"))
+                .values(address=sqlalchemy.bindparam("new")),
+                [{"old": old, "new": new} for new, old in moves.items()],
+            )
+            await self._session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            # Rows were moved concurrently, the next pass sees their new keys
+            await self._session.rollback()
+            return await self.rehash(email_addresses)
+        await self._invalidate_many(list(moves))
+        return len(moves)
+
+    async def count_by_scheme(self) -> typing.Dict[int, int]:
+        """
+        Count the stored rows of each hash scheme.
+        """
+        counts = {}
+        compact = compact_schema(self._session.bind.dialect)
+        total = await self._session.scalar(sqlalchemy.select(sqlalchemy.func.count(Email.address)))
+        for scheme in HASH_SCHEMES:
+            if scheme == 0:
+                continue
+            if compact:
+                # Keys of scheme 1 and later are 33 bytes, starting with the scheme
+                criteria = [
+                    sqlalchemy.func.length(Email.address) == 33,
+                    sqlalchemy.func.substr(Email.address, 1, 1) == bytes([scheme]),
+                ]
+            else:
+                criteria = [Email.address.startswith(f"{scheme}:")]
+            counts[scheme] = await self._session.scalar(
+                sqlalchemy.select(sqlalchemy.func.count(Email.address)).where(*criteria)
+            )
+        counts[0] = total - sum(counts.values())
+        return counts
+
+    @classmethod
+    def _verified_clause(cls):
+        """
+        SQL equivalent of _is_verified(...) == VerifiedEnum.verified
+        """
+        return sqlalchemy.and_(
+            Email.trequested.is_not(None),
+            Email.tverified.is_not(None),
+            Email.tverified >= Email.trequested,
+            Email.token.is_(None),
+        )
+
+    async def _copy_verified(self, rows: typing.Sequence[typing.Tuple[str, float]]) -> int:
+        """
+        Postgres import: COPY rows into a temporary table and merge it into
+        email with one INSERT ... SELECT.
+        """
+        columns = "(address TEXT, tverified DOUBLE PRECISION)"
+        if compact_schema(self._session.bind.dialect):
+            columns = "(address BYTEA, tverified BIGINT)"
+            rows = [(pack_key(key), int(tverified)) for key, tverified in rows]
+        connection = await self._session.connection()
+        raw = await connection.get_raw_connection()
+        async with raw.driver_connection.cursor() as cursor:
+            await cursor.execute(
+                f"CREATE TEMPORARY TABLE IF NOT EXISTS email_import {columns} "
+                "ON COMMIT DELETE ROWS"
+            )
+            async with cursor.copy("COPY email_import (address, tverified) FROM STDIN") as copy:
+                for row in rows:
+                    await copy.write_row(row)
+            await cursor.execute(
+                "INSERT INTO email (address, tcreated, trequested, tverified, token) "
+                "SELECT DISTINCT ON (address) address, tverified, tverified, tverified, NULL "
+                "FROM email_import "
+                "ON CONFLICT (address) DO UPDATE SET token = NULL, "
+                "trequested = excluded.trequested, tverified = excluded.tverified "
+                "WHERE NOT (email.trequested IS NOT NULL AND email.tverified IS NOT NULL "
+                "AND email.tverified >= email.trequested AND email.token IS NULL)"
+            )
+            return cursor.rowcount
+
+    async def import_verified(self, rows: typing.Sequence[typing.Tuple[str, float]]) -> int:
+        """
+        Store rows of (key, tverified) as verified addresses, in one
+        transaction. Keys are stored as given, so addresses must already be
+        hashed. Rows that are already verified are left unchanged.
+
+        On Postgres the rows are loaded with COPY, on SQLite with one
+        executemany INSERT ... ON CONFLICT DO UPDATE.
+
+        Returns:
+            Number of rows inserted or updated
+        """
+        if not rows:
+            return 0
+        dialect = self._session.bind.dialect.name
+        try:
+            if dialect == "postgresql":
+                n_written = await self._copy_verified(rows)
+            else:
+                n_written = await self._import_verified(dialect, rows)
+            await self._session.commit()
+        except Exception as e:
+            await self._session.rollback()
+            raise e
+        await self._invalidate_many([key for key, _ in rows])
+        return n_written
+
+    async def _import_verified(
+        self, dialect: str, rows: typing.Sequence[typing.Tuple[str, float]]
+    ) -> int:
+        table = Email.__table__
+        params = [
+            {"address": key, "tcreated": t, "trequested": t, "tverified": t, "token": None}
+            for key, t in rows
+        ]
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+
+            statement = insert(table)
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.address],
+                set_={
+                    "token": None,
+                    "trequested": statement.excluded.trequested,
+                    "tverified": statement.excluded.tverified,
+                },
+                where=sqlalchemy.not_(VmailRepo._verified_clause()),
+            )
+            result = await self._session.execute(statement, params)
+            return result.rowcount
+        # Other dialects: insert the new keys and update the unverified ones
+        latest = {}
+        for param in params:
+            latest[param["address"]] = param
+        existing = {
+            instance.address: instance
+            for instance in await self._session.scalars(
+                sqlalchemy.select(Email).where(Email.address.in_(list(latest)))
+            )
+        }
+        n_written = 0
+        for key, param in latest.items():
+            instance = existing.get(key)
+            if instance is None:
+                self._session.add(Email(**param))
+            elif VmailRepo._is_verified(instance) == model.VerifiedEnum.verified:
+                continue
+            else:
+                instance.token = None
+                instance.trequested = instance.tverified = param["tverified"]
+            n_written += 1
+        return n_written
+
+    async def export_verified(
+        self, batch_size: int = 10000, after: typing.Optional[str] = None
+    ) -> typing.List[typing.Tuple[str, float]]:
+        """
+        Read the next batch of verified rows as (key, tverified), ordered by
+        key and starting after key after. Paging by primary key keeps each
+        query an index range scan however far into the table it starts.
+        """
+        statement = (
+            sqlalchemy.select(Email.address, Email.tverified)
+            .where(VmailRepo._verified_clause())
+            .order_by(Email.address)
+            .limit(batch_size)
+        )
+        if after is not None:
+            statement = statement.where(Email.address > after)
+        return [tuple(row) for row in await self._session.execute(statement)]
+
+    async def export_rows(
+        self, batch_size: int = 10000, after: typing.Optional[str] = None
+    ) -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        Read the next batch of rows, in any state, as dicts of their columns,
+        ordered by key and starting after key after.
+        """
+        table = Email.__table__
+        statement = sqlalchemy.select(table).order_by(table.c.address).limit(batch_size)
+        if after is not None:
+            statement = statement.where(table.c.address > after)
+        return [dict(row) for row in (await self._session.execute(statement)).mappings()]
+
+    async def import_rows(self, rows: typing.Sequence[typing.Dict[str, typing.Any]]) -> int:
+        """
+        Insert rows, as read by export_rows, in one transaction. Rows whose
+        key is already stored are skipped.
+
+        Returns:
+            Number of rows inserted
+        """
+        if not rows:
+            return 0
+        table = Email.__table__
+        dialect = self._session.bind.dialect.name
+        try:
+            if dialect in ("postgresql", "sqlite"):
+                if dialect == "postgresql":
+                    from sqlalchemy.dialects.postgresql import insert
+                else:
+                    from sqlalchemy.dialects.sqlite import insert
+                result = await self._session.execute(
+                    insert(table).on_conflict_do_nothing(index_elements=[table.c.address]),
+                    list(rows),
+                )
+                n_inserted = result.rowcount
+            else:
+                existing = set(
+                    await self._session.scalars(
+                        sqlalchemy.select(Email.address).where(
+                            Email.address.in_([row["address"] for row in rows])
+                        )
+                    )
+                )
+                new_rows = [row for row in rows if row["address"] not in existing]
+                if new_rows:
+                    await self._session.execute(table.insert(), new_rows)
+                n_inserted = len(new_rows)
+            await self._session.commit()
+        except Exception as e:
+            await self._session.rollback()
+            raise e
+        await self._invalidate_many([row["address"] for row in rows])
+        return n_inserted
+
+    async def delete_keys(self, keys: typing.Sequence[str]) -> int:
+        """
+        Delete the rows of keys in one transaction.
+
+        Returns:
+            Number of rows deleted
+        """
+        if not keys:
+            return 0
+        try:
+            result = await self._session.execute(
+                sqlalchemy.delete(Email).where(Email.address.in_(list(keys))),
+                execution_options={"synchronize_session": False},
+            )
+            await self._session.commit()
+        except Exception as e:
+            await self._session.rollback()
+            raise e
+        await self._invalidate_many(list(keys))
+        return result.rowcount
+
+    async def verification_requested(self, email_address: str, token: str) -> typing.Optional[float]:
         """
         Sets the OTP token for the specified email address
 
@@ -94,33 +639,286 @@ class VmailRepo(BaseRepo):
             or None if email is not found.
 
         """
-        test = self.get_instance_by_token(token)
-        if test is not None:
-            raise ValueError("Token already in use.")
-        instance = self.get_instance(email_address)
+        instance = await self.get_instance(email_address)
         if instance is None:
             return None
         instance.token = token
         instance.trequested = time.time()
-        self._session.commit()
+        try:
+            await self._session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            # Tokens are unique until migration 4 has been applied
+            await self._session.rollback()
+            raise ValueError("Token already in use.")
+        await self._invalidate(instance.address)
         return instance.trequested
 
-    def verify(self, token: str, expiration_seconds: float = 3600) -> model.VerifiedEnum:
+    @classmethod
+    def _keep(cls, now: float, cooldown_seconds: float):
+        """
+        Condition on a row whose token is not to be replaced: it is verified,
+        or was sent a token less than cooldown_seconds ago.
+        """
+        verified = sqlalchemy.and_(
+            Email.trequested.is_not(None),
+            Email.tverified.is_not(None),
+            Email.tverified >= Email.trequested,
+            Email.token.is_(None),
+        )
+        if cooldown_seconds <= 0:
+            return verified
+        return sqlalchemy.or_(
+            verified,
+            sqlalchemy.and_(Email.token.is_not(None), Email.trequested > now - cooldown_seconds),
+        )
+
+    @classmethod
+    def _upsert(
+        cls,
+        dialect: str,
+        key: str,
+        token: str,
+        now: float,
+        cooldown_seconds: float,
+        update: bool = True,
+    ):
+        """
+        INSERT ... ON CONFLICT DO UPDATE assigning token to the row of key
+        unless _keep holds, returning whether the row was inserted if it was
+        written.
+
+        SQLite cannot tell an inserted row from an updated one in RETURNING:
+        there the flag is NULL, or with update False the statement is an
+        INSERT ... ON CONFLICT DO NOTHING and existing rows are left to
+        _assign.
+        """
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+
+            # xmax is only set on a row version written by an update
+            inserted = sqlalchemy.literal_column("(xmax = 0)", sqlalchemy.Boolean)
+        elif dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+
+            inserted = sqlalchemy.true() if not update else sqlalchemy.null()
+        else:
+            return None
+        statement = insert(Email).values(address=key, token=token, trequested=now, tcreated=now)
+        if dialect == "sqlite" and not update:
+            statement = statement.on_conflict_do_nothing(index_elements=[Email.address])
+        else:
+            statement = statement.on_conflict_do_update(
+                index_elements=[Email.address],
+                set_={"token": token, "trequested": now},
+                where=sqlalchemy.not_(VmailRepo._keep(now, cooldown_seconds)),
+            )
+        return statement.returning(inserted.label("inserted"))
+
+    @classmethod
+    def _assign(cls, key: str, token: str, now: float, cooldown_seconds: float):
+        """
+        UPDATE assigning token to the existing row of key unless _keep holds,
+        returning a row if it was written.
+        """
+        return (
+            sqlalchemy.update(Email)
+            .where(Email.address == key, sqlalchemy.not_(VmailRepo._keep(now, cooldown_seconds)))
+            .values(token=token, trequested=now)
+            .returning(sqlalchemy.false().label("inserted"))
+        )
+
+    @classmethod
+    def _kept_state(cls, instance: Email) -> model.VerifiedEnum:
+        if VmailRepo._is_verified(instance) == model.VerifiedEnum.verified:
+            return model.VerifiedEnum.verified
+        return model.VerifiedEnum.pending
+
+    async def _register(
+        self, email_address: str, token: str, now: float, cooldown_seconds: float
+    ) -> typing.Optional[model.VerifiedEnum]:
+        """
+        Returns:
+            None if token was assigned, otherwise the state of the address.
+        """
+        key, *fallbacks = self._key_hasher.candidates(email_address)
+        dialect = self._session.bind.dialect.name
+        # Whether the row is new only matters when it may exist under an
+        # older scheme key
+        statement = VmailRepo._upsert(
+            dialect, key, token, now, cooldown_seconds, update=dialect != "sqlite" or not fallbacks
+        )
+        if statement is None:
+            instance = await self.get_instance(email_address)
+            if instance is None:
+                instance = Email(address=key, tcreated=now)
+                self._session.add(instance)
+            elif VmailRepo._is_verified(instance) == model.VerifiedEnum.verified:
+                return model.VerifiedEnum.verified
+            elif instance.token is not None and instance.trequested > now - cooldown_seconds:
+                return model.VerifiedEnum.pending
+            instance.token = token
+            instance.trequested = now
+            return None
+        row = (await self._session.execute(statement)).first()
+        if row is None and dialect == "sqlite" and fallbacks:
+            # Not inserted, the row exists
+            row = (
+                await self._session.execute(VmailRepo._assign(key, token, now, cooldown_seconds))
+            ).first()
+        if row is None:
+            if cooldown_seconds <= 0:
+                return model.VerifiedEnum.verified
+            return VmailRepo._kept_state(await self._get_instance_by_key(key))
+        if not row.inserted or not fallbacks:
+            return None
+        # The row is new, the address may be stored under an older scheme key
+        legacy = await self._session.scalar(
+            sqlalchemy.select(Email.address).where(Email.address.in_(fallbacks)).limit(1)
+        )
+        if legacy is None:
+            return None
+        await self._session.execute(sqlalchemy.delete(Email).where(Email.address == key))
+        await self._session.execute(
+            sqlalchemy.update(Email).where(Email.address == legacy).values(address=key)
+        )
+        assign = VmailRepo._assign(key, token, now, cooldown_seconds)
+        if (await self._session.execute(assign)).first() is None:
+            return VmailRepo._kept_state(await self._get_instance_by_key(key))
+        return None
+
+    async def register(
+        self,
+        email_address: str,
+        token: str,
+        queue: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        cooldown_seconds: float = 0,
+    ) -> Registration:
+        """
+        Register email_address if it is new and assign it token, in one
+        transaction. On Postgres this is a single
+        INSERT ... ON CONFLICT DO UPDATE statement. On SQLite with fallback
+        hash schemes, an existing address takes an INSERT and an UPDATE.
+
+        Args:
+            email_address: Email address
+            token: OTP token
+            queue: Optional Outbox fields (url, name, app_name). A verification
+                email is queued in the same transaction when the token is
+                assigned.
+            cooldown_seconds: Keep the current token if it was assigned less
+                than cooldown_seconds ago.
+
+        Returns:
+            Registration with state VerifiedEnum.verified if the address is
+            already verified, otherwise VerifiedEnum.pending.
+            Registration.assigned is False when nothing was changed.
+
+        Raises:
+            ValueError if the token is in use.
+        """
+        key = self._key_hasher.hash(email_address)
+        if self._status_cache is not None:
+            if await self._status_cache.get(key) == model.VerifiedEnum.verified:
+                return Registration(model.VerifiedEnum.verified, False)
+        try:
+            state = await self._register(email_address, token, time.time(), cooldown_seconds)
+            if state is not None:
+                await self._session.rollback()
+                return Registration(state, False)
+            if queue is not None:
+                self._session.add(Outbox(recipient=email_address, token=token, **queue))
+            await self._session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            await self._session.rollback()
+            raise ValueError("Token already in use.")
+        except sqlalchemy.exc.DatabaseError as e:
+            await self._session.rollback()
+            raise e
+        await self._invalidate(key)
+        return Registration(model.VerifiedEnum.pending, True)
+
+    async def verification_sent(self, email_address: str, token: str) -> bool:
+        """
+        Restart the expiration time of token, recorded by register, when the
+        verification email has been sent.
+
+        Returns:
+            False if the address does not hold token.
+        """
+        result = await self._session.execute(
+            sqlalchemy.update(Email)
+            .where(Email.address == self._key_hasher.hash(email_address), Email.token == token)
+            .values(trequested=time.time())
+        )
+        await self._session.commit()
+        return result.rowcount > 0
+
+    async def verification_failed(self, email_address: str, token: str) -> bool:
+        """
+        Withdraw token, recorded by register, when its verification email
+        could not be sent, so the next registration is not held back by the
+        resend cooldown.
+
+        Returns:
+            False if the address does not hold token.
+        """
+        key = self._key_hasher.hash(email_address)
+        result = await self._session.execute(
+            sqlalchemy.update(Email)
+            .where(Email.address == key, Email.token == token)
+            .values(token=None, trequested=None)
+        )
+        await self._session.commit()
+        await self._invalidate(key)
+        return result.rowcount > 0
+
+    async def verify(
+        self,
+        token: str,
+        expiration_seconds: float = 3600,
+        email_address: typing.Optional[str] = None,
+        key: typing.Optional[str] = None,
+    ) -> typing.Optional[model.VerifiedEnum]:
         """
         Check the provided token matches one recently issued
         and that it was received within the expiration time.
 
+        When the email address, or its key, is provided the row is fetched by
+        primary key and the token compared in constant time. Otherwise the
+        row is found by token, which must then be held by one address only.
+
         Args:
-            email: Email address
             token: Previously issued token
+            expiration_seconds: Seconds after the request that token is accepted
+            email_address: Email address the token was sent to
+            key: Key of the email address, e.g. from verify_url
 
         Returns:
-            True if the token matches and is valid.
+            The verification state, or None if no address holds the token
+            or key is malformed.
 
+        Raises:
+            AmbiguousToken if token alone is held by more than one address.
         """
-        instance = self.get_instance_by_token(token)
-        if instance is None:
-            return model.VerifiedEnum.unverified
+        if email_address is not None:
+            instance = await self.get_instance(email_address)
+        elif key is not None:
+            if not is_key(key):
+                return None
+            instance = await self._get_instance_by_key(key)
+        else:
+            instances = list(
+                await self._session.scalars(
+                    sqlalchemy.select(Email).where(Email.token == token).limit(2)
+                )
+            )
+            if len(instances) > 1:
+                raise AmbiguousToken("Token is held by more than one address.")
+            instance = instances[0] if instances else None
+        if instance is None or instance.token is None:
+            return None
+        if not hmac.compare_digest(instance.token.encode("utf-8"), token.encode("utf-8")):
+            return None
         if instance.trequested is None:
             return model.VerifiedEnum.unverified
         tverified = time.time()
@@ -128,5 +926,320 @@ class VmailRepo(BaseRepo):
             return model.VerifiedEnum.expired
         instance.tverified = tverified
         instance.token = None
-        self._session.commit()
+        await self._session.commit()
+        await self._invalidate(instance.address)
+        if self._status_hub is not None:
+            await self._status_hub.publish(instance.address, model.VerifiedEnum.verified)
         return model.VerifiedEnum.verified
+
+    async def _update_batch(
+        self, statement, batch_size: int, *criteria
+    ) -> typing.Tuple[int, typing.List[str]]:
+        """
+        Apply statement to at most batch_size rows matching criteria and
+        commit, so locks are held for one batch only.
+
+        Returns:
+            Number of rows changed and the keys of the batch.
+        """
+        keys = list(
+            await self._session.scalars(
+                sqlalchemy.select(Email.address).where(*criteria).limit(batch_size)
+            )
+        )
+        if not keys:
+            return 0, keys
+        try:
+            result = await self._session.execute(
+                statement.where(Email.address.in_(keys), *criteria),
+                execution_options={"synchronize_session": False},
+            )
+            await self._session.commit()
+        except sqlalchemy.exc.DatabaseError as e:
+            await self._session.rollback()
+            raise e
+        return result.rowcount, keys
+
+    async def expire_tokens(self, before: float, batch_size: int = 1000) -> int:
+        """
+        Remove tokens requested before the timestamp before, which can no
+        longer be verified. The reported state of the addresses is unchanged.
+
+        Returns:
+            Number of tokens removed, at most batch_size.
+        """
+        n_updated, _ = await self._update_batch(
+            sqlalchemy.update(Email).values(token=None),
+            batch_size,
+            Email.token.is_not(None),
+            Email.trequested < before,
+        )
+        return n_updated
+
+    async def purge_unverified(self, before: float, batch_size: int = 1000) -> int:
+        """
+        Delete addresses that were never verified and were last requested,
+        or created if never requested, before the timestamp before.
+
+        Returns:
+            Number of rows deleted, at most batch_size.
+        """
+        n_deleted, keys = await self._update_batch(
+            sqlalchemy.delete(Email),
+            batch_size,
+            Email.tverified.is_(None),
+            sqlalchemy.func.coalesce(Email.trequested, Email.tcreated) < before,
+        )
+        await self._invalidate_many(keys)
+        return n_deleted
+
+
+class ShardedVmailRepo:
+    """
+    VmailRepo over a ShardSet. Each address is handled by the VmailRepo of
+    its shard, and operations on many addresses are split by shard and run
+    on the shards concurrently.
+    """
+
+    def __init__(
+        self,
+        shard_set: shards.ShardSet,
+        status_cache: typing.Optional[cache.StatusCache] = None,
+        rehash_on_read: bool = False,
+        status_hub: typing.Optional[notify.StatusHub] = None,
+        key_hasher: typing.Optional[KeyHasher] = None,
+    ):
+        """
+        Args:
+            shard_set: Shard databases
+            status_cache: Optional status cache, as for VmailRepo
+            rehash_on_read: As for VmailRepo
+            status_hub: Optional status hub, as for VmailRepo
+            key_hasher: As for VmailRepo
+        """
+        self._shard_set = shard_set
+        self._key_hasher = key_hasher or get_key_hasher()
+        self._status_cache = status_cache
+        self._rehash_on_read = rehash_on_read
+        self._status_hub = status_hub
+        self._repos: typing.Dict[int, VmailRepo] = {}
+
+    def shard(self, shard: int) -> VmailRepo:
+        """
+        Repository of one shard, with a session opened on first use.
+        """
+        repository = self._repos.get(shard)
+        if repository is None:
+            repository = self._repos[shard] = VmailRepo(
+                self._shard_set.session_factories[shard](),
+                status_cache=self._status_cache,
+                rehash_on_read=self._rehash_on_read,
+                status_hub=self._status_hub,
+                key_hasher=self._key_hasher,
+            )
+        return repository
+
+    def _shard_of(self, email_address: str) -> int:
+        return self._shard_set.shard_of_key(self._key_hasher.hash(email_address))
+
+    def _of(self, email_address: str) -> VmailRepo:
+        return self.shard(self._shard_of(email_address))
+
+    def _group(self, items: typing.Iterable, shard_of: typing.Callable) -> typing.Dict[int, list]:
+        groups = {}
+        for item in items:
+            groups.setdefault(shard_of(item), []).append(item)
+        return groups
+
+    async def _gather(self, calls: typing.Dict[int, typing.Callable]) -> list:
+        """
+        Run calls[shard](repository) on each shard concurrently, each on its
+        own session.
+        """
+        return await asyncio.gather(
+            *[call(self.shard(shard)) for shard, call in calls.items()]
+        )
+
+    async def _all(self, method: str, *args) -> list:
+        return await self._gather(
+            {
+                shard: lambda repository: getattr(repository, method)(*args)
+                for shard in range(len(self._shard_set))
+            }
+        )
+
+    async def rollback(self):
+        for repository in self._repos.values():
+            await repository.rollback()
+
+    async def close(self):
+        for repository in self._repos.values():
+            await repository.close()
+
+    async def clear(self) -> int:
+        return sum(await self._all("clear"))
+
+    async def read(self, email_address: str) -> typing.Optional[model.EmailAddress]:
+        return await self._of(email_address).read(email_address)
+
+    async def read_many(
+        self, email_addresses: typing.Iterable[str], chunk_size: int = 500
+    ) -> typing.Dict[str, model.EmailAddress]:
+        groups = self._group(set(email_addresses), self._shard_of)
+        result = {}
+        for found in await self._gather(
+            {
+                shard: lambda repository, group=group: repository.read_many(group, chunk_size)
+                for shard, group in groups.items()
+            }
+        ):
+            result.update(found)
+        return result
+
+    async def register(
+        self,
+        email_address: str,
+        token: str,
+        queue: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        cooldown_seconds: float = 0,
+    ) -> Registration:
+        # The outbox entry is queued on the same shard, in the same transaction
+        return await self._of(email_address).register(email_address, token, queue, cooldown_seconds)
+
+    async def verification_requested(self, email_address: str, token: str) -> typing.Optional[float]:
+        return await self._of(email_address).verification_requested(email_address, token)
+
+    async def verification_sent(self, email_address: str, token: str) -> bool:
+        return await self._of(email_address).verification_sent(email_address, token)
+
+    async def verification_failed(self, email_address: str, token: str) -> bool:
+        return await self._of(email_address).verification_failed(email_address, token)
+
+    async def get_instance_by_token(self, token: str) -> typing.Optional[Email]:
+        for instance in await self._all("get_instance_by_token", token):
+            if instance is not None:
+                return instance
+        return None
+
+    async def verify(
+        self,
+        token: str,
+        expiration_seconds: float = 3600,
+        email_address: typing.Optional[str] = None,
+        key: typing.Optional[str] = None,
+    ) -> typing.Optional[model.VerifiedEnum]:
+        """
+        As VmailRepo.verify. With the address or its key only its shard is
+        queried, otherwise the token is looked up on all shards in parallel.
+        """
+        if email_address is not None:
+            return await self._of(email_address).verify(token, expiration_seconds, email_address)
+        if key is None:
+            keys = [key for found in await self._all("keys_by_token", token) for key in found]
+            if len(keys) > 1:
+                raise AmbiguousToken("Token is held by more than one address.")
+            if not keys:
+                return None
+            key = keys[0]
+        elif not is_key(key):
+            # Not a key, and not one the shard can be computed from
+            return None
+        repository = self.shard(self._shard_set.shard_of_key(key))
+        return await repository.verify(token, expiration_seconds, key=key)
+
+    async def rehash(self, email_addresses: typing.Sequence[str]) -> int:
+        groups = self._group(email_addresses, self._shard_of)
+        return sum(
+            await self._gather(
+                {
+                    shard: lambda repository, group=group: repository.rehash(group)
+                    for shard, group in groups.items()
+                }
+            )
+        )
+
+    async def count_by_scheme(self) -> typing.Dict[int, int]:
+        counts = {}
+        for shard_counts in await self._all("count_by_scheme"):
+            for scheme, count in shard_counts.items():
+                counts[scheme] = counts.get(scheme, 0) + count
+        return counts
+
+    async def import_verified(self, rows: typing.Sequence[typing.Tuple[str, float]]) -> int:
+        groups = self._group(rows, lambda row: self._shard_set.shard_of_key(row[0]))
+        return sum(
+            await self._gather(
+                {
+                    shard: lambda repository, group=group: repository.import_verified(group)
+                    for shard, group in groups.items()
+                }
+            )
+        )
+
+    async def export_verified(
+        self, batch_size: int = 10000, after: typing.Optional[str] = None
+    ) -> typing.List[typing.Tuple[str, float]]:
+        """
+        As VmailRepo.export_verified, merging the batches of all shards so
+        rows are still ordered by key.
+        """
+        batches = await self._all("export_verified", batch_size, after)
+        compact = compact_schema(self._shard_set.engines[0].dialect)
+        rows = sorted(
+            (row for batch in batches for row in batch), key=lambda row: key_order(row[0], compact)
+        )
+        return rows[:batch_size]
+
+
+class OutboxRepo(BaseRepo):
+    async def claim(self, limit: int, lease_seconds: float) -> typing.List[Outbox]:
+        """
+        Claim up to limit messages that are due for sending.
+
+        Claimed messages are leased by pushing their next attempt time
+        lease_seconds into the future, so a sender that dies mid-send does
+        not lose them. On Postgres, rows locked by another sender are skipped.
+        """
+        now = time.time()
+        try:
+            entries = list(
+                await self._session.scalars(
+                    sqlalchemy.select(Outbox)
+                    .where(Outbox.tnext <= now)
+                    .order_by(Outbox.tnext)
+                    .limit(limit)
+                    .with_for_update(skip_locked=True)
+                )
+            )
+            for entry in entries:
+                entry.attempts += 1
+                entry.tnext = now + lease_seconds
+            await self._session.commit()
+        except sqlalchemy.exc.DatabaseError as e:
+            await self._session.rollback()
+            raise e
+        return entries
+
+    async def complete(self, entry_id: int):
+        """
+        Remove a message that has been sent or abandoned.
+        """
+        await self._session.execute(sqlalchemy.delete(Outbox).where(Outbox.id == entry_id))
+        await self._session.commit()
+
+    async def retry(self, entry_id: int, delay_seconds: float, error: str):
+        """
+        Schedule another attempt at sending a message after delay_seconds.
+        """
+        await self._session.execute(
+            sqlalchemy.update(Outbox)
+            .where(Outbox.id == entry_id)
+            .values(tnext=time.time() + delay_seconds, last_error=error)
+        )
+        await self._session.commit()
+
+    async def pending(self) -> int:
+        """
+        Number of messages waiting to be sent.
+        """
+        return await self._session.scalar(sqlalchemy.select(sqlalchemy.func.count(Outbox.id)))
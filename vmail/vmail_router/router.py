@@ -3,32 +3,166 @@ FastAPI router implementing the vmail endpoints.
 
 """
 
+import asyncio
+import contextlib
 import logging
 import typing
+import urllib.parse
+import weakref
 import email_validator
 import fastapi
-import sqlalchemy.exc
+import fastapi.responses
 
-from . import create_otp, send_verification_email
+from . import create_otp, hash_something, is_key, send_verification_email
+from . import deliverability
 from . import model
+from . import notify
+from . import outbox
+from . import profiling
+from . import repo
+from . import singleflight
 
 L = logging.getLogger("vmail.router")
 
 
+class Registrations:
+    """
+    /register calls in flight, with counts of verification emails sent
+    directly and of sends avoided by coalescing and by the resend cooldown.
+    """
+
+    def __init__(self):
+        self.inflight = singleflight.SingleFlight()
+        self.sent = 0
+        self.cooldown = 0
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.inflight.calls,
+            "coalesced": self.inflight.coalesced,
+            "cooldown": self.cooldown,
+            "sent": self.sent,
+            "avoided": self.inflight.coalesced + self.cooldown,
+        }
+
+
+REGISTRATIONS = Registrations()
+
+
 def get_vmail_router(
     get_settings: typing.Callable,
+    get_repository: typing.Callable,
     dependencies: typing.List[fastapi.Depends] = None,
 ) -> fastapi.APIRouter:
     settings = get_settings()
     router = fastapi.APIRouter(dependencies=dependencies)
+    Repository = typing.Annotated[repo.VmailRepo, fastapi.Depends(get_repository)]
 
-    def get_verify_url(token: str) -> str:
+    def get_verify_url(token: str, key: str) -> str:
         url = settings.verify_url
-        return url.format(token=token)
+        return url.format(token=token, key=urllib.parse.quote(key, safe=""))
+
+    BatchEmails = typing.Annotated[
+        typing.List[str], fastapi.Body(max_length=settings.batch_max_size)
+    ]
+
+    async def check_domains(
+        entries: typing.List[typing.Tuple[model.EmailAddress, email_validator.ValidatedEmail]]
+    ):
+        """
+        Check deliverability once per distinct domain, marking undeliverable
+        entries as invalid.
+        """
+        resolver = deliverability.get_resolver()
+        domains = {info.ascii_domain: info.domain for _, info in entries}
+        with profiling.span("dns"):
+            statuses = dict(
+                zip(
+                    domains,
+                    await asyncio.gather(
+                        *[resolver.check(domain, domain_i18n) for domain, domain_i18n in domains.items()]
+                    ),
+                )
+            )
+        for result, info in entries:
+            status = statuses[info.ascii_domain]
+            if not status.deliverable:
+                result.valid = False
+                result.message = status.message
+
+    async def batch_results(
+        emails: typing.List[str],
+        repository: repo.VmailRepo,
+        check_deliverability: bool,
+    ) -> typing.AsyncIterator[typing.List[model.EmailAddress]]:
+        """
+        Validate and look up emails, yielding results one chunk at a time.
+        """
+        chunk_size = settings.batch_chunk_size
+        for start in range(0, len(emails), chunk_size):
+            results = []
+            entries = []
+            for email in emails[start : start + chunk_size]:
+                result = model.EmailAddress(address=email)
+                try:
+                    emailinfo = email_validator.validate_email(
+                        email, check_deliverability=False
+                    )
+                    result.normalized = emailinfo.normalized
+                    result.valid = True
+                    entries.append((result, emailinfo))
+                except email_validator.EmailNotValidError as e:
+                    result.message = str(e)
+                results.append(result)
+            if check_deliverability:
+                await check_domains(entries)
+            records = await repository.read_many(
+                [result.normalized for result, _ in entries if result.valid],
+                chunk_size=chunk_size,
+            )
+            for result, _ in entries:
+                if not result.valid:
+                    continue
+                record = records.get(result.normalized)
+                if record is not None:
+                    result.verified = record.verified
+                    result.message = "OK"
+                else:
+                    result.message = "Address is valid but not verified"
+            yield results
+
+    async def batch_response(
+        request: fastapi.Request,
+        emails: typing.List[str],
+        repository: repo.VmailRepo,
+        check_deliverability: bool,
+    ) -> typing.Union[typing.List[model.EmailAddress], fastapi.Response]:
+        """
+        Return batch results as a JSON list, or streamed as NDJSON when the
+        client accepts application/x-ndjson.
+        """
+        if "application/x-ndjson" not in request.headers.get("accept", ""):
+            results = []
+            async for chunk in batch_results(emails, repository, check_deliverability):
+                results.extend(chunk)
+            return results
+
+        async def stream() -> typing.AsyncIterator[str]:
+            # The request scoped repository is closed before a streamed
+            # body is sent, so the stream uses its own.
+            async with contextlib.asynccontextmanager(get_repository)() as stream_repository:
+                async for chunk in batch_results(
+                    emails, stream_repository, check_deliverability
+                ):
+                    yield "".join(f"{result.model_dump_json()}\n" for result in chunk)
+
+        return fastapi.responses.StreamingResponse(
+            stream(), media_type="application/x-ndjson"
+        )
 
     @router.get("/valid")
     async def test_email_valid(
-        email: str, request: fastapi.Request
+        email: str, repository: Repository
     ) -> model.EmailAddress:
         """
         Checks validity of an email address.
@@ -38,7 +172,13 @@ def get_vmail_router(
         """
         result = model.EmailAddress(address=email)
         try:
-            emailinfo = email_validator.validate_email(email, check_deliverability=True)
+            emailinfo = email_validator.validate_email(email, check_deliverability=False)
+            with profiling.span("dns"):
+                status = await deliverability.get_resolver().check(
+                    emailinfo.ascii_domain, emailinfo.domain
+                )
+            if not status.deliverable:
+                raise email_validator.EmailUndeliverableError(status.message)
             result.normalized = emailinfo.normalized
             result.valid = True
             result.verified = False
@@ -50,7 +190,7 @@ def get_vmail_router(
             return result
         # See if the email is in the verified list
         try:
-            record = request.state.vmailrepo.read(result.normalized)
+            record = await repository.read(result.normalized)
             if record is not None:
                 result.verified = record.verified
                 result.message = "Address is valid and verified."
@@ -62,9 +202,74 @@ def get_vmail_router(
             result.message = "ERROR: Could not connect to validation database."
         return result
 
+    @router.post("/valid/batch")
+    async def test_email_valid_batch(
+        emails: BatchEmails, request: fastapi.Request, repository: Repository
+    ) -> typing.List[model.EmailAddress]:
+        """
+        Checks validity and verification status of a list of email addresses.
+
+        Deliverability is checked once per distinct domain. Results are
+        returned in the order of the request, streamed as newline delimited
+        JSON if the request accepts application/x-ndjson.
+        """
+        return await batch_response(request, emails, repository, True)
+
+    async def register(
+        email_address: str, name: typing.Optional[str], appname: typing.Optional[str]
+    ) -> typing.Tuple[model.VerifiedEnum, str]:
+        """
+        Register email_address and send, or queue, its verification email.
+
+        Runs in its own task shared by concurrent callers, so it uses its own
+        repository rather than one scoped to a request.
+        """
+        async with contextlib.asynccontextmanager(get_repository)() as repository:
+            for attempt in range(3):
+                email_token = create_otp()
+                verify_url = get_verify_url(email_token, hash_something(email_address))
+                queue = None
+                if settings.outbox_enabled:
+                    queue = dict(url=verify_url, name=name, app_name=appname)
+                try:
+                    registration = await repository.register(
+                        email_address,
+                        email_token,
+                        queue=queue,
+                        cooldown_seconds=settings.register_cooldown_seconds,
+                    )
+                    break
+                except ValueError:
+                    L.warning("Token collision, retrying")
+            else:
+                raise fastapi.HTTPException(status_code=503, detail="Could not allocate a token")
+            if registration.state == model.VerifiedEnum.verified:
+                return registration.state, "OK"
+            if not registration.assigned:
+                REGISTRATIONS.cooldown += 1
+                return registration.state, "Verification request already sent"
+            if settings.outbox_enabled:
+                outbox.wake()
+                return model.VerifiedEnum.pending, "Verification request queued"
+            send_result = await send_verification_email(
+                email=email_address,
+                otp=email_token,
+                verify_url=verify_url,
+                name=name,
+                app_name=appname,
+            )
+            if send_result:
+                REGISTRATIONS.sent += 1
+                await repository.verification_sent(email_address, email_token)
+                return model.VerifiedEnum.pending, "Verification request sent"
+            await repository.verification_failed(email_address, email_token)
+            return (
+                model.VerifiedEnum.unverified,
+                "There was an error sending the verification request",
+            )
+
     @router.post("/register")
     async def register_email_post(
-        request: fastapi.Request,
         email: typing.Annotated[str, fastapi.Form()],
         name: typing.Annotated[typing.Optional[str], fastapi.Form()] = None,
         appname: typing.Annotated[typing.Optional[str], fastapi.Form()] = None,
@@ -77,6 +282,9 @@ def get_vmail_router(
         verification process. This is usually done by the system requesting
         verification, as the user does not have the API key necessary to connect
         to the /verify operation.
+
+        Concurrent requests for the same address share one registration, and
+        no email is sent again within settings.register_cooldown_seconds.
         """
         result = model.EmailAddress(address=email)
         try:
@@ -85,47 +293,20 @@ def get_vmail_router(
             )
             result.normalized = emailinfo.normalized
             result.valid = True
-            result.verified = model.VerifiedEnum.unverified
-            result.message = "OK"
-            # Is email already verified?
-            verified_email = request.state.vmailrepo.read(emailinfo.normalized)
-            if verified_email is not None:
-                if verified_email.verified == model.VerifiedEnum.verified:
-                    result.verified = verified_email.verified
-                    return result
-            email_token = create_otp()
-            verify_url = get_verify_url(email_token)
-            try:
-                request.state.vmailrepo.save(emailinfo.normalized)
-            except sqlalchemy.exc.IntegrityError:
-                L.warning("Email already registered")
-            send_result = await send_verification_email(
-                email=emailinfo.normalized,
-                otp=email_token,
-                verify_url=verify_url,
-                name=name,
-                app_name=appname,
+            result.verified, result.message = await REGISTRATIONS.inflight.do(
+                hash_something(emailinfo.normalized),
+                lambda: register(emailinfo.normalized, name, appname),
             )
-            if send_result:
-                request.state.vmailrepo.verification_requested(
-                    emailinfo.normalized, email_token
-                )
-                result.verified = model.VerifiedEnum.pending
-                result.message = "Verification request sent"
-            else:
-                result.message = "There was an error sending the verification request"
         except email_validator.EmailNotValidError as e:
             result.valid = False
             result.verified = model.VerifiedEnum.unverified
             result.message = str(e)
         return result
 
-    @router.get("/verified")
-    async def email_verification_status(
-        email: str, request: fastapi.Request
-    ) -> model.EmailAddress:
+    def status_result(email: str) -> model.EmailAddress:
         """
-        Given an email address, return its verification status.
+        Validate email, returning a result to be completed by set_status when
+        it is valid.
         """
         result = model.EmailAddress(address=email)
         try:
@@ -138,16 +319,151 @@ def get_vmail_router(
             result.valid = False
             result.verified = model.VerifiedEnum.unverified
             result.message = str(e)
-            return result
-        record = request.state.vmailrepo.read(result.normalized)
-        if record is not None:
-            result.verified = record.verified
+        return result
+
+    def set_status(result: model.EmailAddress, state: typing.Optional[model.VerifiedEnum]):
+        if state is not None:
+            result.verified = state
             result.message = "OK"
         else:
             result.verified = model.VerifiedEnum.unverified
             result.message = "Address is valid but not verified"
+
+    def too_many_waiters() -> fastapi.HTTPException:
+        return fastapi.HTTPException(
+            status_code=503, detail="Too many waiting requests", headers={"Retry-After": "1"}
+        )
+
+    @router.get("/verified")
+    async def email_verification_status(
+        email: str,
+        repository: Repository,
+        wait: typing.Annotated[
+            typing.Optional[float], fastapi.Query(ge=0, le=settings.verified_wait_max_seconds)
+        ] = None,
+    ) -> model.EmailAddress:
+        """
+        Given an email address, return its verification status.
+
+        With wait, the response for an address that is not verified is held
+        for up to wait seconds, and sent as soon as the address is verified.
+        """
+        result = status_result(email)
+        if not result.valid:
+            return result
+        if not wait:
+            record = await repository.read(result.normalized)
+            set_status(result, None if record is None else record.verified)
+            return result
+        hub = notify.get_status_hub()
+        try:
+            # Subscribe before reading, so a verification in between is seen
+            with hub.subscribe(hash_something(result.normalized)) as change:
+                record = await repository.read(result.normalized)
+                state = None if record is None else record.verified
+                if state != model.VerifiedEnum.verified:
+                    # Release the database connection while waiting
+                    await repository.rollback()
+                    changed = await hub.wait(change, wait)
+                    if changed is not None:
+                        state = changed
+        except OverflowError:
+            raise too_many_waiters()
+        set_status(result, state)
         return result
 
+    @router.get("/verified/stream", response_class=fastapi.responses.StreamingResponse)
+    async def email_verification_status_stream(
+        email: str,
+        repository: Repository,
+        timeout: typing.Annotated[
+            float, fastapi.Query(gt=0, le=settings.verified_wait_max_seconds)
+        ] = settings.verified_wait_max_seconds,
+    ):
+        """
+        Given an email address, stream its verification status as server-sent
+        events.
+
+        A status event with the current status is sent first, and another one
+        when the address is verified, which ends the stream. Otherwise the
+        stream ends after timeout seconds. Comment lines are sent every
+        settings.verified_wait_heartbeat_seconds to keep the connection open.
+        """
+        result = status_result(email)
+
+        def event(result: model.EmailAddress) -> str:
+            return f"event: status\ndata: {result.model_dump_json()}\n\n"
+
+        def respond(body: typing.AsyncIterator[str]) -> fastapi.responses.StreamingResponse:
+            return fastapi.responses.StreamingResponse(
+                body,
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+
+        async def once() -> typing.AsyncIterator[str]:
+            yield event(result)
+
+        if not result.valid:
+            return respond(once())
+        hub = notify.get_status_hub()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        # Subscribe before the response is started, so that a full hub is
+        # answered with a 503, and before reading, so that a verification in
+        # between is seen
+        subscription = contextlib.ExitStack()
+        try:
+            change = subscription.enter_context(hub.subscribe(hash_something(result.normalized)))
+        except OverflowError:
+            raise too_many_waiters()
+        try:
+            record = await repository.read(result.normalized)
+            # Release the database connection while streaming
+            await repository.rollback()
+        except BaseException:
+            subscription.close()
+            raise
+        set_status(result, None if record is None else record.verified)
+        if result.verified == model.VerifiedEnum.verified:
+            subscription.close()
+            return respond(once())
+
+        async def stream() -> typing.AsyncIterator[str]:
+            with subscription:
+                yield event(result)
+                while True:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        return
+                    state = await hub.wait(
+                        change, min(remaining, settings.verified_wait_heartbeat_seconds)
+                    )
+                    if state is None:
+                        yield ": keepalive\n\n"
+                        continue
+                    set_status(result, state)
+                    yield event(result)
+                    return
+
+        events = stream()
+        # The body is not iterated if the client disconnects before the
+        # response starts, and then only its collection releases the waiter
+        weakref.finalize(events, subscription.close)
+        return respond(events)
+
+    @router.post("/verified/batch")
+    async def email_verification_status_batch(
+        emails: BatchEmails, request: fastapi.Request, repository: Repository
+    ) -> typing.List[model.EmailAddress]:
+        """
+        Given a list of email addresses, return their verification status.
+
+        Results are returned in the order of the request, streamed as newline
+        delimited JSON if the request accepts application/x-ndjson.
+        """
+        return await batch_response(request, emails, repository, False)
+
     @router.get("/verify/{token}")
     async def verify_email(
         token: typing.Annotated[
@@ -158,16 +474,41 @@ def get_vmail_router(
                 min_length=settings.otp_digits,
             ),
         ],
-        request: fastapi.Request,
+        repository: Repository,
+        email: typing.Optional[str] = None,
+        key: typing.Optional[str] = None,
     ) -> model.VerifiedResponse:
         """
         Given a previously sent OTP, update the email with its verification
         status.
+
+        The email address the OTP was sent to, or its key as included in the
+        verification URL, should be provided. Without either, the OTP must
+        identify a single address.
         """
-        entry = request.state.vmailrepo.get_instance_by_token(token)
-        if entry is None:
+        email_address = None
+        if email is not None:
+            try:
+                email_address = email_validator.validate_email(
+                    email, check_deliverability=False
+                ).normalized
+            except email_validator.EmailNotValidError:
+                raise fastapi.HTTPException(status_code=404)
+        if key is not None and not is_key(key):
+            raise fastapi.HTTPException(status_code=404)
+        try:
+            state = await repository.verify(
+                token,
+                expiration_seconds=settings.verify_timeout_seconds,
+                email_address=email_address,
+                key=key,
+            )
+        except repo.AmbiguousToken:
+            raise fastapi.HTTPException(
+                status_code=409, detail="Provide the email address or key with the OTP"
+            )
+        if state is None:
             raise fastapi.HTTPException(status_code=404)
-        state = request.state.vmailrepo.verify(token)
         return model.VerifiedResponse(
             verified=state, state=state == model.VerifiedEnum.verified
         )
@@ -0,0 +1,71 @@
+"""
+Partitioning of the email table across several databases.
+
+Each row is stored on the shard chosen from its address key with jump
+consistent hashing (Lamping and Veach, 2014), so adding a shard moves only
+the share of rows that belongs on the new shard. The key is a uniformly
+distributed hash, so the leading 16 hex digits of its digest are used as the
+hash input directly.
+
+Outbox entries are stored on the shard of their recipient, in the same
+transaction as the registration that queued them.
+
+Rows are placed by the key they are stored under, so an address that still
+has a row under a fallback hash scheme key may have it on another shard than
+its current key. Run ``manage.py rehash`` before sharding a database that
+has such rows.
+"""
+import typing
+
+import sqlalchemy.ext.asyncio
+
+from . import db
+from . import hash_something
+
+
+def jump_hash(key: int, n_buckets: int) -> int:
+    """
+    Map a 64 bit integer key to one of n_buckets buckets.
+    """
+    b, j = -1, 0
+    while j < n_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def shard_of_key(key: str, n_shards: int) -> int:
+    """
+    Return the shard of an address key, as produced by hash_something.
+    """
+    if n_shards == 1:
+        return 0
+    # Keys of hash scheme 1 and later carry a "<version>:" prefix
+    digest = key.rpartition(":")[2]
+    return jump_hash(int(digest[:16], 16), n_shards)
+
+
+class ShardSet:
+    def __init__(self, engines: typing.Sequence[sqlalchemy.ext.asyncio.AsyncEngine]):
+        self.engines = list(engines)
+        self.session_factories = [
+            sqlalchemy.ext.asyncio.async_sessionmaker(bind=engine, expire_on_commit=False)
+            for engine in self.engines
+        ]
+
+    def __len__(self) -> int:
+        return len(self.engines)
+
+    def shard_of_key(self, key: str) -> int:
+        return shard_of_key(key, len(self.engines))
+
+    def shard_of(self, email_address: str) -> int:
+        return self.shard_of_key(hash_something(email_address))
+
+    async def dispose(self):
+        for engine in self.engines:
+            await engine.dispose()
+
+    def stats(self) -> typing.List[typing.Optional[dict]]:
+        return [db.pool_stats(engine) for engine in self.engines]